@@ -1,6 +1,5 @@
 import argparse
 from collections import Counter
-import re
 from os.path import join
 import string
 import sys
@@ -9,7 +8,7 @@ from bert_clone.tokenization import BasicTokenizer
 from nltk import word_tokenize
 from tqdm import tqdm
 
-from data import load_xqa_wrapper
+from data import iter_items, iter_xqa, load_xqa_wrapper
 from documentqa_clone.docqa.data_processing.text_utils import NltkAndPunctTokenizer
 from documentqa_clone.docqa.triviaqa.answer_detection import FastNormalizedAnswerDetector, compute_answer_spans_par
 
@@ -31,65 +30,80 @@ def tokenize(sent, language, filter_punctuation):
     return tokenized
 
 
-def compute_num_question_tokens(data: dict, language: str, filter_punct: bool):
+def get_corpus(path: str, part: str, stream: bool):
+    """Returns a function providing the corpus, with stream the corpus is read from disk again on every call"""
+    if stream:
+        return lambda: iter_xqa(path, part)
+    data = load_xqa_wrapper(path, part)
+    return lambda: data
+
+
+def compute_num_question_tokens(data, language: str, filter_punct: bool):
     total = 0
-    for question in data:
-        total += len(tokenize(question, language, filter_punct))
-    return total / len(data)
+    num_questions = 0
+    for item in iter_items(data):
+        total += len(tokenize(item.question, language, filter_punct))
+        num_questions += 1
+    return total / num_questions
 
 
-def compute_num_article_tokes(data: dict, language: str, filter_punct: bool):
+def compute_num_article_tokes(data, language: str, filter_punct: bool):
     total = 0
     num_articles = 0
-    for item in tqdm(data.values()):
+    num_questions = 0
+    for item in tqdm(iter_items(data)):
         articles = item.documents
         for art in articles:
             total += len(tokenize(art, language, filter_punct))
             num_articles += 1
-    return total / len(data), total / num_articles
+        num_questions += 1
+    return total / num_questions, total / num_articles
 
 
-def compute_num_article_bytes(data: dict):
+def compute_num_article_bytes(data):
     total = 0
     num_articles = 0
-    for item in data.values():
+    num_questions = 0
+    for item in iter_items(data):
         articles = item.documents
         for art in articles:
             total += sys.getsizeof(art)
             num_articles += 1
-    return total / len(data), total / num_articles
+        num_questions += 1
+    return total / num_questions, total / num_articles
 
 
-def compute_num_answer_tokens(data: dict, language: str, filter_punct: bool):
+def compute_num_answer_tokens(data, language: str, filter_punct: bool):
     # averaged
     total = 0
     num_answers = 0
-    for item in data.values():
+    for item in iter_items(data):
         for answer in item.gold:
             total += len(tokenize(answer, language, filter_punct))
             num_answers += 1
     return total / num_answers
 
 
-def compute_num_answer_bytes(data: dict):
+def compute_num_answer_bytes(data):
     total = 0
     num_answers = 0
-    for item in data.values():
+    for item in iter_items(data):
         for answer in item.gold:
             total += sys.getsizeof(answer)
             num_answers += 1
     return total / num_answers
 
 
-def compute_num_passage_candidates(data: dict):
+def compute_num_passage_candidates(data):
     total_candidates = 0
     num_articles = 0
-    for item in data.values():
-        for article in item.documents:
-            for answer in item.gold:
-                total_candidates += article.count(answer)
-            num_articles += 1
-    return total_candidates / len(data), total_candidates / num_articles
+    num_questions = 0
+    for item in iter_items(data):
+        matches = item.answer_matcher.match(item.documents)
+        total_candidates += sum(len(spans) for spans in matches.spans)
+        num_articles += len(item.documents)
+        num_questions += 1
+    return total_candidates / num_questions, total_candidates / num_articles
 
 
 def get_stopwords(path, language, filter_punct):
@@ -184,18 +198,13 @@ def compute_lexical_overlap(path: str, language: str, n_processes: int, filter_p
     return total / docs_with_answers
 
 
-def compute_answer_spans(data: dict):
+def compute_answer_spans(data):
     spans = {}
-    for item in data.values():
+    for item in iter_items(data):
         question = item.question
         articles = item.documents
         flat_articles = "\n".join(articles)
-        current_spans = []
-        for answer in item.answers:
-            starts = [match.start() for match in re.finditer(answer, flat_articles)]
-            ends = [start + len(answer) for start in starts]
-            current_spans.extend(zip(starts, ends))
-        spans[question] = current_spans
+        spans[question] = item.answer_matcher.spans(flat_articles)
     return spans
 
 
@@ -215,6 +224,7 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--language", choices=["de", "en", "all"], required=True)
     parser.add_argument("-p", "--part", choices=["train", "dev", "test", "all"])
     parser.add_argument("-f", "--filter", action="store_true")
+    parser.add_argument("--stream", action="store_true", help="Stream the corpus instead of loading it at once")
     args = parser.parse_args()
 
     language_list = [args.language]
@@ -231,15 +241,15 @@ if __name__ == "__main__":
             print("part: ", part)
             path = f"/home/ca/Documents/Uni/Masterarbeit/data/XQA_original/{language}/"
             nltk_language = LANGUAGES[language]
-            data = load_xqa_wrapper(path, part)
+            corpus = get_corpus(path, part, args.stream)
             print("data loaded.")
 
-            print("Num question tokens: ", compute_num_question_tokens(data, nltk_language, args.filter))
-            print("Num article tokens: ", compute_num_article_tokes(data, nltk_language, args.filter))
-            print("Num article bytes: ", compute_num_article_bytes(data))
+            print("Num question tokens: ", compute_num_question_tokens(corpus(), nltk_language, args.filter))
+            print("Num article tokens: ", compute_num_article_tokes(corpus(), nltk_language, args.filter))
+            print("Num article bytes: ", compute_num_article_bytes(corpus()))
             print("Lexical overlap: ", compute_lexical_overlap(path, language, 2, False))
-            print("Num answer tokens: ", compute_num_answer_tokens(data, nltk_language, args.filter))
-            print("Num answer bytes: ", compute_num_answer_bytes(data))
-            print("Num passage candidates", compute_num_passage_candidates(data))
+            print("Num answer tokens: ", compute_num_answer_tokens(corpus(), nltk_language, args.filter))
+            print("Num answer bytes: ", compute_num_answer_bytes(corpus()))
+            print("Num passage candidates", compute_num_passage_candidates(corpus()))
             print()
 
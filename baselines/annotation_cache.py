@@ -0,0 +1,143 @@
+"""
+Persistent cache of the spaCy annotations (Named Entities and nouns) of documents
+"""
+
+from collections import namedtuple
+import hashlib
+from itertools import islice
+import json
+import os
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from data import BaselineData
+
+
+# components a pipeline needs so the cached annotation serves every baseline, see PREDICTORS in baselines.py
+ANNOTATION_COMPONENTS = {"tok2vec", "tagger", "morphologizer", "attribute_ruler", "ner"}
+NOUN_TAGS = {"NOUN", "PROPN"}
+
+CachedSpan = namedtuple("CachedSpan", ["text", "label_"])
+CachedToken = namedtuple("CachedToken", ["text", "pos_"])
+
+
+class CachedDoc(object):
+    """Stand-in for a spaCy Doc built from the cache: ents are the Named Entities, iterating yields the nouns only"""
+
+    def __init__(self, ents: List[CachedSpan], tokens: List[CachedToken]):
+        self.ents = ents
+        self.tokens = tokens
+
+    @classmethod
+    def from_annotation(cls, text: str, annotation: Dict):
+        ents = [CachedSpan(text[start:end], label) for start, end, label in annotation["ents"]]
+        tokens = [CachedToken(text[start:end], pos) for start, end, pos in annotation["nouns"]]
+        return cls(ents, tokens)
+
+    @classmethod
+    def from_doc(cls, doc):
+        """Returns the annotation of a spaCy Doc as it is stored in the cache"""
+        return cls.from_annotation(doc.text, annotation_from_doc(doc))
+
+    @classmethod
+    def join(cls, docs: Iterable["CachedDoc"]):
+        """Returns the annotation of the documents as one context, the documents are annotated separately"""
+        docs = list(docs)
+        return cls([ent for doc in docs for ent in doc.ents], [token for doc in docs for token in doc.tokens])
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+def text_key(text: str, model: str) -> str:
+    return f"{model}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+
+
+def annotation_from_doc(doc) -> Dict:
+    """Returns the character offsets of the Named Entities and nouns of a spaCy Doc"""
+    return {"ents": [(ent.start_char, ent.end_char, ent.label_) for ent in doc.ents],
+            "nouns": [(token.idx, token.idx + len(token.text), token.pos_) for token in doc
+                      if token.pos_ in NOUN_TAGS]}
+
+
+class AnnotationCache(object):
+    """Annotations of documents stored in an sqlite database per spaCy model.
+
+    Every document is annotated on its own and stored under the language, name and version of the model and the hash
+    of its text, so a document shared by several questions is annotated once for every n_best and baseline. Texts are
+    deduplicated before they are annotated and only texts that are not in the cache yet are given to spaCy. An instance
+    can be called like a spaCy pipeline and returns a CachedDoc.
+    """
+
+    def __init__(self, cache_dir: str, nlp, batch_size: int = 64, n_process: int = 1):
+        self.nlp = nlp
+        self.batch_size = batch_size
+        self.n_process = n_process
+        meta = nlp.meta
+        self.model = f"{meta['lang']}_{meta['name']}-{meta['version']}"
+        os.makedirs(cache_dir, exist_ok=True)
+        self.filename = os.path.join(cache_dir, f"{self.model}.sqlite")
+        self._connection = None
+
+    @property
+    def connection(self):
+        # opened on first use, so a cache can be passed to worker processes before it is used
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.filename, timeout=60)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS annotations (key TEXT PRIMARY KEY, value TEXT)")
+        return self._connection
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        return state
+
+    def __call__(self, text: str) -> CachedDoc:
+        return self.annotate([text])[0]
+
+    def annotate(self, texts: List[str]) -> List[CachedDoc]:
+        """Returns the annotations of the texts, annotating each missing distinct text once"""
+        keys = [text_key(text, self.model) for text in texts]
+        annotations = self._lookup(set(keys))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in annotations:
+                missing.setdefault(key, text)
+        if missing:
+            docs = self.nlp.pipe(missing.values(), batch_size=self.batch_size, n_process=self.n_process)
+            new_annotations = {key: annotation_from_doc(doc) for key, doc in zip(missing, docs)}
+            self._store(new_annotations)
+            annotations.update(new_annotations)
+        return [CachedDoc.from_annotation(text, annotations[key]) for key, text in zip(keys, texts)]
+
+    def annotate_items(self, items: Iterable[BaselineData],
+                       batch_questions: int = 256) -> Iterator[Tuple[BaselineData, List[CachedDoc]]]:
+        """Yields every item with the annotations of all its documents, the documents are annotated in batches"""
+        items = iter(items)
+        while True:
+            batch = list(islice(items, batch_questions))
+            if not batch:
+                break
+            docs = self.annotate([document for item in batch for document in item.documents])
+            position = 0
+            for item in batch:
+                yield item, docs[position:position + len(item.documents)]
+                position += len(item.documents)
+
+    def _lookup(self, keys) -> Dict[str, Dict]:
+        keys = list(keys)
+        annotations = {}
+        for start in range(0, len(keys), 500):
+            current = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, value FROM annotations WHERE key IN ({','.join('?' * len(current))})", current)
+            annotations.update((key, json.loads(value)) for key, value in rows)
+        return annotations
+
+    def _store(self, annotations: Dict[str, Dict]):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO annotations VALUES (?, ?)",
+                                        ((key, json.dumps(value)) for key, value in annotations.items()))
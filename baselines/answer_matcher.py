@@ -0,0 +1,79 @@
+"""
+Multi-pattern matching of the gold answers of a question in its documents
+"""
+
+from collections import namedtuple
+from typing import List, Optional, Sequence, Tuple
+
+import ahocorasick
+
+
+# found: any answer occurs, first_rank: index of the first document with an answer or None,
+# spans: list of (start, end) offsets for every document
+AnswerMatches = namedtuple("AnswerMatches", ["found", "first_rank", "spans"])
+
+
+class AnswerMatcher(object):
+    """Aho-Corasick automaton over the gold answers of one question.
+
+    All answers are found with a single scan per document. Like str.count and re.finditer the occurrences of one
+    answer do not overlap, occurrences of different answers may.
+    """
+
+    def __init__(self, answers: Sequence[str]):
+        self.answers = list(answers)
+        self.has_empty = "" in self.answers
+        patterns = {}  # answer -> positions in self.answers, an answer can be listed twice
+        for i, answer in enumerate(self.answers):
+            if answer:
+                patterns.setdefault(answer, []).append(i)
+
+        self.automaton = None
+        if patterns:
+            self.automaton = ahocorasick.Automaton()
+            for answer, indices in patterns.items():
+                self.automaton.add_word(answer, (len(answer), indices))
+            self.automaton.make_automaton()
+
+    def contains(self, text: str) -> bool:
+        """Returns true if at least one answer occurs in the text, stops at the first occurrence"""
+        if self.has_empty:
+            return True
+        if self.automaton is None:
+            return False
+        for _ in self.automaton.iter(text):
+            return True
+        return False
+
+    def spans(self, text: str) -> List[Tuple[int, int]]:
+        """Returns the (start, end) offsets of all answers in the text, ordered by answer and then by position"""
+        answer_spans = [[] for _ in self.answers]
+        if self.automaton is not None:
+            # matches are reported by end position, so for one answer they are also sorted by start position
+            for last, (length, indices) in self.automaton.iter(text):
+                start = last - length + 1
+                previous = answer_spans[indices[0]]
+                if not previous or previous[-1][1] <= start:
+                    for i in indices:
+                        answer_spans[i].append((start, last + 1))
+        for i, answer in enumerate(self.answers):
+            if not answer:
+                answer_spans[i] = [(position, position) for position in range(len(text) + 1)]
+        return [span for current_spans in answer_spans for span in current_spans]
+
+    def count(self, text: str) -> int:
+        """Returns the number of answer occurrences, the sum of text.count(answer) over all answers"""
+        return len(self.spans(text))
+
+    def first_rank(self, documents: Sequence[str]) -> Optional[int]:
+        """Returns the index of the first document that contains an answer or None"""
+        for rank, document in enumerate(documents):
+            if self.contains(document):
+                return rank
+        return None
+
+    def match(self, documents: Sequence[str]) -> AnswerMatches:
+        """Scans every document once and returns whether an answer occurs, where first and all spans"""
+        spans = [self.spans(document) for document in documents]
+        first_rank = next((rank for rank, current_spans in enumerate(spans) if current_spans), None)
+        return AnswerMatches(first_rank is not None, first_rank, spans)
@@ -7,7 +7,7 @@ from collections import Counter
 import logging
 import random
 import os
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
 
 import numpy as np
 import spacy
@@ -18,12 +18,18 @@ from tqdm import tqdm
 
 from documentqa_clone.docqa.triviaqa.trivia_qa_eval import exact_match_score, f1_score, metric_max_over_ground_truths
 
-from data import load_xqa_wrapper
+from annotation_cache import ANNOTATION_COMPONENTS, AnnotationCache, CachedDoc
+from data import BaselineData, iter_items, iter_xqa, load_xqa_wrapper
+from evaluation import predict_parallel, question_seed
 
 
 def predict_noun(documents: List[str], nlp):
     """Returns the most frequent noun in a given document list"""
-    doc = nlp("".join(documents))
+    return most_frequent_noun(nlp("".join(documents)))
+
+
+def most_frequent_noun(doc):
+    """Returns the most frequent noun of an annotated spaCy document"""
     noun_list = [token.text for token in doc if (token.pos_ == "NOUN" or token.pos_ == "PROPN")]
     counts = Counter(noun_list)
     if counts:
@@ -58,7 +64,11 @@ def predict_noun_phrase(documents: List[str], nlp):
 
 def predict_ne(documents: List[str], nlp):
     """Returns the most frequent Named Entity in a given document list"""
-    doc = nlp("".join(documents))
+    return most_frequent_ne(nlp("".join(documents)))
+
+
+def most_frequent_ne(doc):
+    """Returns the most frequent Named Entity of an annotated spaCy document"""
     ne_list = [ent.text for ent in doc.ents]
     counts = {ent: ne_list.count(ent) for ent in ne_list}
     logging.debug(f"Counts {sorted(counts.items(), key=lambda x: x[1])}")
@@ -71,7 +81,11 @@ def predict_ne(documents: List[str], nlp):
 
 def random_ne(documents: List[str], nlp):
     """Returns a random Named Entity from a given document list"""
-    doc = nlp("".join(documents))
+    return random_ne_from_doc(nlp("".join(documents)))
+
+
+def random_ne_from_doc(doc):
+    """Returns a random Named Entity of an annotated spaCy document"""
     ne_list = [ent.text for ent in doc.ents]
     # TODO: convert to set so every NE occurs only once or leave more frequent NEs more frequent?
     if ne_list:
@@ -81,7 +95,11 @@ def random_ne(documents: List[str], nlp):
 
 def first_ne(documents: List[str], nlp):
     """Returns the first Named Entity from a list of documents"""
-    doc = nlp(documents[0])
+    return first_ne_from_doc(nlp(documents[0]))
+
+
+def first_ne_from_doc(doc):
+    """Returns the first Named Entity of an annotated spaCy document"""
     if len(doc.ents) > 0:
         return doc.ents[0].text
     return ""
@@ -91,6 +109,93 @@ def predict_ngram(documents: List[str], nlp):
     pass
 
 
+def ngram_from_doc(doc):
+    pass
+
+
+# model -> (prediction from the annotated context, needed pipeline components, only the first document is annotated)
+# tok2vec and attribute_ruler are only part of spaCy 3 pipelines, in spaCy 2 the tagger sets the POS tags itself
+PREDICTORS = {"ne": (most_frequent_ne, {"tok2vec", "ner"}, False),
+              "noun": (most_frequent_noun, {"tok2vec", "tagger", "morphologizer", "attribute_ruler"}, False),
+              "n-gram": (ngram_from_doc, set(), False),
+              "random-ne": (random_ne_from_doc, {"tok2vec", "ner"}, False),
+              "first-ne": (first_ne_from_doc, {"tok2vec", "ner"}, True)}
+
+SPACY_MODELS = {"de": "de_core_news_sm",
+                "en": "en_core_web_sm"}
+
+
+def load_nlp(language: str, components: Optional[Set[str]] = None):
+    """Loads the spaCy pipeline of a language, only with the given components if they are specified"""
+    if language not in SPACY_MODELS:
+        raise NotImplementedError("Only German (de) and English (en) implemented")
+    nlp = spacy.load(SPACY_MODELS[language])
+    if components is not None:
+        for name in list(nlp.pipe_names):
+            if name not in components:
+                nlp.remove_pipe(name)
+    return nlp
+
+
+def get_context(documents: List, n_best: Optional[int], first_document_only: bool = False) -> List:
+    """Returns the n best documents that are given to the baseline"""
+    if first_document_only:
+        return documents[:1]
+    return documents[:n_best]
+
+
+def predict_batch(items: Iterable[BaselineData], model: str, nlp, n_best: Optional[int] = None,
+                  batch_size: int = 64, n_process: int = 1) -> Iterator[Tuple[BaselineData, str]]:
+    """Annotates the contexts of many questions with nlp.pipe and yields (item, prediction) in the order of the items
+
+    Every document of a context is annotated on its own and the annotations are joined, like in predict_cached.
+
+    Args:
+        batch_size: number of documents spaCy processes as one batch
+        n_process: number of processes spaCy uses for the annotation
+    """
+    from_doc, _, first_document_only = PREDICTORS[model]
+
+    def texts():
+        for item in items:
+            # a question without documents is annotated as an empty text so it still gets a prediction
+            documents = get_context(item.documents, n_best, first_document_only) or [""]
+            for position, document in enumerate(documents):
+                yield document, (item, position == len(documents) - 1)
+
+    docs = []
+    for doc, (item, last) in nlp.pipe(texts(), as_tuples=True, batch_size=batch_size, n_process=n_process):
+        docs.append(CachedDoc.from_doc(doc))
+        if last:
+            random.seed(question_seed(item))
+            yield item, from_doc(CachedDoc.join(docs))
+            docs = []
+
+
+def predict_cached(items: Iterable[BaselineData], model: str, cache: AnnotationCache,
+                   n_best: Optional[int] = None) -> Iterator[Tuple[BaselineData, str]]:
+    """Like predict_batch but reads the annotations of the documents from the cache.
+
+    All documents of a question are annotated, so changing the model or n_best needs no new annotation.
+    """
+    from_doc, _, first_document_only = PREDICTORS[model]
+    for item, docs in cache.annotate_items(items):
+        random.seed(question_seed(item))
+        yield item, from_doc(CachedDoc.join(get_context(docs, n_best, first_document_only)))
+
+
+def make_predictor(model: str, language: str, n_best: Optional[int] = None, annotation_cache: Optional[str] = None,
+                   batch_size: int = 64, n_process: int = 1):
+    """Loads the spaCy pipeline and returns a function that yields (item, prediction) for a list of items"""
+    if model not in PREDICTORS:
+        raise NotImplementedError("Baseline models are 'ne', 'noun', 'n-gram'")
+    if annotation_cache:
+        cache = AnnotationCache(annotation_cache, load_nlp(language, ANNOTATION_COMPONENTS), batch_size, n_process)
+        return lambda items: predict_cached(items, model, cache, n_best)
+    nlp = load_nlp(language, PREDICTORS[model][1])
+    return lambda items: predict_batch(items, model, nlp, n_best, batch_size, n_process)
+
+
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.DEBUG)
     parser = argparse.ArgumentParser(description='Evaluate a baseline model')
@@ -105,33 +210,29 @@ if __name__ == "__main__":
                         help="Language of the used preprocessing system")
 
     parser.add_argument("-p", "--part", choices=["train", "dev", "test", "all"])
+    parser.add_argument("--stream", action="store_true", help="Stream the corpus instead of loading it at once")
+    parser.add_argument("--load_processes", type=int, default=1, help="Number of processes loading the corpus")
+    parser.add_argument("--batch_size", type=int, default=64, help="Number of contexts spaCy annotates as one batch")
+    parser.add_argument("--n_process", type=int, default=1, help="Number of processes used by spaCy")
+    parser.add_argument("--annotation_cache", help="Directory of the annotation cache, annotations are not cached "
+                                                   "if not given")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes the questions are sharded to")
 
     args = parser.parse_args()
     logging.info(str(args))
 
     # load data
-    data = load_xqa_wrapper(os.path.join(args.corpus, args.language), args.part)
-
-    # build model
-    if args.model == "ne":
-        predict = predict_ne
-    elif args.model == "noun":
-        predict = predict_noun
-    elif args.model == "n-gram":
-        predict = predict_ngram
-    elif args.model == "random-ne":
-        predict = random_ne
-    elif args.model == "first-ne":
-        predict = first_ne
+    if args.stream:
+        data = iter_xqa(os.path.join(args.corpus, args.language), args.part)
     else:
-        raise NotImplementedError("Baseline models are 'ne', 'noun', 'n-gram'")
+        data = load_xqa_wrapper(os.path.join(args.corpus, args.language), args.part, args.load_processes)
 
-    if args.language == "de":
-        nlp = spacy.load("de_core_news_sm")
-    elif args.language == "en":
-        nlp = spacy.load("en_core_web_sm")
+    # build model
+    predictor_args = (args.model, args.language, args.n_best, args.annotation_cache, args.batch_size)
+    if args.workers > 1:
+        predictions = predict_parallel(iter_items(data), make_predictor, predictor_args, args.workers)
     else:
-        raise NotImplementedError("Only German (de) and English (en) implemented")
+        predictions = make_predictor(*predictor_args, args.n_process)(iter_items(data))
 
     # run baseline
     is_writing = False
@@ -143,12 +244,7 @@ if __name__ == "__main__":
     incorrect = 0
     f1_collection = []
     em_collection = []
-    for question, item in tqdm(list(data.items())):
-        if (args.n_best is not None) and (args.n_best < len(item.documents)):
-            context = item.documents[:args.n_best]
-        else:
-            context = item.documents
-        prediction = predict(context, nlp)
+    for item, prediction in tqdm(predictions, total=None if args.stream else len(data)):
         logging.info(f"Question: {item.question} \t pred: {prediction}\t gold: {item.gold}")
         if is_writing:
             output_file.write(f"Question: {item.question} \t pred: {prediction}\t gold: {item.gold}\n")
@@ -160,12 +256,13 @@ if __name__ == "__main__":
             correct += 1
         else:
             incorrect += 1
-    print(f"Accuracy: {correct / len(data)}")
+    num_questions = correct + incorrect
+    print(f"Accuracy: {correct / num_questions}")
 
     print("F1:", np.mean(f1_collection))
     print("EM:", np.mean(em_collection))
     if is_writing:
-        output_file.write(f"Accuracy: {correct / len(data)}\n")
+        output_file.write(f"Accuracy: {correct / num_questions}\n")
         output_file.write(f"F1: {np.mean(f1_collection)}\n")
         output_file.write(f"EM: {np.mean(em_collection)}\n")
         output_file.close()
@@ -3,11 +3,19 @@ Representation of the XQA corpus and related functions
 """
 
 import argparse
+from array import array
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import json
 import logging
+import mmap
 import os
+import struct
 from os.path import join
-from typing import Dict, List
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from answer_matcher import AnswerMatcher
 
 
 class BaselineData(object):
@@ -18,9 +26,18 @@ class BaselineData(object):
         self.documents = documents
         self.document_ids = document_ids
         self.gold = gold
+        self._answer_matcher = None
 
     def add_gold_answer(self, answer):
         self.gold = answer
+        self._answer_matcher = None
+
+    @property
+    def answer_matcher(self) -> AnswerMatcher:
+        """Matcher for the gold answers, built on first use"""
+        if self._answer_matcher is None:
+            self._answer_matcher = AnswerMatcher(self.gold)
+        return self._answer_matcher
 
     def __str__(self):
         return f"id {self.id}: {self.question} - {self.gold}"
@@ -36,12 +53,8 @@ class BaselineData(object):
             current_documents = self.documents[:n]
         else:
             current_documents = self.documents
-        for answer in self.gold:
-            logging.debug(f"Current gold answer {answer}")
-            for document in current_documents:
-                if document.find(answer) >= 0:
-                    return True
-        return False
+        logging.debug(f"Current gold answers {self.gold}")
+        return self.answer_matcher.first_rank(current_documents) is not None
 
     def get_json(self):
         """Returns a json representation of the data"""
@@ -70,55 +83,365 @@ class BaselineData(object):
         return res
 
 
-def load_xqa_wrapper(path: str, part: str):
-    """Loads the correct files from a given path"""
+class XQACorpus(Mapping):
+    """Columnar in-memory representation of an XQA corpus.
+
+    All documents (and document ids) are packed into one contiguous UTF-8 buffer with an offset array, the questions,
+    gold answers and integer question ids are kept as one column each. The corpus behaves like the dictionary
+    {question: BaselineData} that load_xqa returned before, the BaselineData objects are only created on access.
+    """
+
+    # columns that are stored as raw bytes in the corpus cache, the rest is stored as json
+    BUFFER_COLUMNS = {"doc_buffer": "B", "doc_offsets": "q", "doc_id_buffer": "B", "doc_id_offsets": "q",
+                      "doc_starts": "q"}
+
+    def __init__(self):
+        # plain list as MLQA ids derived from hex strings do not fit into 64 bit
+        self.ids = []
+        self.questions = []
+        self.golds = []
+        # row i owns the documents doc_starts[i]:doc_starts[i + 1]
+        self.doc_starts = array("q", [0])
+        self.doc_buffer = bytearray()
+        self.doc_offsets = array("q", [0])
+        self.doc_id_buffer = bytearray()
+        self.doc_id_offsets = array("q", [0])
+        # question -> row, a repeated question points to its last row like the former dictionary did
+        self._index = {}
+
+    def _make_writable(self):
+        # the buffer columns of a corpus loaded from the cache are read-only views of the memory mapped file, they are
+        # copied on the first change
+        for name, typecode in self.BUFFER_COLUMNS.items():
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                setattr(self, name, bytearray(column) if typecode == "B" else array(typecode, column.tobytes()))
+
+    def add(self, iid: int, question: str, documents: List[str], document_ids: List, gold=()):
+        """Appends a question with its documents as a new row and returns the row number
+
+        The document ids keep their type, they are stored as json.
+        """
+        self._make_writable()
+        row = len(self.questions)
+        self.ids.append(iid)
+        self.questions.append(question)
+        self.golds.append(list(gold))
+        for document, document_id in zip(documents, document_ids):
+            self.doc_buffer += document.encode("utf-8")
+            self.doc_offsets.append(len(self.doc_buffer))
+            self.doc_id_buffer += json.dumps(document_id, ensure_ascii=False).encode("utf-8")
+            self.doc_id_offsets.append(len(self.doc_id_buffer))
+        self.doc_starts.append(len(self.doc_offsets) - 1)
+        self._index[question] = row
+        return row
+
+    def add_gold_answer(self, question: str, answers: List[str]):
+        self.golds[self._index[question]] = answers
+
+    def extend(self, other: "XQACorpus"):
+        """Appends all rows of another corpus"""
+        for row in other.rows():
+            self.add(other.ids[row], other.questions[row], other.get_documents(row), other.get_document_ids(row),
+                     other.golds[row])
+
+    @property
+    def num_rows(self):
+        return len(self.questions)
+
+    def rows(self) -> Iterator[int]:
+        """Iterates over the row numbers in the order of the questions"""
+        return iter(self._index.values())
+
+    def num_documents(self, row: int):
+        return self.doc_starts[row + 1] - self.doc_starts[row]
+
+    def get_documents(self, row: int, n: Optional[int] = None) -> List[str]:
+        """Decodes the documents of a row, only the n best if n is given"""
+        return self._decode(self.doc_buffer, self.doc_offsets, self._doc_range(row, n))
+
+    def get_document_ids(self, row: int, n: Optional[int] = None) -> List:
+        return [json.loads(document_id)
+                for document_id in self._decode(self.doc_id_buffer, self.doc_id_offsets, self._doc_range(row, n))]
+
+    def get_item(self, row: int) -> BaselineData:
+        return BaselineData(self.ids[row], self.questions[row], self.get_documents(row), self.get_document_ids(row),
+                            self.golds[row])
+
+    def _doc_range(self, row: int, n: Optional[int]) -> range:
+        start, end = self.doc_starts[row], self.doc_starts[row + 1]
+        if n is not None:
+            end = min(end, start + n)
+        return range(start, end)
+
+    @staticmethod
+    def _decode(buffer, offsets, doc_range: range) -> List[str]:
+        return [str(buffer[offsets[i]:offsets[i + 1]], "utf-8") for i in doc_range]
+
+    def __getitem__(self, question: str) -> BaselineData:
+        return self.get_item(self._index[question])
+
+    def __contains__(self, question):
+        return question in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def get_parts(path: str, part: str) -> List[str]:
+    """Returns the corpus parts that are loaded for a part argument, "all" are dev, test and train if it exists"""
     if part == "all":
         parts = ["dev", "test"]
-        data = {}
         if os.path.exists(join(path, "train_doc.json")):
             parts.append("train")
-        for part in parts:
-            question_data = join(path, f"{part}_doc.json")
-            gold_data = join(path, f"{parts}.txt")
-            data = {**data, **load_xqa(question_data, gold_data)}
-    else:
+        return parts
+    return [part]
+
+
+def load_xqa_wrapper(path: str, part: str, processes: int = 1, cache: bool = True):
+    """Loads the correct files from a given path
+
+    Args:
+        processes: number of processes parsing the files, all parts are parsed concurrently if larger than 1
+        cache: reuse the parsed corpus from a cache file next to the source files and create it if it is missing or
+            outdated
+    """
+    files = [(join(path, f"{part}_doc.json"), join(path, f"{part}.txt")) for part in get_parts(path, part)]
+    cache_file = join(path, f"{part}.xqa_cache")
+    fingerprints = [file_fingerprint(filename) for pair in files for filename in pair] if cache else None
+
+    data = load_corpus_cache(cache_file, fingerprints) if cache else None
+    if data is None:
+        if processes > 1:
+            data = load_xqa_parallel(files, processes)
+        else:
+            data = XQACorpus()
+            for question_data, gold_data in files:
+                load_xqa(question_data, gold_data, data)
+        if cache:
+            try:
+                save_corpus_cache(data, cache_file, fingerprints)
+            except OSError as e:
+                logging.warning(f"Corpus cache {cache_file} could not be written: {e}")
+    logging.info(f"Data loaded of size {len(data)}")
+    return data
+
+
+CACHE_MAGIC = b"XQACACHE"
+CACHE_VERSION = 2
+
+
+def file_fingerprint(filename, block_size: int = 1 << 20) -> Dict:
+    """Returns path, size, modification time in ns and a hash of the first, middle and last block of a file
+
+    A cache is only valid if all of them are unchanged. The modification time notices edits that keep the size and
+    touch no hashed block, hashing only three blocks keeps the fingerprint cheap for corpora of several GB while still
+    noticing files that were rewritten with the same size and modification time.
+    """
+    stat = os.stat(filename)
+    sha = hashlib.sha1()
+    positions = sorted({0, max(stat.st_size // 2 - block_size // 2, 0), max(stat.st_size - block_size, 0)})
+    with open(filename, "rb") as f:
+        for position in positions:
+            f.seek(position)
+            sha.update(f.read(block_size))
+    return {"path": os.path.abspath(filename), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+            "hash": sha.hexdigest()}
+
+
+def save_corpus_cache(data: XQACorpus, cache_file: str, fingerprints: List[Dict]):
+    """Writes a corpus as binary cache file: a json header followed by the 8 byte aligned buffer columns
+
+    The file is written to a temporary name first and moved afterwards, so a crash never leaves a broken cache.
+    """
+    header = {"version": CACHE_VERSION,
+              "fingerprints": fingerprints,
+              "ids": data.ids,
+              "questions": data.questions,
+              "golds": data.golds,
+              "index_rows": list(data.rows()),
+              "columns": {}}
+    position = 0
+    for name in XQACorpus.BUFFER_COLUMNS:
+        length = len(memoryview(getattr(data, name)).cast("B"))
+        header["columns"][name] = (position, length)
+        position += length + (-length) % 8
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    header_bytes += b" " * ((-len(header_bytes)) % 8)
+
+    tmp_file = f"{cache_file}.tmp{os.getpid()}"
+    try:
+        with open(tmp_file, "wb") as fout:
+            fout.write(CACHE_MAGIC)
+            fout.write(struct.pack("<q", len(header_bytes)))
+            fout.write(header_bytes)
+            for name in XQACorpus.BUFFER_COLUMNS:
+                column = memoryview(getattr(data, name)).cast("B")
+                fout.write(column)
+                fout.write(b"\0" * ((-len(column)) % 8))
+        os.replace(tmp_file, cache_file)
+    finally:
+        # a failed write, e.g. a full disk, leaves no temporary file behind
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def load_corpus_cache(cache_file: str, fingerprints: List[Dict]) -> Optional[XQACorpus]:
+    """Returns the cached corpus with memory mapped buffer columns or None if there is no valid cache"""
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file, "rb") as f:
+        if os.path.getsize(cache_file) < 16 or f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            logging.warning(f"Ignoring invalid corpus cache {cache_file}")
+            return None
+        header_length = struct.unpack("<q", f.read(8))[0]
+        header = json.loads(f.read(header_length))
+        if header["version"] != CACHE_VERSION or header["fingerprints"] != fingerprints:
+            logging.info(f"Corpus cache {cache_file} is outdated")
+            return None
+        buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    data = XQACorpus()
+    data.ids = header["ids"]
+    data.questions = header["questions"]
+    data.golds = header["golds"]
+    data._index = {data.questions[row]: row for row in header["index_rows"]}
+    start = len(CACHE_MAGIC) + 8 + header_length
+    for name, (position, length) in header["columns"].items():
+        column = buffer[start + position:start + position + length]
+        setattr(data, name, column.cast(XQACorpus.BUFFER_COLUMNS[name]))
+    logging.info(f"Corpus loaded from cache {cache_file}")
+    return data
+
+
+def iter_xqa(path: str, part: str) -> Iterator[BaselineData]:
+    """Streams the questions of the correct files from a given path as BaselineData.
+
+    Only the current question is kept in memory. Different to load_xqa_wrapper repeated questions are not merged.
+    """
+    for part in get_parts(path, part):
         question_data = join(path, f"{part}_doc.json")
         gold_data = join(path, f"{part}.txt")
-        data = load_xqa(question_data, gold_data)
-    logging.info(f"Data loaded of size {len(data)}")
+        yield from iter_xqa_files(question_data, gold_data)
+
+
+def iter_xqa_files(question_file, gold_file) -> Iterator[BaselineData]:
+    """Reads the question file and the gold file in lockstep, both have to list the questions in the same order"""
+    with open(question_file) as f_question:
+        with open(gold_file) as f_gold:
+            gold_lines = (line for line in f_gold if line.strip())
+            for q_id, question, all_docs, doc_ids in group_questions(f_question):
+                json_gold = json.loads(next(gold_lines, "null"))
+                if json_gold is None or json_gold["question"] != question:
+                    raise ValueError(f"{gold_file} is not aligned with {question_file} at question {q_id}, "
+                                     f"load the corpus without streaming")
+                yield BaselineData(q_id, question, all_docs, doc_ids, json_gold["answers"])
+
+
+def iter_items(data) -> Iterable[BaselineData]:
+    """Returns the BaselineData of a loaded corpus or of a stream from iter_xqa"""
+    if isinstance(data, Mapping):
+        return data.values()
     return data
 
 
-def load_xqa(question_file, gold_file):
-    """Reads development data and returns it as dictionary {question: BaselineData}"""
-    data = {}
+def group_questions(lines) -> Iterator[Tuple[int, str, List[str], List[str]]]:
+    """Groups the items of XQA *_doc.json lines by question id and yields (id, question, documents, document_ids)"""
     question = None
     all_docs = []
     doc_ids = []
     q_id = 0
+    for line in lines:
+        json_data = json.loads(line)
+        for item in json_data:
+            iid = item["id"]
+            if iid[0] != q_id:
+                if question is not None:
+                    yield q_id, question, all_docs, doc_ids
+                all_docs = []
+                doc_ids = []
+                q_id = iid[0]
+            question = item["question"]
+            all_docs.append(item["document"])
+            doc_ids.append(item["document_id"])
+    if question is not None:
+        yield q_id, question, all_docs, doc_ids
+
+
+def load_xqa(question_file, gold_file, corpus: Optional[XQACorpus] = None):
+    """Reads development data and returns it as XQACorpus, a mapping {question: BaselineData}
+
+    Args:
+        corpus: an existing corpus the data is appended to, a new one is created if None
+    """
+    data = XQACorpus() if corpus is None else corpus
     with open(question_file) as f:
-        for line in f:
-            json_data = json.loads(line)
-            for item in json_data:
-                iid = item["id"]
-                if iid[0] != q_id:
-                    if question is not None:
-                        data[question] = (BaselineData(q_id, question, all_docs, doc_ids))
-                    all_docs = []
-                    doc_ids = []
-                    q_id = iid[0]
-                question = item["question"]
-                document = item["document"]
-                all_docs.append(document)
-                doc_ids.append(item["document_id"])
-        data[question] = (BaselineData(q_id, question, all_docs, doc_ids))
+        for q_id, question, all_docs, doc_ids in group_questions(f):
+            data.add(q_id, question, all_docs, doc_ids)
+    load_gold(data, gold_file)
+    return data
 
+
+def load_gold(data: XQACorpus, gold_file):
+    """Adds the answers of an XQA gold file to the questions of a corpus"""
     with open(gold_file) as f:
         for line in f:
             json_gold = json.loads(line)
-            answers = json_gold["answers"]
-            question = json_gold["question"]
-            data[question].add_gold_answer(answers)
+            data.add_gold_answer(json_gold["question"], json_gold["answers"])
+
+
+def find_chunks(filename, num_chunks: int) -> List[Tuple[int, int]]:
+    """Splits a file into at most num_chunks byte ranges (start, end) that begin and end at line boundaries"""
+    size = os.path.getsize(filename)
+    boundaries = [0]
+    with open(filename, "rb") as f:
+        for i in range(1, num_chunks):
+            f.seek(max(size * i // num_chunks, boundaries[-1]))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def read_chunk(question_file, start: int, end: int):
+    """Parses the lines in the byte range [start, end) of a *_doc.json file and returns the grouped questions"""
+    with open(question_file, "rb") as f:
+        f.seek(start)
+        lines = [line for line in f.read(end - start).split(b"\n") if line.strip()]
+    return list(group_questions(lines))
+
+
+def load_xqa_parallel(files: List[Tuple[str, str]], processes: Optional[int] = None, chunks_per_process: int = 4):
+    """Reads several (question_file, gold_file) pairs into one XQACorpus, parsing chunks of all files in a process pool
+
+    The chunks are merged in order, a question whose items are split between two chunks is joined again so the result
+    is the same as calling load_xqa on each pair.
+    """
+    processes = processes or os.cpu_count()
+    data = XQACorpus()
+    with ProcessPoolExecutor(processes) as executor:
+        # submit the chunks of all files first so the parts are parsed concurrently
+        file_futures = []
+        for question_file, _ in files:
+            chunks = find_chunks(question_file, processes * chunks_per_process)
+            file_futures.append([executor.submit(read_chunk, question_file, start, end) for start, end in chunks])
+
+        for (_, gold_file), futures in zip(files, file_futures):
+            pending = None
+            for future in futures:
+                for group in future.result():
+                    if pending is not None and pending[0] == group[0]:
+                        pending = (group[0], group[1], pending[2] + group[2], pending[3] + group[3])
+                        continue
+                    if pending is not None:
+                        data.add(*pending)
+                    pending = group
+            if pending is not None:
+                data.add(*pending)
+            load_gold(data, gold_file)
     return data
 
 
@@ -160,21 +483,28 @@ def check_answers_corpus():
     parser.add_argument("corpus", help="Path to the eval data")
     parser.add_argument("-n", "--n_best", help="answerable with n best documents", type=int)
     parser.add_argument("-p", "--part", choices=["train", "dev", "test", "all"])
+    parser.add_argument("--stream", action="store_true", help="Stream the corpus instead of loading it at once")
+    parser.add_argument("--load_processes", type=int, default=1, help="Number of processes loading the corpus")
 
     args = parser.parse_args()
 
     # load data
-    data = load_xqa_wrapper(args.corpus, args.part)
+    if args.stream:
+        data = iter_xqa(args.corpus, args.part)
+    else:
+        data = load_xqa_wrapper(args.corpus, args.part, args.load_processes)
 
     # check number of found answers
     not_found = 0
-    for question, item in list(data.items()):
-        print(question)
+    total = 0
+    for item in iter_items(data):
+        print(item.question)
+        total += 1
         if not item.check_gold_answer(args.n_best):
             print(item.gold, item.question)
             not_found += 1
 
-    print(f"{not_found} of {len(data)} questions without answer: {not_found / len(data)} %")
+    print(f"{not_found} of {total} questions without answer: {not_found / total} %")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,62 @@
+"""
+Sharded evaluation of the baselines in several worker processes
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import zlib
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from data import BaselineData
+
+
+# prediction function of the current worker process, see init_worker
+_WORKER_PREDICT = None
+
+
+def question_seed(item: BaselineData, seed: int = 0) -> int:
+    """Returns a seed that only depends on the question, so random baselines do not depend on the number of workers"""
+    return zlib.crc32(f"{seed}\t{item.id}\t{item.question}".encode("utf-8"))
+
+
+def init_worker(make_predictor: Callable, predictor_args: Tuple):
+    """Builds the prediction function once per worker, e.g. loads the spaCy model"""
+    global _WORKER_PREDICT
+    _WORKER_PREDICT = make_predictor(*predictor_args)
+
+
+def predict_shard(items: List[BaselineData]) -> List[str]:
+    return [prediction for _, prediction in _WORKER_PREDICT(items)]
+
+
+def iter_shards(items: Iterable[BaselineData], shard_size: int) -> Iterator[List[BaselineData]]:
+    shard = []
+    for item in items:
+        shard.append(item)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def predict_parallel(items: Iterable[BaselineData], make_predictor: Callable, predictor_args: Tuple, workers: int,
+                     shard_size: int = 64) -> Iterator[Tuple[BaselineData, str]]:
+    """Predicts shards of the items in worker processes and yields (item, prediction) in the order of the items.
+
+    Args:
+        make_predictor: top level function that is called with predictor_args in every worker and returns a function
+            mapping a list of items to (item, prediction) pairs
+        shard_size: number of questions sent to a worker at once
+    """
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(make_predictor, predictor_args)) as executor:
+        # only a few shards per worker are in flight, so streamed corpora stay streamed
+        pending = deque()
+        for shard in iter_shards(items, shard_size):
+            pending.append((shard, executor.submit(predict_shard, shard)))
+            if len(pending) > 2 * workers:
+                shard, future = pending.popleft()
+                yield from zip(shard, future.result())
+        while pending:
+            shard, future = pending.popleft()
+            yield from zip(shard, future.result())
@@ -2,31 +2,28 @@ import argparse
 import logging
 import random
 import os
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Tuple
 
-from nltk.tokenize import sent_tokenize, word_tokenize
 import numpy as np
-import spacy
 from tqdm import tqdm
 
 from documentqa_clone.docqa.triviaqa.trivia_qa_eval import exact_match_score, f1_score, metric_max_over_ground_truths
 
-from data import load_xqa_wrapper
+from annotation_cache import ANNOTATION_COMPONENTS, AnnotationCache
+from baselines import load_nlp
+from data import BaselineData, iter_items, iter_xqa, load_xqa_wrapper
+from evaluation import predict_parallel, question_seed
+from sentence_overlap import SentenceOverlap
+
+
+# segmented documents are shared between the questions, the retrieved documents repeat often
+SENTENCE_OVERLAP = SentenceOverlap()
 
 
 def ne_with_wordoverlap(documents: List[str], nlp, question: str):
     """Take sentence with highest word overlap with the question, returns NE from that that is not in question"""
-    sentences = []
-    question_set = set(word_tokenize(question))
-    for document in documents:
-        sentences.extend(sent_tokenize(document))
-
     # get sentence with best overlap
-    best_overlap = (0, "")
-    for sentence in sentences:
-        current_overlap = len(set(word_tokenize(sentence)).intersection(question_set))
-        if current_overlap > best_overlap[0]:
-            best_overlap = (current_overlap, sentence)
+    best_overlap = SENTENCE_OVERLAP.best_sentence(documents, question)
 
     # get NE from that sentence
     doc = nlp(best_overlap[1])
@@ -39,17 +36,8 @@ def ne_with_wordoverlap(documents: List[str], nlp, question: str):
 
 def noun_with_wordoverlap(documents: List[str], nlp, question: str):
     """Take sentence with highest word overlap with the question, returns NE from that that is not in question"""
-    sentences = []
-    question_set = set(word_tokenize(question))
-    for document in documents:
-        sentences.extend(sent_tokenize(document))
-
     # get sentence with best overlap
-    best_overlap = (0, "")
-    for sentence in sentences:
-        current_overlap = len(set(word_tokenize(sentence)).intersection(question_set))
-        if current_overlap > best_overlap[0]:
-            best_overlap = (current_overlap, sentence)
+    best_overlap = SENTENCE_OVERLAP.best_sentence(documents, question)
 
     # get NE from that sentence
     doc = nlp(best_overlap[1])
@@ -62,6 +50,28 @@ def noun_with_wordoverlap(documents: List[str], nlp, question: str):
     return ""
 
 
+def make_predictor(model: str, language: str, n_best: Optional[int] = None, annotation_cache: Optional[str] = None):
+    """Loads the spaCy pipeline and returns a function that yields (item, prediction) for a list of items"""
+    if model == "ne":
+        predict = ne_with_wordoverlap
+    elif model == "noun":
+        predict = noun_with_wordoverlap
+    else:
+        raise NotImplementedError("Baseline models are 'ne', 'noun'")
+
+    if annotation_cache:
+        # the cache can be called like the spaCy pipeline and returns the cached annotation
+        nlp = AnnotationCache(annotation_cache, load_nlp(language, ANNOTATION_COMPONENTS))
+    else:
+        nlp = load_nlp(language)
+
+    def predict_items(items: Iterable[BaselineData]) -> Iterator[Tuple[BaselineData, str]]:
+        for item in items:
+            random.seed(question_seed(item))
+            yield item, predict(item.documents[:n_best], nlp, item.question)
+    return predict_items
+
+
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.DEBUG)
     parser = argparse.ArgumentParser(description='Evaluate a baseline model')
@@ -74,28 +84,27 @@ if __name__ == "__main__":
                         help="Language of the used preprocessing system")
 
     parser.add_argument("-p", "--part", choices=["train", "dev", "test", "all"])
+    parser.add_argument("--stream", action="store_true", help="Stream the corpus instead of loading it at once")
+    parser.add_argument("--load_processes", type=int, default=1, help="Number of processes loading the corpus")
+    parser.add_argument("--annotation_cache", help="Directory of the annotation cache, annotations are not cached "
+                                                   "if not given")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes the questions are sharded to")
 
     args = parser.parse_args()
     logging.info(str(args))
 
     # load data
-    data = load_xqa_wrapper(os.path.join(args.corpus, args.language), args.part)
-
-    # build model
-    if args.model == "ne":
-        predict = ne_with_wordoverlap
-    elif args.model == "noun":
-        predict = noun_with_wordoverlap
+    if args.stream:
+        data = iter_xqa(os.path.join(args.corpus, args.language), args.part)
     else:
-        raise NotImplementedError("Baseline models are 'ne', 'noun'")
-
+        data = load_xqa_wrapper(os.path.join(args.corpus, args.language), args.part, args.load_processes)
 
-    if args.language == "de":
-        nlp = spacy.load("de_core_news_sm")
-    elif args.language == "en":
-        nlp = spacy.load("en_core_web_sm")
+    # build model
+    predictor_args = (args.model, args.language, args.n_best, args.annotation_cache)
+    if args.workers > 1:
+        predictions = predict_parallel(iter_items(data), make_predictor, predictor_args, args.workers)
     else:
-        raise NotImplementedError("Only German (de) and English (en) implemented")
+        predictions = make_predictor(*predictor_args)(iter_items(data))
 
     # run baseline
     is_writing = False
@@ -107,12 +116,7 @@ if __name__ == "__main__":
     incorrect = 0
     f1_collection = []
     em_collection = []
-    for question, item in tqdm(list(data.items())):
-        if (args.n_best is not None) and (args.n_best < len(item.documents)):
-            context = item.documents[:args.n_best]
-        else:
-            context = item.documents
-        prediction = predict(context, nlp, item.question)
+    for item, prediction in tqdm(predictions, total=None if args.stream else len(data)):
         logging.info(f"Question: {item.question} \t pred: {prediction}\t gold: {item.gold}")
         if is_writing:
             output_file.write(f"Question: {item.question} \t pred: {prediction}\t gold: {item.gold}\n")
@@ -124,12 +128,13 @@ if __name__ == "__main__":
             correct += 1
         else:
             incorrect += 1
-    print(f"Accuracy: {correct / len(data)}")
+    num_questions = correct + incorrect
+    print(f"Accuracy: {correct / num_questions}")
 
     print("F1:", np.mean(f1_collection))
     print("EM:", np.mean(em_collection))
     if is_writing:
-        output_file.write(f"Accuracy: {correct / len(data)}\n")
+        output_file.write(f"Accuracy: {correct / num_questions}\n")
         output_file.write(f"F1: {np.mean(f1_collection)}\n")
         output_file.write(f"EM: {np.mean(em_collection)}\n")
         output_file.close()
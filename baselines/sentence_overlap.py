@@ -0,0 +1,66 @@
+"""
+Word overlap between the sentences of documents and a question
+"""
+
+from collections import OrderedDict
+from typing import List, Tuple
+
+from nltk.tokenize import sent_tokenize, word_tokenize
+import numpy as np
+
+
+class SentenceOverlap(object):
+    """Finds the sentence of a document list that shares the most distinct tokens with a question.
+
+    Every document is segmented and tokenized only once: its sentences are kept together with the distinct token ids
+    of each sentence, so scoring all sentences against a question is a single numpy operation per document. The
+    segmented documents are kept in a cache of bounded size.
+    """
+
+    def __init__(self, language: str = "english", max_cached_documents: int = 10000):
+        self.language = language
+        self.max_cached_documents = max_cached_documents
+        self.vocabulary = {}
+        self._documents = OrderedDict()
+
+    def token_ids(self, tokens) -> List[int]:
+        return [self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokens]
+
+    def segment(self, document: str) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """Returns the sentences of a document, the distinct token ids of all sentences and their sentence index"""
+        if document in self._documents:
+            self._documents.move_to_end(document)
+            return self._documents[document]
+
+        sentences = sent_tokenize(document, self.language)
+        token_ids = []
+        sentence_index = []
+        for i, sentence in enumerate(sentences):
+            current_ids = set(self.token_ids(word_tokenize(sentence, self.language)))
+            token_ids.extend(current_ids)
+            sentence_index.extend(i for _ in current_ids)
+        segmented = (sentences, np.array(token_ids, dtype=np.int32), np.array(sentence_index, dtype=np.int32))
+
+        self._documents[document] = segmented
+        if len(self._documents) > self.max_cached_documents:
+            self._documents.popitem(last=False)
+        return segmented
+
+    def best_sentence(self, documents: List[str], question: str) -> Tuple[int, str]:
+        """Returns (overlap, sentence) for the first sentence with the highest overlap, (0, "") without any overlap"""
+        # segment first, so the vocabulary contains all tokens of the documents
+        segmented = [self.segment(document) for document in documents]
+        question_ids = [self.vocabulary[token] for token in set(word_tokenize(question, self.language))
+                        if token in self.vocabulary]
+        best_overlap = (0, "")
+        if not question_ids:
+            return best_overlap
+        question_ids = np.array(question_ids, dtype=np.int32)
+        for sentences, token_ids, sentence_index in segmented:
+            if not sentences:
+                continue
+            overlaps = np.bincount(sentence_index[np.isin(token_ids, question_ids)], minlength=len(sentences))
+            best = int(np.argmax(overlaps))
+            if overlaps[best] > best_overlap[0]:
+                best_overlap = (int(overlaps[best]), sentences[best])
+        return best_overlap
@@ -0,0 +1,112 @@
+"""
+Tests of the annotation cache of the baselines with a stand-in for the spaCy pipeline, run with
+python -m unittest test_annotation_cache in baselines
+"""
+
+import random
+import re
+import tempfile
+import unittest
+
+from annotation_cache import AnnotationCache
+from baselines import PREDICTORS, predict_batch, predict_cached
+from data import BaselineData
+
+
+class StubSpan(object):
+
+    def __init__(self, text: str, start: int, label: str):
+        self.text = text
+        self.start_char = start
+        self.end_char = start + len(text)
+        self.label_ = label
+
+
+class StubToken(object):
+
+    def __init__(self, text: str, idx: int, pos: str):
+        self.text = text
+        self.idx = idx
+        self.pos_ = pos
+
+
+class StubDoc(object):
+    """Capitalized words are proper nouns and entities, words ending in "ung" are nouns"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens = []
+        for match in re.finditer(r"\w+", text):
+            word = match.group()
+            pos = "PROPN" if word[0].isupper() else "NOUN" if word.endswith("ung") else "X"
+            self.tokens.append(StubToken(word, match.start(), pos))
+        self.ents = [StubSpan(token.text, token.idx, "LOC") for token in self.tokens if token.pos_ == "PROPN"]
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+
+class StubPipeline(object):
+    """Stand-in for a spaCy pipeline that counts the annotated texts"""
+
+    meta = {"lang": "de", "name": "stub", "version": "1.0"}
+
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, text: str) -> StubDoc:
+        self.texts.append(text)
+        return StubDoc(text)
+
+    def pipe(self, texts, as_tuples=False, **kwargs):
+        for text in texts:
+            if as_tuples:
+                yield self(text[0]), text[1]
+            else:
+                yield self(text)
+
+
+def make_items(n: int = 200):
+    rng = random.Random(0)
+    words = ["Haus", "Berlin", "Zeitung", "und", "Bau", "Ordnung", "Mainz", "der"]
+    # the documents are shared between questions like the BM25 documents of the corpus
+    documents = [" ".join(rng.choice(words) for _ in range(rng.randint(1, 8))) for _ in range(40)]
+    return [BaselineData(i, f"question {i}", rng.sample(documents, rng.randint(0, 5)), [], ["Haus"])
+            for i in range(n)]
+
+
+class AnnotationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.items = make_items()
+        self.directory = tempfile.TemporaryDirectory()
+        self.nlp = StubPipeline()
+        self.cache = AnnotationCache(self.directory.name, self.nlp)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_same_predictions_as_predict_batch(self):
+        for model in PREDICTORS:
+            for n_best in (None, 1, 2, 3):
+                expected = list(predict_batch(self.items, model, StubPipeline(), n_best))
+                self.assertEqual(list(predict_cached(self.items, model, self.cache, n_best)), expected)
+
+    def test_documents_annotated_once(self):
+        list(predict_cached(self.items, "ne", self.cache, 1))
+        distinct = {document for item in self.items for document in item.documents}
+        self.assertEqual(sorted(self.nlp.texts), sorted(distinct))
+
+    def test_warm_cache_needs_no_annotation(self):
+        list(predict_cached(self.items, "ne", self.cache, 1))
+        annotated = len(self.nlp.texts)
+        # a new cache on the same directory, e.g. of a later run
+        cache = AnnotationCache(self.directory.name, self.nlp)
+        for model in PREDICTORS:
+            for n_best in (None, 1, 2, 5):
+                list(predict_cached(self.items, model, cache, n_best))
+        self.assertEqual(len(self.nlp.texts), annotated)
+
+
+if __name__ == "__main__":
+    unittest.main()
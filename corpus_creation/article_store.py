@@ -0,0 +1,243 @@
+"""
+Offline store of the articles of a Wikipedia dump with case-insensitive and redirect-aware title lookup
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import html
+from itertools import islice
+import json
+import os
+from os.path import join
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+from tqdm import tqdm
+from wiki_dump_reader import Cleaner
+
+from dump_bm25 import save_json_atomic
+from wiki_dump import ARTICLE_NAMESPACES, Page, iter_dump_pages, normalize_title
+from wiki_page import WikiPage, extract_page_text
+
+
+# stores of older versions are rebuilt
+STORE_VERSION = 3
+
+# categories are returned with the namespace of the German Wikipedia like the Wikipedia API does
+CATEGORY_NAMESPACE = "Kategorie"
+
+# redirects of the German Wikipedia use both keywords
+REDIRECT_PATTERN = re.compile(r"#\s*(?:REDIRECT|WEITERLEITUNG)\s*:?\s*\[\[([^\]|]+)", re.IGNORECASE)
+CATEGORY_PATTERN = re.compile(r"\[\[\s*(?:Kategorie|Category)\s*:\s*([^\]|]+)(?:\|[^\]]*)?\]\]", re.IGNORECASE)
+
+# longest chain of redirects that is followed
+MAX_REDIRECTS = 5
+
+HEADING_PATTERN = re.compile(r"^(={2,6})\s*(.*?)\s*\1\s*$", re.MULTILINE)
+# images and galleries are not part of the extracts of the Wikipedia API
+FILE_NAMESPACES = ("Datei", "Bild", "File", "Image")
+FILE_LINK_PATTERN = re.compile(r"\[\[(?:" + "|".join(FILE_NAMESPACES) + r"):")
+BRACKET_PATTERN = re.compile(r"[\[\]]")
+GALLERY_PATTERN = re.compile(r"<gallery.*?</gallery>", re.IGNORECASE | re.DOTALL)
+
+
+def link_end(wikitext: str, start: int) -> Optional[int]:
+    """Returns the end of the link starting at start, the brackets of nested links are counted, None if unclosed"""
+    depth = 0
+    for bracket in BRACKET_PATTERN.finditer(wikitext, start):
+        depth += 1 if bracket.group() == "[" else -1
+        if depth == 0:
+            return bracket.end()
+    return None
+
+
+def remove_file_links(wikitext: str) -> str:
+    """Removes the links of images and other files with their captions, which can contain links, unclosed links stay"""
+    parts = []
+    begin = 0
+    match = FILE_LINK_PATTERN.search(wikitext)
+    while match is not None:
+        end = link_end(wikitext, match.start())
+        if end is None:
+            match = FILE_LINK_PATTERN.search(wikitext, match.end())
+            continue
+        parts.append(wikitext[begin:match.start()])
+        begin = end
+        match = FILE_LINK_PATTERN.search(wikitext, end)
+    parts.append(wikitext[begin:])
+    return "".join(parts)
+
+
+def remove_tables(wikitext: str) -> str:
+    """Removes the tables {| ... |} of wikitext, also nested and indented tables"""
+    lines = []
+    depth = 0
+    for line in wikitext.split("\n"):
+        stripped = line.lstrip(": ")
+        if stripped.startswith("{|"):
+            depth += 1
+        elif depth > 0 and stripped.startswith("|}"):
+            depth -= 1
+        elif depth == 0:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+def extract_text(wikitext: str) -> str:
+    """Converts wikitext to plain text in the format of the extracts of the Wikipedia API.
+
+    Paragraphs and list items are lines and headings are "== title ==" lines after two empty lines. Templates, tables,
+    images, galleries and references are removed.
+    """
+    cleaner = Cleaner()
+    wikitext = remove_tables(GALLERY_PATTERN.sub("", remove_file_links(wikitext)))
+    text, _ = cleaner.build_links(cleaner.clean_text(wikitext))
+    text = html.unescape(text)
+    return HEADING_PATTERN.sub(lambda match: f"\n\n{match.group(1)} {match.group(2)} {match.group(1)}", text).strip()
+
+
+def parse_article(page: Page):
+    """Returns (page id, title, text, categories, redirect target) of a dump page.
+
+    The wikitext is converted to the text of the page the Wikipedia API would return, text and categories are None for
+    a redirect.
+    """
+    page_id, _, title, text = page
+    redirect = REDIRECT_PATTERN.match(text.lstrip())
+    if redirect is not None:
+        return page_id, title, None, None, normalize_title(redirect.group(1))
+    categories = [f"{CATEGORY_NAMESPACE}:{normalize_title(category)}" for category in CATEGORY_PATTERN.findall(text)]
+    text = extract_page_text(extract_text(CATEGORY_PATTERN.sub("", text)))
+    return page_id, title, text, categories, None
+
+
+class ArticleStore(object):
+    """Articles of a dump built by build_article_store.
+
+    Titles are looked up exactly first, then ignoring the case, redirects are followed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(join(directory, "titles.json")) as fin:
+            saved = json.load(fin)
+        self.titles = saved["titles"]
+        self.redirects = saved["redirects"]
+        self.offsets = np.asarray(np.load(join(directory, "doc_offsets.npy")))
+        self._positions = {title: position for position, title in enumerate(self.titles)}
+        self._folded_positions = {}
+        for position, title in enumerate(self.titles):
+            self._folded_positions.setdefault(title.casefold(), position)
+        self._folded_redirects = {}
+        for title, target in self.redirects.items():
+            self._folded_redirects.setdefault(title.casefold(), target)
+        self._file = open(join(directory, "articles.jsonl"), "rb")
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __contains__(self, title: str):
+        return self.find(title) is not None
+
+    def find(self, title: str) -> Optional[int]:
+        """Returns the position of the article with the title or None"""
+        for _ in range(MAX_REDIRECTS + 1):
+            title = normalize_title(title)
+            if title in self._positions:
+                return self._positions[title]
+            if title in self.redirects:
+                title = self.redirects[title]
+                continue
+            folded = title.casefold()
+            if folded in self._folded_positions:
+                return self._folded_positions[folded]
+            if folded not in self._folded_redirects:
+                return None
+            title = self._folded_redirects[folded]
+        return None
+
+    def read(self, position: int) -> Dict:
+        """Returns {"id", "title", "text", "categories"} of the article at the position"""
+        self._file.seek(self.offsets[position])
+        return json.loads(self._file.readline())
+
+    def get(self, title: str) -> Optional[Dict]:
+        position = self.find(title)
+        return None if position is None else self.read(position)
+
+    def page(self, title) -> WikiPage:
+        """Returns the article like wikipediaapi.Wikipedia.page, a list of titles is looked up by its first title"""
+        if not isinstance(title, str):
+            title = title[0] if title else ""
+        article = self.get(title)
+        if article is None:
+            return WikiPage(title)
+        return WikiPage(article["title"], article["id"], article["text"], article["categories"])
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def build_article_store(infile, directory: str, processes=None, index_file=None,
+                        batch_size: int = 10000) -> ArticleStore:
+    """Writes the plain text articles and redirects of a dump to directory, the store of an unchanged dump is reused.
+
+    Args:
+        processes: number of processes decompressing the dump and cleaning the wikitext
+        index_file: stream offset index of the dump, looked up next to the dump by default
+        batch_size: number of pages cleaned in the process pool at once
+    """
+    stat = os.stat(infile)
+    source = {"version": STORE_VERSION, "source": os.path.abspath(infile), "source_size": stat.st_size,
+              "source_mtime": stat.st_mtime_ns}
+    titles_file = join(directory, "titles.json")
+    if os.path.exists(titles_file):
+        with open(titles_file) as fin:
+            saved = json.load(fin)
+        if all(saved.get(key) == value for key, value in source.items()):
+            return ArticleStore(directory)
+        print("article store outdated ", directory)
+
+    os.makedirs(directory, exist_ok=True)
+    processes = processes or os.cpu_count()
+    pages = iter_dump_pages(infile, index_file, processes, namespaces=ARTICLE_NAMESPACES, skip_redirects=False)
+    titles: List[str] = []
+    redirects: Dict[str, str] = {}
+    doc_offsets = []
+    with ProcessPoolExecutor(processes) as executor, open(join(directory, "articles.jsonl"), "wb") as fout:
+        with tqdm() as progress:
+            while True:
+                batch = list(islice(pages, batch_size))
+                if not batch:
+                    break
+                for page_id, title, text, categories, redirect in executor.map(parse_article, batch, chunksize=100):
+                    if redirect is not None:
+                        redirects[normalize_title(title)] = redirect
+                        continue
+                    titles.append(title)
+                    doc_offsets.append(fout.tell())
+                    article = {"id": page_id, "title": title, "text": text, "categories": categories}
+                    fout.write(json.dumps(article, ensure_ascii=False).encode("utf-8"))
+                    fout.write(b"\n")
+                progress.update(len(batch))
+    np.save(join(directory, "doc_offsets.npy"), np.array(doc_offsets, dtype=np.int64))
+    # the titles are written last, a store without them is incomplete
+    save_json_atomic(titles_file, {**source, "titles": titles, "redirects": redirects})
+    print("stored ", len(titles), " articles and ", len(redirects), " redirects")
+    return ArticleStore(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the offline article store of a Wikipedia dump")
+    parser.add_argument("--dump", default="/home/ca/wikipedia_de/dewiki-20200620-pages-articles-multistream.xml.bz2")
+    parser.add_argument("--store_dir", default="article_store")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+    build_article_store(args.dump, args.store_dir, args.processes).close()
@@ -0,0 +1,415 @@
+"""
+BM25 retrieval over postings arrays, in memory or memory-mapped from an index directory
+"""
+
+from bisect import bisect_left
+import json
+import os
+from os.path import join
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+
+INDEX_VERSION = 1
+# number of documents with the highest weight kept for every term, see BM25.best_documents
+NUM_BEST_DOCUMENTS = 10
+# number of consecutive documents with one upper bound per term, see BM25.block_max_weights
+BLOCK_SIZE = 128
+
+
+class MappedVocabulary(object):
+    """Sorted terms in one UTF-8 buffer with offsets, the id of a term is its position"""
+
+    def __init__(self, buffer, offsets: np.ndarray):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.buffer[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def get(self, word: str, default=None):
+        i = bisect_left(self, word)
+        if i < len(self) and self[i] == word:
+            return i
+        return default
+
+    def __contains__(self, word: str):
+        return self.get(word) is not None
+
+
+class BM25(object):
+    """BM25Okapi whose scores agree with rank_bm25.BM25Okapi for the same k1, b and epsilon.
+
+    The index consists of postings: for every term the indices of the documents containing it (postings[indptr[t]:
+    indptr[t + 1]]) with the term frequencies and the precomputed BM25 weights. Scoring a batch of queries only
+    reads the postings of the query terms and is one sparse matrix product, so the arrays can be memory-mapped.
+    """
+
+    def __init__(self, vocabulary, indptr: np.ndarray, postings: np.ndarray, freqs: np.ndarray, doc_len: np.ndarray,
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25, dtype=np.float32,
+                 weights: Optional[np.ndarray] = None):
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.postings = postings
+        self.freqs = freqs
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.dtype = dtype
+        self.doc_freqs = np.diff(indptr)
+        self.idf = compute_idf(self.doc_freqs, self.corpus_size, epsilon)
+        self.avgdl = self.doc_len.sum() / self.corpus_size if self.corpus_size else 0.0
+        self.weights = self.compute_weights(k1, b) if weights is None else weights
+        self._max_weights = None
+        self._best_documents = None
+        self._block_max_weights = None
+
+    @classmethod
+    def from_corpus(cls, corpus: Iterable[Sequence[str]], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25,
+                    dtype=np.float32):
+        """Indexes an iterable of tokenized documents"""
+        vocabulary = {}
+        indptr = [0]
+        indices = []
+        frequencies = []
+        doc_len = []
+        for document in corpus:
+            counts = {}
+            for word in document:
+                term = vocabulary.setdefault(word, len(vocabulary))
+                counts[term] = counts.get(term, 0) + 1
+            indices.extend(counts.keys())
+            frequencies.extend(counts.values())
+            indptr.append(len(indices))
+            doc_len.append(len(document))
+
+        doc_term = sparse.csr_matrix((np.array(frequencies, dtype=np.int32), np.array(indices, dtype=np.int64),
+                                      np.array(indptr, dtype=np.int64)),
+                                     shape=(len(doc_len), len(vocabulary)))
+        # transposed: one row per term with the documents containing it
+        term_doc = doc_term.T.tocsr()
+        term_doc.sort_indices()
+        return cls(vocabulary, term_doc.indptr.astype(np.int64), term_doc.indices.astype(np.int32),
+                   term_doc.data.astype(np.int32), np.array(doc_len, dtype=np.int64), k1, b, epsilon, dtype)
+
+    @property
+    def corpus_size(self):
+        return len(self.doc_len)
+
+    def compute_weights(self, k1: float, b: float, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+        """Returns the BM25 weights of the postings [start, end) for the given parameters"""
+        end = len(self.postings) if end is None else end
+        tf = np.asarray(self.freqs[start:end], dtype=np.float64)
+        doc_len = self.doc_len[self.postings[start:end]]
+        posting_terms = np.searchsorted(self.indptr, np.arange(start, end), side="right") - 1
+        data = self.idf[posting_terms] * (tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len / self.avgdl)))
+        return data.astype(self.dtype)
+
+    def set_statistics(self, idf: np.ndarray, avgdl: float):
+        """Replaces the idf of the terms and the average document length and recomputes the weights.
+
+        Used for an index of one shard of a larger corpus, so its scores are the scores in the whole corpus.
+        """
+        self.idf = idf
+        self.avgdl = avgdl
+        self.weights = self.compute_weights(self.k1, self.b)
+        self._max_weights = None
+        self._best_documents = None
+        self._block_max_weights = None
+
+    def term_ids(self, query: Sequence[str]) -> List[int]:
+        """Returns the ids of the query words, words that are not in the corpus are left out"""
+        ids = (self.vocabulary.get(word) for word in query)
+        return [term for term in ids if term is not None]
+
+    def term_positions(self, terms: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the positions of the postings of the terms and the start of every term in them"""
+        starts = self.indptr[terms]
+        lengths = self.indptr[np.asarray(terms, dtype=np.int64) + 1] - starts
+        row_ptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return np.arange(row_ptr[-1]) - np.repeat(row_ptr[:-1] - starts, lengths), row_ptr
+
+    def term_weights(self, terms: Sequence[int], weights: Optional[np.ndarray] = None) -> sparse.csr_matrix:
+        """Returns the weight rows of the given terms as (terms x documents) matrix, only their postings are read"""
+        weights = self.weights if weights is None else weights
+        positions, row_ptr = self.term_positions(terms)
+        return sparse.csr_matrix((np.asarray(weights[positions], dtype=self.dtype), self.postings[positions], row_ptr),
+                                 shape=(len(terms), self.corpus_size))
+
+    def query_matrix(self, queries: Sequence[Sequence[str]]) -> Tuple[sparse.csr_matrix, List[int]]:
+        """Returns the (queries x terms) matrix counting the query words and the term ids of its columns"""
+        query_terms = [self.term_ids(query) for query in queries]
+        terms = sorted({term for current in query_terms for term in current})
+        local = {term: i for i, term in enumerate(terms)}
+        rows = [i for i, current in enumerate(query_terms) for _ in current]
+        columns = [local[term] for current in query_terms for term in current]
+        # duplicate entries are summed, a repeated query word counts repeatedly like in rank_bm25
+        return sparse.csr_matrix((np.ones(len(rows), dtype=self.dtype), (rows, columns)),
+                                 shape=(len(queries), len(terms))), terms
+
+    def get_batch_scores(self, queries: Sequence[Sequence[str]], weights: Optional[np.ndarray] = None) -> np.ndarray:
+        """Returns the scores of all documents for a batch of queries as (queries x documents) array"""
+        query_matrix, terms = self.query_matrix(queries)
+        return (query_matrix @ self.term_weights(terms, weights)).toarray()
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        return self.get_batch_scores([query])[0]
+
+    @property
+    def max_weights(self) -> np.ndarray:
+        """Upper bound of the weight of every term, i.e. its maximal weight in any document"""
+        if self._max_weights is None:
+            weights = np.asarray(self.weights)
+            self._max_weights = (np.maximum.reduceat(weights, self.indptr[:-1]) if len(weights)
+                                 else np.zeros(len(self.doc_freqs), dtype=self.dtype))
+        return self._max_weights
+
+    @property
+    def best_documents(self) -> np.ndarray:
+        """(terms x NUM_BEST_DOCUMENTS) array of the documents with the highest weights of every term, -1 if unused"""
+        if self._best_documents is None:
+            posting_terms = np.repeat(np.arange(len(self.doc_freqs)), self.doc_freqs)
+            order = np.lexsort((-np.asarray(self.weights), posting_terms))
+            ranks = np.arange(len(order)) - np.repeat(self.indptr[:-1], self.doc_freqs)
+            best = ranks < NUM_BEST_DOCUMENTS
+            self._best_documents = np.full((len(self.doc_freqs), NUM_BEST_DOCUMENTS), -1, dtype=np.int32)
+            self._best_documents[posting_terms[best], ranks[best]] = self.postings[order[best]]
+        return self._best_documents
+
+    @property
+    def block_max_weights(self) -> sparse.csr_matrix:
+        """(terms x blocks) maximal weight of every term in every block of BLOCK_SIZE consecutive documents"""
+        if self._block_max_weights is None:
+            posting_terms = np.repeat(np.arange(len(self.doc_freqs)), self.doc_freqs)
+            blocks = np.asarray(self.postings) // BLOCK_SIZE
+            # the postings of a term are sorted by document, so the postings of a block are consecutive
+            starts = np.flatnonzero(np.concatenate([[True], (posting_terms[1:] != posting_terms[:-1]) |
+                                                    (blocks[1:] != blocks[:-1])])) if len(blocks) else blocks[:0]
+            data = np.maximum.reduceat(np.asarray(self.weights), starts) if len(starts) else np.zeros(0)
+            self._block_max_weights = sparse.csr_matrix(
+                (data.astype(self.dtype), blocks[starts], np.searchsorted(starts, self.indptr)),
+                shape=(len(self.doc_freqs), (self.corpus_size + BLOCK_SIZE - 1) // BLOCK_SIZE))
+        return self._block_max_weights
+
+    def candidate_scores(self, query_matrix: sparse.csr_matrix, terms: Sequence[int],
+                         documents: np.ndarray) -> np.ndarray:
+        """Returns the scores of the sorted documents for the queries of query_matrix, equal to get_batch_scores.
+
+        The weights are looked up in the postings of the terms with binary search, the sums are computed in the same
+        order as in get_batch_scores, so the scores are exactly equal.
+        """
+        data, indices, indptr = [], [], [0]
+        for term in terms:
+            start, end = self.indptr[term], self.indptr[term + 1]
+            postings = self.postings[start:end]
+            found = np.minimum(np.searchsorted(postings, documents.astype(postings.dtype)), len(postings) - 1)
+            columns = np.flatnonzero(postings[found] == documents)
+            data.append(np.asarray(self.weights[start + found[columns]], dtype=self.dtype))
+            indices.append(columns)
+            indptr.append(indptr[-1] + len(columns))
+        weights = sparse.csr_matrix((np.concatenate(data + [np.zeros(0, dtype=self.dtype)]),
+                                     np.concatenate(indices + [np.zeros(0, dtype=np.int64)]), indptr),
+                                    shape=(len(terms), len(documents)))
+        return (query_matrix @ weights).toarray()
+
+    def top_k_wand(self, query: Sequence[str], k: int = 10, sample_size: int = 4096) -> List[Tuple[float, int]]:
+        """Returns the same k best (score, document index) as top_k, but skips documents that cannot be among them.
+
+        Dynamic pruning like block-max WAND/MaxScore: the scores of the documents with the highest weights of the
+        query terms and of up to sample_size documents of the terms with the highest upper bounds give a lower bound
+        of the k-th best score. Only the postings in blocks of documents whose upper bound reaches it are read, and
+        only of the essential terms: the terms with the lowest upper bounds whose sum stays below it cannot make a
+        document one of the k best on their own. The remaining documents are scored like in get_batch_scores, so
+        scores and order are equal to exhaustive scoring.
+        """
+        query_matrix, terms = self.query_matrix([query])
+        # few postings are read faster at once
+        if self.doc_freqs[terms].sum() <= sample_size or self.corpus_size <= k or np.any(self.idf[terms] < 0):
+            return self.top_k([query], k)[0]
+
+        counts = np.zeros(len(terms), dtype=np.float64)
+        counts[query_matrix.indices] = query_matrix.data
+        bounds = counts * self.max_weights[terms]
+        order = np.argsort(bounds, kind="stable")
+
+        # lower bound of the k-th best score from the documents with the highest weights of the query terms and all
+        # documents of the terms with the highest upper bounds as long as they are few
+        sample = [self.best_documents[terms].ravel()]
+        num_documents = np.cumsum(self.doc_freqs[terms][order[::-1]])
+        for i in order[::-1][num_documents <= sample_size]:
+            sample.append(self.postings[self.indptr[terms[i]]:self.indptr[terms[i] + 1]])
+        sample = np.unique(np.concatenate(sample))
+        sample = sample[sample >= 0]
+        if len(sample) < k:
+            return self.top_k([query], k)[0]
+        threshold = np.sort(self.candidate_scores(query_matrix, terms, sample)[0])[-k]
+        if threshold <= 0:
+            return self.top_k([query], k)[0]
+
+        # the tolerance covers the rounding of the float32 sums
+        non_essential = np.cumsum(bounds[order]) * (1 + 1e-4) < threshold
+        block_bounds = (query_matrix @ self.block_max_weights[terms]).toarray()[0]
+        blocks = np.flatnonzero(block_bounds * (1 + 1e-4) >= threshold)
+        # same type as the postings, otherwise searchsorted converts the postings
+        block_starts = (blocks * BLOCK_SIZE).astype(self.postings.dtype)
+        block_ends = ((blocks + 1) * BLOCK_SIZE).astype(self.postings.dtype)
+
+        ranges = []
+        for i in order[~non_essential]:
+            postings = self.postings[self.indptr[terms[i]]:self.indptr[terms[i] + 1]]
+            starts = np.searchsorted(postings, block_starts)
+            ranges.append((postings, starts, np.searchsorted(postings, block_ends) - starts))
+        # every remaining document is looked up in the postings of every term, reading all postings is cheaper if
+        # there are too many
+        if sum(int(lengths.sum()) for _, _, lengths in ranges) * len(terms) > self.doc_freqs[terms].sum():
+            return self.top_k([query], k)[0]
+        documents = []
+        for postings, starts, lengths in ranges:
+            offsets = np.cumsum(lengths)
+            documents.append(postings[np.arange(offsets[-1] if len(offsets) else 0)
+                                      - np.repeat(offsets - lengths - starts, lengths)])
+        documents = np.unique(np.concatenate(documents))
+        scores = self.candidate_scores(query_matrix, terms, documents)
+        return [(score, int(documents[column])) for score, column in top_k_rows(scores, k)[0]]
+
+    def top_k(self, queries: Sequence[Sequence[str]], k: int = 10, batch_size: int = 256,
+              weights: Optional[np.ndarray] = None, method: str = "exhaustive") -> List[List[Tuple[float, int]]]:
+        """Returns the k best (score, document index) pairs for every query, sorted by score.
+
+        Equal scores are ordered by document index, so the result does not depend on the batch size.
+
+        Args:
+            method: "exhaustive" scores every document with a query word, "wand" skips the documents that cannot be
+                among the k best (see top_k_wand) and returns the same result
+        """
+        if method == "wand" and weights is None:
+            return [self.top_k_wand(query, k) for query in queries]
+        results = []
+        for start in range(0, len(queries), batch_size):
+            scores = self.get_batch_scores(queries[start:start + batch_size], weights)
+            results.extend(top_k_rows(scores, k))
+        return results
+
+    def top_k_grid(self, queries: Sequence[Sequence[str]], parameters: Sequence[Tuple[float, float]], k: int = 10,
+                   batch_size: int = 256) -> Dict[Tuple[float, float], List[List[Tuple[float, int]]]]:
+        """Returns the top_k of the queries for every (k1, b) of parameters.
+
+        The term frequencies and document lengths of the postings of a batch are read once and only the weights are
+        computed again for every setting, the results are equal to top_k with compute_weights(k1, b).
+        """
+        results = {parameter: [] for parameter in parameters}
+        for start in range(0, len(queries), batch_size):
+            query_matrix, terms = self.query_matrix(queries[start:start + batch_size])
+            positions, row_ptr = self.term_positions(terms)
+            postings = self.postings[positions]
+            tf = np.asarray(self.freqs[positions], dtype=np.float64)
+            doc_len = self.doc_len[postings]
+            idf = np.repeat(self.idf[terms], np.diff(row_ptr))
+            for k1, b in parameters:
+                data = idf * (tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_len / self.avgdl)))
+                weights = sparse.csr_matrix((data.astype(self.dtype), postings, row_ptr),
+                                            shape=(len(terms), self.corpus_size))
+                results[k1, b].extend(top_k_rows((query_matrix @ weights).toarray(), k))
+        return results
+
+    def save(self, directory: str, doc_offsets: Optional[np.ndarray] = None, meta: Optional[Dict] = None):
+        """Writes the index as arrays that BM25.load memory-maps, the terms are stored sorted.
+
+        Args:
+            doc_offsets: byte offset of every document in its source file for lazy retrieval of the text
+            meta: additional information saved in meta.json, e.g. about the source file
+        """
+        os.makedirs(directory, exist_ok=True)
+        id_terms = [None] * len(self.vocabulary)
+        for word, term in self.vocabulary.items():
+            id_terms[term] = word
+        order = np.array(sorted(range(len(id_terms)), key=id_terms.__getitem__), dtype=np.int64)
+        sorted_terms = [id_terms[term].encode("utf-8") for term in order]
+
+        starts = self.indptr[order]
+        lengths = self.doc_freqs[order]
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        positions = np.arange(indptr[-1]) - np.repeat(indptr[:-1] - starts, lengths)
+
+        with open(join(directory, "vocabulary.bin"), "wb") as fout:
+            fout.write(b"".join(sorted_terms))
+        term_offsets = np.concatenate([[0], np.cumsum([len(term) for term in sorted_terms])]).astype(np.int64)
+        np.save(join(directory, "vocabulary_offsets.npy"), term_offsets)
+        np.save(join(directory, "indptr.npy"), indptr)
+        np.save(join(directory, "doc_freqs.npy"), lengths)
+        np.save(join(directory, "postings.npy"), np.asarray(self.postings[positions], dtype=np.int32))
+        np.save(join(directory, "freqs.npy"), np.asarray(self.freqs[positions], dtype=np.int32))
+        np.save(join(directory, "weights.npy"), np.asarray(self.weights[positions], dtype=self.dtype))
+        np.save(join(directory, "doc_len.npy"), self.doc_len)
+        # upper bounds for top_k_wand
+        np.save(join(directory, "max_weights.npy"), self.max_weights[order])
+        np.save(join(directory, "best_documents.npy"), self.best_documents[order])
+        block_max_weights = self.block_max_weights[order]
+        np.save(join(directory, "block_max_data.npy"), block_max_weights.data)
+        np.save(join(directory, "block_max_indices.npy"), block_max_weights.indices)
+        np.save(join(directory, "block_max_indptr.npy"), block_max_weights.indptr)
+        if doc_offsets is not None:
+            np.save(join(directory, "doc_offsets.npy"), np.asarray(doc_offsets, dtype=np.int64))
+        # meta.json is written last, an index without it is incomplete
+        current_meta = {"version": INDEX_VERSION, "k1": self.k1, "b": self.b, "epsilon": self.epsilon,
+                        "dtype": np.dtype(self.dtype).name, **(meta or {})}
+        with open(join(directory, "meta.json"), "w") as fout:
+            json.dump(current_meta, fout, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str):
+        """Opens an index written by save, all arrays are memory-mapped and shared between processes"""
+        with open(join(directory, "meta.json")) as fin:
+            meta = json.load(fin)
+
+        def load_array(name):
+            # a plain view of the mapped memory, indexing a np.memmap is much slower
+            return np.asarray(np.load(join(directory, f"{name}.npy"), mmap_mode="r"))
+
+        terms_file = join(directory, "vocabulary.bin")
+        # numpy cannot map empty files
+        terms = np.memmap(terms_file, dtype=np.uint8, mode="r") if os.path.getsize(terms_file) else b""
+        vocabulary = MappedVocabulary(memoryview(terms), load_array("vocabulary_offsets"))
+        bm25 = cls(vocabulary, load_array("indptr"), load_array("postings"), load_array("freqs"),
+                   np.asarray(load_array("doc_len")), meta["k1"], meta["b"], meta["epsilon"], np.dtype(meta["dtype"]),
+                   load_array("weights"))
+        bm25.meta = meta
+        if os.path.exists(join(directory, "block_max_indptr.npy")):
+            bm25._max_weights = load_array("max_weights")
+            bm25._best_documents = load_array("best_documents")
+            bm25._block_max_weights = sparse.csr_matrix(
+                (load_array("block_max_data"), load_array("block_max_indices"), load_array("block_max_indptr")),
+                shape=(len(vocabulary), (bm25.corpus_size + BLOCK_SIZE - 1) // BLOCK_SIZE))
+        bm25.doc_offsets = load_array("doc_offsets") if os.path.exists(join(directory, "doc_offsets.npy")) else None
+        return bm25
+
+
+def compute_idf(doc_freqs: np.ndarray, corpus_size: int, epsilon: float) -> np.ndarray:
+    """Returns the idf of rank_bm25.BM25Okapi: negative values are replaced by epsilon times the average idf"""
+    idf = np.log(corpus_size - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+    if len(idf):
+        idf[idf < 0] = epsilon * idf.mean()
+    return idf
+
+
+def top_k_rows(scores: np.ndarray, k: int) -> List[List[Tuple[float, int]]]:
+    """Returns the k best (score, column) pairs of every row, ties are broken by the lower column index"""
+    k = min(k, scores.shape[1])
+    results = []
+    if k == 0:
+        return [[] for _ in range(scores.shape[0])]
+    kth_columns = np.argpartition(-scores, k - 1, axis=1)[:, k - 1]
+    for row, kth_column in zip(scores, kth_columns):
+        kth_score = row[kth_column]
+        above = np.flatnonzero(row > kth_score)
+        ties = np.flatnonzero(row == kth_score)[:k - len(above)]
+        columns = np.concatenate([above, ties])
+        columns = columns[np.lexsort((columns, -row[columns]))]
+        results.append([(float(row[column]), int(column)) for column in columns])
+    return results
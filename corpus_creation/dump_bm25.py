@@ -0,0 +1,306 @@
+"""
+Exact BM25 retrieval over a whole Wikipedia dump with sharded indexes built and searched in parallel
+
+The dump is split into shards of consecutive pages that are indexed independently. The document frequencies and
+lengths of all shards are merged into the statistics of the whole dump, every shard is scored with these global
+statistics and the per-shard top k are merged into the global top k.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from collections import deque
+import hashlib
+import heapq
+import json
+import os
+from os.path import join
+from itertools import islice
+import time
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from nltk.tokenize import word_tokenize
+import numpy as np
+from tqdm import tqdm
+
+from bm25 import BM25, INDEX_VERSION
+from wiki_dump import ARTICLE_NAMESPACES, Page, iter_dump_stream_pages
+
+
+def index_shard(shard_dir: str, pages: List[Page]) -> Tuple[int, int]:
+    """Indexes one shard of pages and stores the pages next to the index, returns (documents, total length)"""
+    os.makedirs(shard_dir, exist_ok=True)
+    doc_offsets = []
+    with open(join(shard_dir, "pages.jsonl"), "wb") as fout:
+        for page_id, _, title, text in pages:
+            doc_offsets.append(fout.tell())
+            fout.write(json.dumps({"id": page_id, "title": title, "text": text}, ensure_ascii=False).encode("utf-8"))
+            fout.write(b"\n")
+    bm25 = BM25.from_corpus(word_tokenize(text, "german") for _, _, _, text in pages)
+    bm25.save(shard_dir, np.array(doc_offsets, dtype=np.int64))
+    return bm25.corpus_size, int(bm25.doc_len.sum())
+
+
+def iter_page_positions(stream_pages: Iterable[Tuple[int, Page]]):
+    """Yields ((stream offset, number of pages read from that offset before), page) for (stream offset, page)"""
+    current_offset, count = None, 0
+    for stream_offset, page in stream_pages:
+        if stream_offset != current_offset:
+            current_offset, count = stream_offset, 0
+        yield (stream_offset, count), page
+        count += 1
+
+
+def iter_page_shards(pages: Iterable, shard_size: int):
+    shard = []
+    for page in pages:
+        shard.append(page)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def save_json_atomic(filename: str, json_object):
+    with open(filename + ".tmp", "w") as fout:
+        json.dump(json_object, fout, ensure_ascii=False)
+    os.replace(filename + ".tmp", filename)
+
+
+def build_dump_shards(infile, work_dir: str, shard_size: int = 10000, processes=None, read_processes=None,
+                      index_file=None, resume: bool = False, checkpoint_interval: float = 300,
+                      namespaces=ARTICLE_NAMESPACES, skip_redirects: bool = True) -> List[str]:
+    """Indexes the pages of a dump in shards, the shards of an unchanged dump are reused.
+
+    Returns the shard directories in the order of the dump.
+
+    Args:
+        processes: number of processes indexing shards
+        read_processes: number of processes decompressing the streams of a multistream dump, see iter_dump_pages
+        index_file: stream offset index of the dump, looked up next to the dump by default
+        resume: continue after the shards of the last checkpoint instead of starting at the beginning of the dump
+        checkpoint_interval: minimal number of seconds between two checkpoints
+        namespaces: namespaces of the indexed pages, all if None
+        skip_redirects: leave out redirect pages
+    """
+    stat = os.stat(infile)
+    source = {"version": INDEX_VERSION, "source": os.path.abspath(infile), "source_size": stat.st_size,
+              "source_mtime": stat.st_mtime_ns, "shard_size": shard_size,
+              "namespaces": None if namespaces is None else sorted(namespaces), "skip_redirects": skip_redirects}
+    shards_file = join(work_dir, "shards.json")
+    if os.path.exists(shards_file):
+        with open(shards_file) as fin:
+            shards = json.load(fin)
+        if all(shards.get(key) == value for key, value in source.items()):
+            return [join(work_dir, name) for name in shards["shards"]]
+        print("shards outdated ", work_dir)
+
+    # the checkpoint holds the finished shards and the position in the dump after their pages, i.e. the offset of a
+    # stream and the number of pages read from it
+    checkpoint_file = join(work_dir, "checkpoint.json")
+    checkpoint = {**source, "shards": [], "pages": 0, "stream_offset": 0, "skip": 0}
+    if resume and os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as fin:
+            saved = json.load(fin)
+        if all(saved.get(key) == value for key, value in source.items()):
+            checkpoint = saved
+            print("resuming after page ", checkpoint["pages"])
+        else:
+            print("checkpoint outdated ", checkpoint_file)
+
+    os.makedirs(work_dir, exist_ok=True)
+    processes = processes or os.cpu_count()
+    pages = iter_page_positions(iter_dump_stream_pages(infile, index_file, read_processes or processes,
+                                                       start_offset=checkpoint["stream_offset"], namespaces=namespaces,
+                                                       skip_redirects=skip_redirects))
+    names = checkpoint["shards"]
+    last_checkpoint = time.monotonic()
+    with ProcessPoolExecutor(processes) as executor:
+        # the shards are read by the main process, only a few per worker are in flight
+        pending = deque()
+
+        def finish_shard():
+            name, num_pages, (stream_offset, count), future = pending.popleft()
+            future.result()
+            names.append(name)
+            checkpoint.update(pages=checkpoint["pages"] + num_pages, stream_offset=stream_offset, skip=count + 1)
+
+        for shard in tqdm(iter_page_shards(islice(pages, checkpoint["skip"], None), shard_size)):
+            name = f"shard_{len(names) + len(pending):05d}"
+            future = executor.submit(index_shard, join(work_dir, name), [page for _, page in shard])
+            pending.append((name, len(shard), shard[-1][0], future))
+            if len(pending) > 2 * processes:
+                finish_shard()
+                if time.monotonic() - last_checkpoint > checkpoint_interval:
+                    save_json_atomic(checkpoint_file, checkpoint)
+                    last_checkpoint = time.monotonic()
+        while pending:
+            finish_shard()
+
+    # shards.json is written last, the shards are incomplete without it
+    save_json_atomic(shards_file, {**source, "shards": names})
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    print("dump indexed ", len(names), " shards")
+    return [join(work_dir, name) for name in names]
+
+
+def iter_shard_terms(shard_dir: str):
+    """Yields (term, document frequency) of a shard in sorted order"""
+    bm25 = BM25.load(shard_dir)
+    for term in range(len(bm25.vocabulary)):
+        yield bm25.vocabulary[term], int(bm25.doc_freqs[term])
+
+
+def global_statistics(shard_dirs: Sequence[str], query_words: Iterable[str], epsilon: float = 0.25):
+    """Returns (idf of the query words, average document length) of all shards as one corpus.
+
+    The idf is the one of rank_bm25.BM25Okapi over the whole dump, including the epsilon floor that depends on the
+    average idf of all terms. The sorted vocabularies of the shards are merged, so no global vocabulary is held in
+    memory.
+    """
+    corpus_size = 0
+    total_length = 0
+    for shard_dir in shard_dirs:
+        doc_len = np.load(join(shard_dir, "doc_len.npy"), mmap_mode="r")
+        corpus_size += len(doc_len)
+        total_length += int(doc_len.sum())
+
+    query_words = set(query_words)
+    query_freqs = {}
+    num_terms = 0
+    idf_sum = 0.0
+    current_term, current_freq = None, 0
+    for term, doc_freq in heapq.merge(*(iter_shard_terms(shard_dir) for shard_dir in shard_dirs)):
+        if term != current_term:
+            if current_term is not None:
+                num_terms += 1
+                idf_sum += np.log(corpus_size - current_freq + 0.5) - np.log(current_freq + 0.5)
+                if current_term in query_words:
+                    query_freqs[current_term] = current_freq
+            current_term, current_freq = term, 0
+        current_freq += doc_freq
+    if current_term is not None:
+        num_terms += 1
+        idf_sum += np.log(corpus_size - current_freq + 0.5) - np.log(current_freq + 0.5)
+        if current_term in query_words:
+            query_freqs[current_term] = current_freq
+
+    average_idf = idf_sum / num_terms if num_terms else 0.0
+    query_idf = {}
+    for word, doc_freq in query_freqs.items():
+        idf = np.log(corpus_size - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        query_idf[word] = idf if idf >= 0 else epsilon * average_idf
+    return query_idf, total_length / corpus_size if corpus_size else 0.0
+
+
+def score_shard(shard_dir: str, queries: Sequence[Sequence[str]], query_idf: Dict[str, float], avgdl: float,
+                k: int) -> List[List[Tuple[float, int]]]:
+    """Returns the k best (score, position in the shard) of every query with the statistics of the whole dump"""
+    bm25 = BM25.load(shard_dir)
+    # only the query words need an idf, the weights of all other terms become 0
+    idf = np.zeros(len(bm25.vocabulary), dtype=np.float64)
+    for word, value in query_idf.items():
+        term = bm25.vocabulary.get(word)
+        if term is not None:
+            idf[term] = value
+    bm25.set_statistics(idf, avgdl)
+    return bm25.top_k(queries, k)
+
+
+def save_heaps(filename: str, heaps: List[List[Tuple[float, int, int]]], k: int, merged: Iterable[int], key: str):
+    """Writes the per-query top k and the indices of the merged shards as arrays, without any text of the articles"""
+    scores = np.full((len(heaps), k), -np.inf)
+    entries = np.zeros((len(heaps), k, 2), dtype=np.int64)
+    sizes = np.array([len(heap) for heap in heaps], dtype=np.int64)
+    for i, heap in enumerate(heaps):
+        for j, (score, shard, position) in enumerate(heap):
+            scores[i, j] = score
+            entries[i, j] = (shard, position)
+    with open(filename + ".tmp", "wb") as fout:
+        np.savez(fout, scores=scores, entries=entries, sizes=sizes, merged=np.array(sorted(merged), dtype=np.int64),
+                 key=key)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_heaps(filename: str, key: str):
+    """Returns (heaps, set of merged shards) saved by save_heaps, or None if they belong to another search"""
+    with np.load(filename) as checkpoint:
+        if str(checkpoint["key"]) != key:
+            return None
+        heaps = [[(float(score), int(shard), int(position)) for score, (shard, position) in zip(scores[:size], entries)]
+                 for scores, entries, size in zip(checkpoint["scores"], checkpoint["entries"], checkpoint["sizes"])]
+        merged = checkpoint["merged"]
+        # older checkpoints hold the number of shards merged in order
+        merged = set(range(int(merged))) if merged.ndim == 0 else set(merged.tolist())
+        return heaps, merged
+
+
+def search_shards(shard_dirs: Sequence[str], queries: Sequence[Sequence[str]], k: int = 10, processes=None,
+                  epsilon: float = 0.25, checkpoint_file=None, resume: bool = False,
+                  checkpoint_interval: float = 300) -> List[List[Tuple[float, int, int]]]:
+    """Returns the global k best (score, shard, position) of every query, best first.
+
+    Equal scores are ordered by shard and position, i.e. by the position in the dump, like BM25.top_k on one index.
+
+    Args:
+        checkpoint_file: file the top k of the shards merged so far are saved to, at most every checkpoint_interval
+            seconds
+        resume: continue after the shards merged in the checkpoint of the same search
+    """
+    query_idf, avgdl = global_statistics(shard_dirs, (word for query in queries for word in query), epsilon)
+    key = hashlib.sha1(json.dumps([list(map(list, queries)), [os.path.basename(shard_dir) for shard_dir in shard_dirs],
+                                   k, epsilon], ensure_ascii=False).encode("utf-8")).hexdigest()
+    # min heaps of (score, -shard, -position), the root is the worst of the current top k
+    heaps, merged = [[] for _ in queries], set()
+    if resume and checkpoint_file and os.path.exists(checkpoint_file):
+        saved = load_heaps(checkpoint_file, key)
+        if saved is None:
+            print("checkpoint of another search ", checkpoint_file)
+        else:
+            heaps, merged = saved
+            print("resuming with merged shards ", len(merged))
+
+    def merge_shard(shard: int, shard_top_k: List[List[Tuple[float, int]]]):
+        # the entries are distinct, so the top k do not depend on the order the shards are merged in
+        for heap, top_k in zip(heaps, shard_top_k):
+            for score, position in top_k:
+                entry = (score, -shard, -position)
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+        merged.add(shard)
+
+    last_checkpoint = time.monotonic()
+    processes = processes or os.cpu_count()
+    remaining = [shard for shard in range(len(shard_dirs)) if shard not in merged]
+    with ProcessPoolExecutor(processes) as executor, tqdm(total=len(remaining)) as progress:
+        # a few shards per process are in flight and every shard is merged as soon as it is scored
+        pending = deque()
+
+        def merge_finished(in_flight: int):
+            nonlocal last_checkpoint
+            while len(pending) > in_flight:
+                finished, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                for task in [task for task in pending if task[1] in finished]:
+                    pending.remove(task)
+                    merge_shard(task[0], task[1].result())
+                    progress.update()
+                if checkpoint_file and time.monotonic() - last_checkpoint > checkpoint_interval:
+                    save_heaps(checkpoint_file, heaps, k, merged, key)
+                    last_checkpoint = time.monotonic()
+
+        for shard in remaining:
+            pending.append((shard, executor.submit(score_shard, shard_dirs[shard], queries, query_idf, avgdl, k)))
+            merge_finished(2 * processes)
+        merge_finished(0)
+    if checkpoint_file and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return [[(score, -shard, -position) for score, shard, position in sorted(heap, reverse=True)] for heap in heaps]
+
+
+def read_shard_page(shard_dir: str, position: int) -> Dict:
+    offset = np.load(join(shard_dir, "doc_offsets.npy"), mmap_mode="r")[position]
+    with open(join(shard_dir, "pages.jsonl"), "rb") as fin:
+        fin.seek(offset)
+        return json.loads(fin.readline())
@@ -0,0 +1,142 @@
+"""
+Join of line-based files on a key that keeps only the keys and byte offsets of the lines in memory
+"""
+
+import json
+import os
+from os.path import join
+import sys
+import tempfile
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+
+# estimated bytes of a dict entry besides its key, i.e. the slot and the offset
+ENTRY_SIZE = 100
+
+
+def iter_lines(filename) -> Iterator[Tuple[int, str]]:
+    """Yields (byte offset, line) of the non-empty lines of a file"""
+    with open(filename, "rb") as fin:
+        offset = 0
+        for line in fin:
+            if line.strip():
+                yield offset, line.decode("utf-8")
+            offset += len(line)
+
+
+class ExternalHashJoin(object):
+    """Looks up the lines of a build file by key for the lines of probe files, in the order of the probe file.
+
+    Only a dict from key to byte offset of the line is kept. If it exceeds memory_budget bytes, the keys and offsets are
+    spilled to partitions by the hash of the key in a temporary directory and the join is done one partition at a time.
+    A later line of the build file replaces an earlier line with the same key. Use as context manager or close it.
+
+    Args:
+        build_key: key of a build line
+        partitions: number of partitions if the keys are spilled
+        tmp_dir: directory of the temporary directory, the default of tempfile if None
+    """
+
+    def __init__(self, build_file, build_key: Callable[[str], str], memory_budget: int = 1 << 30,
+                 partitions: int = 64, tmp_dir=None):
+        self.build_file = build_file
+        self.partitions = partitions
+        self.offsets: Dict[str, int] = {}
+        self._tmp = None
+        self._build = open(build_file, "rb")
+        size = 0
+        partition_files = None
+        for offset, line in iter_lines(build_file):
+            key = build_key(line)
+            if partition_files is not None:
+                partition_files[hash(key) % partitions].write(json.dumps([key, offset]) + "\n")
+                continue
+            if key not in self.offsets:
+                size += sys.getsizeof(key) + ENTRY_SIZE
+            self.offsets[key] = offset
+            if size > memory_budget:
+                print(f"spilling the join keys of {build_file} to {partitions} partitions")
+                self._tmp = tempfile.TemporaryDirectory(dir=tmp_dir)
+                partition_files = [open(self._partition_file("build", i), "w") for i in range(partitions)]
+                # the keys are written in the order of their first line, the offsets are of their last line so far
+                for spilled_key, spilled_offset in self.offsets.items():
+                    partition_files[hash(spilled_key) % partitions].write(
+                        json.dumps([spilled_key, spilled_offset]) + "\n")
+                self.offsets = {}
+        if partition_files is None:
+            self.size = len(self.offsets)
+        else:
+            for fout in partition_files:
+                fout.close()
+            self.size = sum(len(self._load_partition(i)) for i in range(partitions))
+
+    @property
+    def spilled(self) -> bool:
+        return self._tmp is not None
+
+    def _partition_file(self, side: str, partition: int) -> str:
+        return join(self._tmp.name, f"{side}_{partition}.jsonl")
+
+    def _load_partition(self, partition: int) -> Dict[str, int]:
+        offsets = {}
+        with open(self._partition_file("build", partition)) as fin:
+            for line in fin:
+                key, offset = json.loads(line)
+                offsets[key] = offset
+        return offsets
+
+    def read(self, offset: int) -> str:
+        """Returns the line of the build file at the byte offset"""
+        self._build.seek(offset)
+        return self._build.readline().decode("utf-8")
+
+    def join(self, probe_file, probe_parse: Callable[[str], Tuple[str, Any]]) -> Iterator[Tuple[Optional[str], Any]]:
+        """Yields (build line or None, value) for the lines of the probe file in order.
+
+        probe_parse returns (key, value) of a probe line, e.g. the key and the parsed JSON object.
+        """
+        if not self.spilled:
+            for _, line in iter_lines(probe_file):
+                key, value = probe_parse(line)
+                offset = self.offsets.get(key)
+                yield (None if offset is None else self.read(offset)), value
+            return
+
+        # the probe keys are partitioned like the build keys with their line number, the offsets of the matching build
+        # lines are collected in a memory-mapped array by line number
+        partition_files = [open(self._partition_file("probe", i), "w") for i in range(self.partitions)]
+        count = 0
+        for _, line in iter_lines(probe_file):
+            key, _ = probe_parse(line)
+            partition_files[hash(key) % self.partitions].write(json.dumps([count, key]) + "\n")
+            count += 1
+        for fout in partition_files:
+            fout.close()
+        build_offsets = np.lib.format.open_memmap(join(self._tmp.name, "probe_offsets.npy"), mode="w+",
+                                                  dtype=np.int64, shape=(max(count, 1),))
+        build_offsets[:] = -1
+        for partition in range(self.partitions):
+            offsets = self._load_partition(partition)
+            with open(self._partition_file("probe", partition)) as fin:
+                for line in fin:
+                    position, key = json.loads(line)
+                    build_offsets[position] = offsets.get(key, -1)
+            os.remove(self._partition_file("probe", partition))
+        for position, (_, line) in enumerate(iter_lines(probe_file)):
+            _, value = probe_parse(line)
+            offset = int(build_offsets[position])
+            yield (None if offset == -1 else self.read(offset)), value
+        del build_offsets
+
+    def close(self):
+        self._build.close()
+        if self._tmp is not None:
+            self._tmp.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,12 +1,15 @@
+import hashlib
+import heapq
 import html
 import json
 from os.path import join
-import random
-import re
 import string
+from typing import Dict, List, Tuple
 
 from tqdm import tqdm
 
+from external_join import ExternalHashJoin, iter_lines
+
 
 def read_translated_json(filename: str):
     items = []
@@ -149,93 +152,92 @@ def check_answer_in_doc(path, part):
     print(wrong_answer_count / total)
 
 
+# the ASCII characters that are not letters, deleted from the question keys
+NON_LETTERS = bytes(sorted(set(range(128)) - set(string.ascii_letters.encode("ascii"))))
+QUESTION_TAGS = ("< i >", "< /i >", "& nbsp ;", "& amp ;")
+
+
 def strip_punctuation(text: str):
-    # for char in string.punctuation:
-    #     text = text.replace(char, "")
-    # for char in string.whitespace:
-    #     text = text.replace(char, "")
+    """Returns the ASCII letters of the unescaped text without the tags of the tokenized questions"""
     text = html.unescape(text)
-    text = re.sub(r"< i >", "", text)
-    text = re.sub(r"< /i >", "", text)
-    text = re.sub(r"& nbsp ;", "", text)
-    text = re.sub(r"& amp ;", "", text)
-    new_text = []
-    for char in text:
-        if char in string.ascii_letters:
-            new_text.append(char)
-    text = "".join(new_text)
-    return text
-
-
-def add_additional_docs(path, part):
+    for tag in QUESTION_TAGS:
+        text = text.replace(tag, "")
+    # the characters that are not ASCII are dropped by the encoding, the others by the table
+    return text.encode("ascii", "ignore").translate(None, NON_LETTERS).decode("ascii")
+
+
+def single_doc_items(line: str) -> list:
+    current = json.loads(line)
+    return current if type(current) is list else [current]
+
+
+def parse_question(line: str):
+    current = json.loads(line)
+    return strip_punctuation(current["question"]), current
+
+
+def parse_txt_question(line: str):
+    current = json.loads(line)
+    return current["question"], current
+
+
+def add_additional_docs(path, part, memory_budget=1 << 30):
+    """Adds the BM25 documents of every question to its document and writes the first 10 to {part}_doc_de.json.
+
+    The single documents are joined by question without loading them, see ExternalHashJoin for memory_budget.
+    """
     single_doc_file = join(path, f"filtered_{part}_single_doc_de.json")
     multi_doc_file = join(path, f"corpus_{part}_BM25_documents.json")
     out_file = join(path, f"{part}_doc_de.json")
 
-    data = {}
-    with open(single_doc_file) as fin:
-        for line in tqdm(fin):
-            current = json.loads(line.strip())
-            if type(current) is list:
-                question_key = strip_punctuation(current[0]["question"])
-                data[question_key] = current
-            else:
-                question_key = strip_punctuation(current["question"])
-                data[question_key] = [current]
+    data = ExternalHashJoin(single_doc_file, lambda line: strip_punctuation(single_doc_items(line)[0]["question"]),
+                            memory_budget)
 
     same_doc = 0
-    with open(multi_doc_file) as fin:
-        with open(out_file, "w") as fout:
-            for line in tqdm(fin):
-                current = json.loads(line.strip())
-                question = current["question"]
-                question_key = strip_punctuation(question)
-                if question_key not in data:
-                    # was filtered
-                    print("Not in data ", question, question_key)
-                    continue
-                orig_doc = data[question_key][0]["document"]
-                question = data[question_key][0]["question"]  # use the question version with less whitespace
-                current_list = data[question_key].copy()
-                for i, doc in enumerate(current["documents"]):
-                    question_id = data[question_key][0]["id"][0]
-                    new_item = {"id": [question_id, i],
-                                "question": question,
-                                "document": doc["text"],
-                                "document_id": doc["id"]}
-                    current_list.append(new_item)
-                    if orig_doc == doc["text"]:
-                        same_doc += 1
-                if len(current_list) < 10:
-                    print(question)
-                json.dump(current_list[:10], fout, ensure_ascii=False)
-                fout.write("\n")
+    with data, open(out_file, "w") as fout:
+        for single_line, current in tqdm(data.join(multi_doc_file, parse_question)):
+            if single_line is None:
+                # was filtered
+                print("Not in data ", current["question"], strip_punctuation(current["question"]))
+                continue
+            current_list = single_doc_items(single_line)
+            orig_doc = current_list[0]["document"]
+            question = current_list[0]["question"]  # use the question version with less whitespace
+            question_id = current_list[0]["id"][0]
+            for i, doc in enumerate(current["documents"]):
+                new_item = {"id": [question_id, i],
+                            "question": question,
+                            "document": doc["text"],
+                            "document_id": doc["id"]}
+                current_list.append(new_item)
+                if orig_doc == doc["text"]:
+                    same_doc += 1
+            if len(current_list) < 10:
+                print(question)
+            json.dump(current_list[:10], fout, ensure_ascii=False)
+            fout.write("\n")
 
-    print("Total ", len(data))
+    print("Total ", data.size)
     print("same docs ", same_doc)
-    print("Fraction ", same_doc / len(data))
+    print("Fraction ", same_doc / data.size)
 
 
-def add_article_title_as_answer(path, part):
+def add_article_title_as_answer(path, part, memory_budget=1 << 30):
     txt_file = join(path, f"filtered_{part}_de.txt")
     json_file = join(path, f"filtered_{part}_single_doc_de.json")
     out_file = join(path, f"filtered_{part}_de_extended.txt")
 
-    answers = {}
-    with open(json_file) as fin:
-        for line in fin:
-            current = json.loads(line.strip())
-            answers[current[0]["question"]] = current[0]["document_id"]
+    answers = ExternalHashJoin(json_file, lambda line: json.loads(line)[0]["question"], memory_budget)
 
-    with open(txt_file) as fin:
-        with open(out_file, "w") as fout:
-            for line in fin:
-                current = json.loads(line.strip())
-                title_answer = answers[current["question"]]
-                if title_answer not in current["answers"]:
-                    current["answers"].append(title_answer)
-                json.dump(current, fout, ensure_ascii=False)
-                fout.write("\n")
+    with answers, open(out_file, "w") as fout:
+        for json_line, current in answers.join(txt_file, parse_txt_question):
+            if json_line is None:
+                raise KeyError(current["question"])
+            title_answer = json.loads(json_line)[0]["document_id"]
+            if title_answer not in current["answers"]:
+                current["answers"].append(title_answer)
+            json.dump(current, fout, ensure_ascii=False)
+            fout.write("\n")
 
 
 def remove_first_paragraph(path, part):
@@ -252,56 +254,81 @@ def remove_first_paragraph(path, part):
                 fout.write("\n")
 
 
-def select_items(n: int, part):
+def question_priority(question: str, seed: int) -> int:
+    """Random priority of a question, the same question has the same priority with the same seed"""
+    digest = hashlib.blake2b(question.encode("utf-8"), digest_size=8, key=str(seed).encode("utf-8")).digest()
+    return int.from_bytes(digest, "little")
+
+
+class QuestionReservoir(object):
+    """Reservoir sample of the distinct questions of a file with the byte offsets of their first lines.
+
+    The reservoir keeps the size questions with the lowest priorities, so the sample of every smaller size is a subset
+    of the samples of larger sizes.
+    """
+
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        self.seed = seed
+        # max heap of (-priority, question) of the questions in the reservoir
+        self.heap = []
+        self.offsets: Dict[str, Tuple[int, int]] = {}
+
+    def add(self, question: str, offset: int):
+        if question in self.offsets:
+            return
+        priority = question_priority(question, self.seed)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, (-priority, question))
+        elif priority < -self.heap[0][0]:
+            _, evicted = heapq.heapreplace(self.heap, (-priority, question))
+            del self.offsets[evicted]
+        else:
+            return
+        self.offsets[question] = (priority, offset)
+
+    def sample(self, n: int) -> Dict[str, int]:
+        """Returns {question: offset} of the n questions with the lowest priorities"""
+        return {question: offset for question, (_, offset) in
+                heapq.nsmallest(n, self.offsets.items(), key=lambda item: item[1][0])}
+
+
+def read_line(fin, offset: int) -> bytes:
+    fin.seek(offset)
+    return fin.readline()
+
+
+def select_items(sizes: List[int], part, seed: int = 0):
+    """Writes a random selection of sample size questions of the corpus for every sample size.
+
+    The txt and the json file are read once for all sizes and the smaller selections are subsets of the larger ones.
+    """
     txt_file_in = f"created_corpus/filtered_{part}_de_extended.txt"
     json_file_in = f"created_corpus/filtered_{part}_minus_first_doc_de.json"
-    txt_file_out = f"created_corpus/selection_{n}_{part}_de.txt"
-    json_file_out = f"created_corpus/selection_{n}_{part}_doc_de.json"
-
-    with open(txt_file_in) as fin:
-        for i, _ in enumerate(fin):
-            pass
-        length = i + 1
-
-    indices = random.sample(range(length), k=n)
-    print(indices)
-    print(len(indices))
-    print("only unique ", len(indices) == len(set(indices)))
-    questions = {}
-    counter = 0
-    with open(txt_file_in) as fin:
-        with open(txt_file_out, "w") as fout:
-            for i, line in enumerate(fin):
-                if i in indices:
-                    current = json.loads(line)
-                    if current["question"] in questions:
-                        print(current["question"])
+
+    txt_sample = QuestionReservoir(max(sizes), seed)
+    for offset, line in iter_lines(txt_file_in):
+        txt_sample.add(json.loads(line)["question"], offset)
+    # the lines of the json file are matched by question, the last line of a question is used
+    json_offsets = {question: None for question in txt_sample.offsets}
+    for offset, line in iter_lines(json_file_in):
+        question = json.loads(line)[0]["question"]
+        if question in json_offsets:
+            json_offsets[question] = offset
+
+    with open(txt_file_in, "rb") as ftxt, open(json_file_in, "rb") as fjson:
+        for n in sizes:
+            questions = txt_sample.sample(n)
+            print(f"selection {n}: {len(questions)} questions")
+            with open(f"created_corpus/selection_{n}_{part}_de.txt", "wb") as ftxt_out, \
+                    open(f"created_corpus/selection_{n}_{part}_doc_de.json", "wb") as fjson_out:
+                # in the order of the corpus
+                for i, question in enumerate(sorted(questions, key=questions.get)):
+                    ftxt_out.write(read_line(ftxt, questions[question]))
+                    if json_offsets[question] is not None:
+                        fjson_out.write(read_line(fjson, json_offsets[question]))
+                    else:
                         print(i)
-                        print(questions[current["question"]])
-                        continue
-                    fout.write(line)
-                    questions[current["question"]] = (counter, i)
-                    counter += 1
-    print("questions", len(questions))
-    lines = [None for _ in range(n)]
-    print("lines ", len(lines))
-    print("counter ", counter)
-    with open(json_file_in) as fin:
-        for line in fin:
-            current = json.loads(line)
-            question = current[0]["question"]
-            if question in questions:
-                idx = questions[question][0]
-                if idx >= len(lines):
-                    print(idx)
-                lines[idx] = line
-
-    with open(json_file_out, "w") as fout:
-        for i, line in enumerate(lines):
-            if line:
-                fout.write(line)
-            else:
-                print(i)
 
 
 if __name__ == "__main__":
@@ -322,6 +349,5 @@ if __name__ == "__main__":
         add_article_title_as_answer(path, current_part)
         print("select items")
         if current_part == "train":
-            for sample_size in [500, 1000, 5000]:
-                select_items(sample_size, current_part)
-        # select_items(5000, current_part)
+            select_items([500, 1000, 5000], current_part)
+        # select_items([5000], current_part)
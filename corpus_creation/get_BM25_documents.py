@@ -1,11 +1,15 @@
-from bz2 import BZ2File
+import argparse
 import json
-import xml.etree.ElementTree as etree
+import os
+from os.path import join
 
 from nltk.tokenize import word_tokenize
-from rank_bm25 import BM25Okapi
+import numpy as np
 from tqdm import tqdm
-from wiki_dump_reader import Cleaner, iterate
+
+from bm25 import BM25, INDEX_VERSION
+from dump_bm25 import build_dump_shards, read_shard_page, search_shards
+from segmented_bm25 import SegmentedBM25
 
 
 class Article(object):
@@ -39,77 +43,25 @@ def clean_article(text: str):
     return text
 
 
-def get_10_closest_docs(infile, queries):
-    closest = {query: {} for query in queries}
-    # cleaner = Cleaner()
-    # for title, text in iterate(infile):
-    #     text = cleaner.clean_text(text)
-    #     cleaned_text, _ = cleaner.build_links(text)
-    #     print(cleaned_text)
-    #     return
-
-    def strip_tag_name(t):
-        """From https://www.heatonresearch.com/2017/03/03/python-basic-wikipedia-parsing.html"""
-        t = elem.tag
-        idx = t.rfind("}")
-        if idx != -1:
-            t = t[idx + 1:]
-        return t
-
-    page_count = 0
-    collected_articles = []
-    with BZ2File(infile, "rb") as bzfin:
-        for event, elem in tqdm(etree.iterparse(bzfin, events=('start', 'end'))):
-            tag_name = strip_tag_name(elem.tag)
-            # print(tag_name)
-
-            if event == 'start':
-                if tag_name == 'page':
-                    title = ''
-                    id = -1
-                    in_revision = False
-                    ns = 0
-                elif tag_name == 'revision':
-                    # Do not pick up on revision id's
-                    in_revision = True
-            else:
-                if tag_name == 'title':
-                    title = elem.text
-                elif tag_name == 'id' and not in_revision:
-                    id = int(elem.text)
-                elif tag_name == "text":
-                    article = elem.text
-                    if not isinstance(article, str):
-                        print("article ", article)
-                        print("title ", title)
-                        print(elem)
-                        continue
-                    collected_articles.append(Article(title, id, article, word_tokenize(article, "german")))
-                elif tag_name == 'page':
-                    page_count += 1
-                    if page_count > 0 and page_count % 1000 == 0:  # change to 1000?
-                        bm25 = BM25Okapi([art.word_list for art in collected_articles])
-                        for query in closest:
-                            if closest[query]:
-                                minimal_score = min(closest[query])
-                            else:
-                                minimal_score = -1
-                            # print(minimal_score)
-                            doc_scores = bm25.get_scores(query)
-                            # print(doc_scores)
-                            for idx, score in enumerate(doc_scores):
-                                if score >= minimal_score:
-                                    closest[query][score] = collected_articles[idx]
-                            # prune score dict again
-                            if (len(closest[query])) > 10:
-                                tenth_best_score = sorted(closest[query].keys(), reverse=True)[9]
-                                for score in list(closest[query].keys()):
-                                    if score < tenth_best_score:
-                                        closest[query].pop(score)
-                        collected_articles = []
-                        save_closest("tmp_train.txt", closest)
-                        print("page_count ", page_count)
-                elem.clear()
+def get_10_closest_docs(infile, queries, work_dir="dump_shards", processes=None, index_file=None, resume=False):
+    """Returns the 10 articles of a dump with the highest BM25 score as {query: [(score, article)]}, best first
+
+    The dump is indexed in shards in work_dir, which are reused for the same dump. The streams of a multistream dump
+    are decompressed in parallel if its offset index is found, see wiki_dump.iter_dump_pages. Indexing and search
+    write checkpoints to work_dir that are continued from with resume.
+    """
+    shard_dirs = build_dump_shards(infile, work_dir, processes=processes, index_file=index_file, resume=resume)
+    top_ks = search_shards(shard_dirs, queries, 10, processes, checkpoint_file=join(work_dir, "search_checkpoint.npz"),
+                           resume=resume)
+    closest = {}
+    articles = {}  # an article retrieved for several queries is only read once
+    for query, top_k in zip(queries, top_ks):
+        closest[query] = []
+        for score, shard, position in top_k:
+            if (shard, position) not in articles:
+                page = read_shard_page(shard_dirs[shard], position)
+                articles[shard, position] = Article(page["title"], page["id"], page["text"], [])
+            closest[query].append((score, articles[shard, position]))
     return closest
 
 
@@ -128,41 +80,157 @@ def save_closest(filename: str, closest: dict):
             fout.write("\n")
 
 
-def get_10_closest_from_corpus(infile, queries):
-    # load docs
-    collected_articles = []
+def parse_single_doc(json_object):
+    """Returns (document id, text) of a line of a filtered_*_single_doc_de.json file"""
+    # [{"id": [0, 0],
+    #   "question": "Der halluzinogene Pilz <Query> \"\" wurde erstmals in einem tropischen Regenwald in der
+    #   Region Uxpanapa in Veracruz im Südosten Mexikos entdeckt.",
+    #   "document": "page does not exist", "document_id": "Psilocybe naematoliformis"}]
+    return json_object[0]["document_id"], json_object[0]["document"]
+
+
+def get_10_closest_from_corpus(infile, queries, index_dir=None, method="exhaustive"):
+    bm25 = open_corpus_index(infile, parse_single_doc, index_dir)
+    return get_closest(bm25, queries, lambda idx: read_article(infile, bm25.doc_offsets[idx], parse_single_doc),
+                       method=method)
+
+
+def sweep_parameters(infile, queries, k1_values, b_values, ks=(1, 5, 10), index_dir=None,
+                     parse_document=parse_single_doc):
+    """Returns the recall@k of the gold article for every (k1, b) as {(k1, b): {k: recall}}
+
+    The gold article of a query is the document id (the target title) of the same line of the corpus. The corpus is
+    tokenized and indexed once, only the weights are recomputed for every setting, see BM25.top_k_grid.
+    """
+    bm25 = open_corpus_index(infile, parse_document, index_dir)
     with open(infile) as fin:
-        for line in tqdm(fin):
-            json_object = json.loads(line.strip())
-            # [{"id": [0, 0],
-            #   "question": "Der halluzinogene Pilz <Query> \"\" wurde erstmals in einem tropischen Regenwald in der
-            #   Region Uxpanapa in Veracruz im Südosten Mexikos entdeckt.",
-            #   "document": "page does not exist", "document_id": "Psilocybe naematoliformis"}]
-            doc = json_object[0]["document"]
-            doc_id = json_object[0]["document_id"]
-            collected_articles.append(Article(doc_id, doc_id, doc, word_tokenize(doc, "german")))
-
-    # compute bm25
-    corpus = [art.word_list for art in collected_articles]
-    bm25 = BM25Okapi(corpus)
+        gold_ids = [parse_document(json.loads(line))[0] for line in fin]
+    if len(gold_ids) != len(queries):
+        raise ValueError(f"{len(queries)} queries but {len(gold_ids)} documents in {infile}")
+
+    parameters = [(k1, b) for k1 in k1_values for b in b_values]
+    recalls = {}
+    for parameter, top_ks in bm25.top_k_grid(queries, parameters, max(ks)).items():
+        recalls[parameter] = {}
+        for k in ks:
+            found = sum(any(gold_ids[idx] == gold_id for _, idx in top_k[:k])
+                        for gold_id, top_k in zip(gold_ids, top_ks))
+            recalls[parameter][k] = found / len(queries)
+    return recalls
+
+
+def print_recalls(recalls):
+    ks = next(iter(recalls.values())).keys()
+    print("\t".join(["k1", "b"] + [f"recall@{k}" for k in ks]))
+    for (k1, b), current in recalls.items():
+        print("\t".join([str(k1), str(b)] + [f"{recall:.4f}" for recall in current.values()]))
+
+
+def open_corpus_index(infile, parse_document, index_dir=None):
+    """Opens the BM25 index of a json lines corpus, it is built first if it is missing or older than the corpus
+
+    Args:
+        parse_document: function returning (document id, text) for a parsed line of the corpus
+        index_dir: directory of the index, <infile>.bm25 by default
+    """
+    index_dir = index_dir or f"{infile}.bm25"
+    stat = os.stat(infile)
+    source = {"source": os.path.abspath(infile), "source_size": stat.st_size, "source_mtime": stat.st_mtime_ns}
+    if os.path.exists(join(index_dir, "meta.json")):
+        bm25 = BM25.load(index_dir)
+        if bm25.meta["version"] == INDEX_VERSION and all(bm25.meta.get(key) == value for key, value in source.items()):
+            return bm25
+        print("index outdated ", index_dir)
+
+    doc_offsets = []
+
+    def tokenized_documents():
+        with open(infile, "rb") as fin:
+            offset = 0
+            for line in tqdm(fin):
+                doc_offsets.append(offset)
+                offset += len(line)
+                _, text = parse_document(json.loads(line))
+                yield word_tokenize(text, "german")
+
+    BM25.from_corpus(tokenized_documents()).save(index_dir, np.array(doc_offsets, dtype=np.int64), source)
     print("corpus indexed")
+    return BM25.load(index_dir)
 
-    closest = {query: [] for query in queries}
-    for query in tqdm(queries):
-        doc_scores = bm25.get_scores(query)
-        tenth_best_score = sorted(doc_scores, reverse=True)[9]
-        for idx, score in enumerate(doc_scores):
-            if score >= tenth_best_score:
-                closest[query].append((score, collected_articles[idx]))
-        if len(closest[query]) < 10:
-            print("Not enough closest queries")
-            raise RuntimeError
+
+def read_article(infile, offset, parse_document):
+    """Reads the article starting at a byte offset of a json lines corpus"""
+    with open(infile, "rb") as fin:
+        fin.seek(offset)
+        doc_id, text = parse_document(json.loads(fin.readline()))
+    return Article(doc_id, doc_id, text, [])
+
+
+def update_segmented_index(infile, parse_document, index_dir=None) -> SegmentedBM25:
+    """Opens the segmented index of a json lines corpus and indexes the documents that changed since the last update
+
+    A document is identified by its id and the number of previous documents with that id, so repeated documents are
+    indexed repeatedly like in open_corpus_index.
+
+    Args:
+        parse_document: function returning (document id, text) for a parsed line of the corpus
+        index_dir: directory of the index, <infile>.segments by default
+    """
+    index = SegmentedBM25(index_dir or f"{infile}.segments")
+    documents = {}
+    occurrences = {}
+    with open(infile) as fin:
+        for line in tqdm(fin):
+            doc_id, text = parse_document(json.loads(line))
+            occurrences[doc_id] = occurrences.get(doc_id, 0) + 1
+            documents[f"{occurrences[doc_id] - 1}\t{doc_id}"] = text
+    index.synchronize(documents)
+    return index
+
+
+def read_segment_article(index: SegmentedBM25, key: str):
+    doc_id = key.split("\t", 1)[1]
+    return Article(doc_id, doc_id, index.get_text(key), [])
+
+
+def get_closest(bm25, queries, get_article, k=10, method="exhaustive"):
+    """Returns the k articles with the highest BM25 score as {query: [(score, article)]}, best first
+
+    Args:
+        bm25: BM25 or SegmentedBM25 index
+        get_article: function returning the article for a document index of BM25 or a key of SegmentedBM25
+        method: "exhaustive" or "wand", which skips documents that cannot be among the k best, see BM25.top_k
+    """
+    if bm25.corpus_size < k:
+        print("Not enough closest queries")
+        raise RuntimeError
+
+    closest = {}
+    articles = {}  # an article retrieved for several queries is only read once
+    for query, top_k in zip(queries, bm25.top_k(queries, k, method=method)):
+        closest[query] = []
+        for score, idx in top_k:
+            if idx not in articles:
+                articles[idx] = get_article(idx)
+            closest[query].append((score, articles[idx]))
     return closest
 
 
 if __name__ == "__main__":
-    #part = "dev"
-    part = "train"
+    parser = argparse.ArgumentParser(description="Retrieve the 10 closest documents of every question with BM25")
+    parser.add_argument("--part", default="train")
+    parser.add_argument("--dump", action="store_true", help="retrieve from the Wikipedia dump instead of the corpus")
+    parser.add_argument("--work_dir", default="dump_shards", help="directory of the dump index and checkpoints")
+    parser.add_argument("--resume", action="store_true", help="continue the dump retrieval from its last checkpoint")
+    parser.add_argument("--method", default="exhaustive", choices=["exhaustive", "wand"],
+                        help="wand skips documents that cannot be among the 10 closest, with the same result")
+    parser.add_argument("--sweep", action="store_true",
+                        help="report the recall@k of the gold article for all combinations of --k1 and --b")
+    parser.add_argument("--k1", type=float, nargs="+", default=[0.9, 1.2, 1.5, 2.0])
+    parser.add_argument("--b", type=float, nargs="+", default=[0.3, 0.5, 0.75, 0.9])
+    parser.add_argument("--recall_at", type=int, nargs="+", default=[1, 5, 10])
+    args = parser.parse_args()
+    part = args.part
     outfile = f"updated_{part}_BM25_documents.json"
     # wiki_file = "/home/ca/wikipedia_de/dewiki-20200620-pages-meta-current1.xml-p1p262468.bz2"
     wiki_file = "/home/ca/wikipedia_de/dewiki-20200620-pages-articles-multistream.xml.bz2"
@@ -170,6 +238,11 @@ if __name__ == "__main__":
     # doc_file = f"{part}_doc_de.json"
     doc_file = f"created_corpus/filtered_{part}_single_doc_de.json"
     queries = get_queries(query_file)
-    # data = get_10_closest_docs(wiki_file, queries)
-    data = get_10_closest_from_corpus(doc_file, queries)
-    save_closest(outfile, data)
+    if args.sweep:
+        print_recalls(sweep_parameters(doc_file, queries, args.k1, args.b, args.recall_at))
+    else:
+        if args.dump:
+            data = get_10_closest_docs(wiki_file, queries, args.work_dir, resume=args.resume)
+        else:
+            data = get_10_closest_from_corpus(doc_file, queries, method=args.method)
+        save_closest(outfile, data)
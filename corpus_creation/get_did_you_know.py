@@ -1,16 +1,18 @@
+import argparse
 import html
 import json
 import os
 from os.path import join
 import re
 
-from rank_bm25 import BM25Okapi
-from nltk.tokenize import word_tokenize
 from tqdm import tqdm
 import wikipediaapi
 
 # from get_wiki_articles import get_target_article
-from get_BM25_documents import get_queries, save_closest, Article
+from article_store import ArticleStore
+from page_cache import PageCache
+from wiki_fetcher import WikiFetcher, count_written, skip_written
+from get_BM25_documents import get_closest, get_queries, read_segment_article, save_closest, update_segmented_index
 from format_corpus import check_answer_in_doc, add_additional_docs, remove_first_paragraph, filter_without_document, \
     add_article_title_as_answer
 
@@ -80,22 +82,37 @@ class DummyPage(wikipediaapi.WikipediaPage):
         return False
 
 
-def get_target_article(infile, outfile):
+def get_target_article(infile, outfile, store_dir=None, resume=False, concurrency=8, rate=20.0, cache_dir=None):
+    """Adds the text and categories of the target articles in the order of the questions.
+
+    The articles are read from the article store in store_dir if it is given, otherwise they are fetched from the
+    Wikipedia API with concurrency requests in flight and at most rate requests per second, the responses are cached
+    in cache_dir if it is given. With resume the questions already in outfile are skipped.
+    """
     items = []
     with open(infile) as fin:
         for line in fin:
             items.append(json.loads(line))
+    if resume:
+        written = count_written(outfile, lambda line: json.loads(line)["question"])
+        items = skip_written(items, [item["question"] for item in items], written)
 
     # wiki_en = wikipediaapi.Wikipedia('en')
-    wiki_de = wikipediaapi.Wikipedia('de')
-    with open(outfile, "w") as fout:
+    titles = [item["target_title"] or item["answers"] for item in items if item["target_title"] or item["answers"]]
+    if store_dir is None:
+        wiki_de = WikiFetcher('de', concurrency, rate, cache=PageCache(cache_dir) if cache_dir else None)
+        pages = wiki_de.iter_pages(titles, ("extracts", "categories"))
+    else:
+        wiki_de = ArticleStore(store_dir)
+        pages = map(wiki_de.page, titles)
+    with wiki_de, open(outfile, "a" if resume else "w") as fout:
         for item in tqdm(items):
             # if i < 155:
             #     continue
             if item["target_title"]:
-                page = wiki_de.page(item["target_title"])
+                page = next(pages)
             elif item["answers"]:
-                page = wiki_de.page(item["answers"])
+                page = next(pages)
                 item["target_title"] = item["answers"]
             else:
                 page = DummyPage()
@@ -110,32 +127,15 @@ def get_target_article(infile, outfile):
             fout.flush()
 
 
-def get_10_closest_from_corpus(infile, queries):
-    # load docs
-    collected_articles = []
-    with open(infile) as fin:
-        for line in tqdm(fin):
-            json_object = json.loads(line.strip())
-            doc = json_object["target_text"]
-            doc_id = json_object["target_title"]
-            collected_articles.append(Article(doc_id, doc_id, doc, word_tokenize(doc, "german")))
-
-    # compute bm25
-    corpus = [art.word_list for art in collected_articles]
-    bm25 = BM25Okapi(corpus)
-    print("corpus indexed")
-
-    closest = {query: [] for query in queries}
-    for query in tqdm(queries):
-        doc_scores = bm25.get_scores(query)
-        tenth_best_score = sorted(doc_scores, reverse=True)[9]
-        for idx, score in enumerate(doc_scores):
-            if score >= tenth_best_score:
-                closest[query].append((score, collected_articles[idx]))
-        if len(closest[query]) < 10:
-            print("Not enough closest queries")
-            raise RuntimeError
-    return closest
+def parse_target_article(json_object):
+    """Returns (document id, text) of a line of the single document file written by get_target_article"""
+    return json_object["target_title"], json_object["target_text"]
+
+
+def get_10_closest_from_corpus(infile, queries, index_dir=None):
+    # only new and changed target articles are indexed when questions are added or the articles are refreshed
+    with update_segmented_index(infile, parse_target_article, index_dir) as index:
+        return get_closest(index, queries, lambda key: read_segment_article(index, key))
 
 
 def format_html_umlauts(path, part):
@@ -170,12 +170,25 @@ def unescape(text: str):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Create the corpus of the did you know questions")
+    parser.add_argument("--offline", action="store_true",
+                        help="read the target articles from the article store instead of the Wikipedia API. "
+                             "The texts have the format of the API extracts but miss the text generated by "
+                             "templates, so offline and online corpora should not be mixed")
+    parser.add_argument("--store_dir", default="article_store", help="built from the dump with article_store.py")
+    parser.add_argument("--resume", action="store_true", help="skip the questions that are already in the output")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of API requests in flight")
+    parser.add_argument("--rate", type=float, default=20.0, help="maximal number of API requests per second")
+    parser.add_argument("--cache_dir", default="wiki_cache", help="cache of the API responses, disabled if empty")
+    args = parser.parse_args()
+    store_dir = args.store_dir if args.offline else None
     # data = read_did_you_know("did_you_know")
     path = "created_corpus_orig"
     dev_txt_file = join(path, "ori.txt")
     single_doc_file = f"created_corpus_orig/ori_single_doc_de.json"
     # save_questions_json(join(path, "saved_questions.json"), data)
-    # get_target_article(join(path, "saved_questions.json"), single_doc_file)
+    # get_target_article(join(path, "saved_questions.json"), single_doc_file, store_dir, args.resume, args.concurrency,
+    #                    args.rate, args.cache_dir)
     # save_dev_txt(dev_txt_file, data)
     # get other articles
     outfile = join(path, "corpus_ori_BM25_documents.json")
@@ -1,8 +1,13 @@
+import argparse
 from ast import literal_eval
 import json
 
 from tqdm import tqdm
-import wikipediaapi
+
+from article_store import ArticleStore
+from title_resolver import TitleResolver
+from page_cache import PageCache
+from wiki_fetcher import WikiFetcher, count_written, skip_written
 
 
 class Article(object):
@@ -35,20 +40,45 @@ def get_answers(filename):
     return answers
 
 
-def get_original_articles(answers, part, target_language="de"):
-    wiki_en = wikipediaapi.Wikipedia('en')
+def get_original_articles(answers, part, target_language="de", resolver_dir=None, resume=False, concurrency=8,
+                          rate=20.0, cache_dir=None):
+    """Writes the English and the target language article of every answer set to {part}_url_map.tsv
+
+    The articles are looked up with the title resolver in resolver_dir if it is given, otherwise they are fetched from
+    the Wikipedia API with concurrency requests in flight and at most rate requests per second, the responses are
+    cached in cache_dir if it is given. With resume the answer sets already in the url map are skipped.
+    """
+    outfile = f"{part}_url_map.tsv"
+    answer_sets = list(answers)
+    if resume:
+        written = count_written(outfile, lambda line: line.split("\t")[0])
+        answer_sets = skip_written(answer_sets, [answers[answer_set] for answer_set in answer_sets], written)
+    fetcher = None
+    if resolver_dir is None:
+        fetcher = WikiFetcher('en', concurrency, rate, cache=PageCache(cache_dir) if cache_dir else None)
+        # every answer option is looked up once in the order of the loop below
+        pages = fetcher.iter_pages([answer_option for answer_set in answer_sets for answer_option in answer_set],
+                                   ("info", "langlinks"))
+        get_page = lambda answer_option: next(pages)
+    else:
+        resolver = TitleResolver(resolver_dir)
+        if resolver.target_language != target_language:
+            raise ValueError(f"the title resolver has the language links to {resolver.target_language}")
+        # all answer options are resolved in one batch
+        options = list({answer_option for answer_set in answer_sets for answer_option in answer_set})
+        get_page = dict(zip(options, resolver.pages(options))).__getitem__
     url_map = {}
     translation_map = {}
     not_found_pages = []
 
-    with open(f"{part}_url_map.tsv", "w") as url_file:
-        for answer_set in tqdm(answers):
+    with open(outfile, "a" if resume else "w") as url_file:
+        for answer_set in tqdm(answer_sets):
             found = False
             target_page = None
             source_page = None
             old_source_page = None
             for answer_option in answer_set:
-                source_page = wiki_en.page(answer_option)
+                source_page = get_page(answer_option)
                 if source_page.exists():
                     found = True
                     old_source_page = source_page
@@ -79,9 +109,12 @@ def get_original_articles(answers, part, target_language="de"):
             url_file.flush()
             if not found:
                 not_found_pages.append(answer_set)
-    print(f"{len(answers)} pages processed")
-    print(f"{len(url_map)} pages found in English Wikipedia: {len(url_map) / len(answers)}")
-    print(f"{len(translation_map)} pages found in German Wikipedia: {len(translation_map) / len(answers)}")
+    if fetcher is not None:
+        fetcher.close()
+    processed = max(len(answer_sets), 1)
+    print(f"{len(answer_sets)} pages processed")
+    print(f"{len(url_map)} pages found in English Wikipedia: {len(url_map) / processed}")
+    print(f"{len(translation_map)} pages found in German Wikipedia: {len(translation_map) / processed}")
     print(f"Not found pages {not_found_pages}")
 
 
@@ -95,11 +128,26 @@ def read_url_map(filename):
     return urls
 
 
-def get_target_article(infile, outfile):
+def get_target_article(infile, outfile, store_dir=None, resume=False, concurrency=8, rate=20.0, cache_dir=None):
+    """Writes the German target articles of the url map in its order.
+
+    The articles are read from the article store in store_dir if it is given, otherwise they are fetched from the
+    Wikipedia API with concurrency requests in flight and at most rate requests per second, the responses are cached
+    in cache_dir if it is given. With resume the questions already in outfile are skipped.
+    """
     urls = read_url_map(infile)
+    if resume:
+        written = count_written(outfile, lambda line: json.loads(line)["question"])
+        urls = skip_written(urls, [url.question for url in urls], written)
     # wiki_en = wikipediaapi.Wikipedia('en')
-    wiki_de = wikipediaapi.Wikipedia('de')
-    with open(outfile, "w") as fout:
+    titles = [url.target_title for url in urls if url.target_title != "None"]
+    if store_dir is None:
+        wiki_de = WikiFetcher('de', concurrency, rate, cache=PageCache(cache_dir) if cache_dir else None)
+        pages = wiki_de.iter_pages(titles, ("extracts", "categories"))
+    else:
+        wiki_de = ArticleStore(store_dir)
+        pages = map(wiki_de.page, titles)
+    with wiki_de, open(outfile, "a" if resume else "w") as fout:
         for url in tqdm(urls):
             current_json = {"question": url.question,
                             "answers": url.answers,
@@ -111,7 +159,7 @@ def get_target_article(infile, outfile):
                 current_json["target_text"] = "page does not exist"
                 current_json["categories"] = "page does not exist"
             else:
-                page = wiki_de.page(url.target_title)
+                page = next(pages)
                 if page.exists():
                     current_json["target_text"] = page.text
                     current_json["categories"] = [x.title() for x in page.categories]
@@ -125,15 +173,31 @@ def get_target_article(infile, outfile):
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Get the Wikipedia articles of the XQA questions")
+    parser.add_argument("--offline", action="store_true",
+                        help="use the title resolver and the article store instead of the Wikipedia API. "
+                             "The texts have the format of the API extracts but miss the text generated by "
+                             "templates, so offline and online corpora should not be mixed")
+    parser.add_argument("--resolver_dir", default="title_resolver",
+                        help="built from the English SQL dumps with title_resolver.py")
+    parser.add_argument("--store_dir", default="article_store", help="built from the dump with article_store.py")
+    parser.add_argument("--resume", action="store_true", help="skip the questions that are already in the output")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of API requests in flight")
+    parser.add_argument("--rate", type=float, default=20.0, help="maximal number of API requests per second")
+    parser.add_argument("--cache_dir", default="wiki_cache", help="cache of the API responses, disabled if empty")
+    args = parser.parse_args()
+    resolver_dir = args.resolver_dir if args.offline else None
+    store_dir = args.store_dir if args.offline else None
     # part = "train_tail"
     # corpus = f"/home/ca/Documents/Uni/Masterarbeit/data/XQA_original/en/{part}.txt"
     #
     # answers = get_answers(corpus)
     # print(len(answers))
-    # get_original_articles(answers, part)
+    # get_original_articles(answers, part, resolver_dir=resolver_dir, resume=args.resume,
+    #                       concurrency=args.concurrency, rate=args.rate, cache_dir=args.cache_dir)
     # infile = "/home/ca/Documents/Uni/Masterarbeit/crosslingual-qa-scripts/corpus_creation/2020_06_09/full_train_url_map_2.tsv"
     # outfile = "/home/ca/Documents/Uni/Masterarbeit/crosslingual-qa-scripts/corpus_creation/train_urls.json"
-    # get_target_article(infile, outfile)
+    # get_target_article(infile, outfile, store_dir, args.resume, args.concurrency, args.rate, args.cache_dir)
     pass
 
 
@@ -0,0 +1,99 @@
+"""
+Persistent cache of the Wikipedia API responses of page lookups
+"""
+
+import json
+import os
+import sqlite3
+import time
+import zlib
+from typing import Dict
+
+from wiki_dump import normalize_title
+
+
+# responses older than this are fetched again
+CACHE_TTL = 30 * 24 * 3600
+# size of the compressed responses in bytes the cache is kept below
+CACHE_SIZE = 2 << 30
+
+
+def page_key(language: str, title: str) -> str:
+    return f"{language}:{normalize_title(title)}"
+
+
+class PageCache(object):
+    """API responses of pages stored in an sqlite database, keyed by language and normalized title.
+
+    A page has one response per call like "extracts" or "langlinks", which are compressed together. Responses older
+    than ttl seconds are ignored and the least recently used pages are evicted when the cache exceeds max_size bytes.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float = CACHE_TTL, max_size: int = CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.filename = os.path.join(cache_dir, "wikipedia_pages.sqlite")
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        # every lookup updates the time of use, which is cheap with a write-ahead log
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS pages "
+                                    "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS pages_used ON pages (used)")
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, language: str, title: str) -> Dict[str, Dict]:
+        """Returns {call: response} of the responses of a page that are not expired"""
+        key = page_key(language, title)
+        row = self.connection.execute("SELECT value FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return {}
+        now = time.time()
+        responses = {call: stored["response"] for call, stored in json.loads(zlib.decompress(row[0])).items()
+                     if now - stored["time"] < self.ttl}
+        with self.connection:
+            self.connection.execute("UPDATE pages SET used = ? WHERE key = ?", (now, key))
+        if responses:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return responses
+
+    def put(self, language: str, title: str, responses: Dict[str, Dict]):
+        """Stores new responses of a page next to its other responses that are not expired"""
+        key = page_key(language, title)
+        now = time.time()
+        stored = {}
+        row = self.connection.execute("SELECT value, size FROM pages WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            stored = {call: value for call, value in json.loads(zlib.decompress(row[0])).items()
+                      if now - value["time"] < self.ttl}
+            self.size -= row[1]
+        stored.update((call, {"time": now, "response": response}) for call, response in responses.items())
+        value = zlib.compress(json.dumps(stored, ensure_ascii=False).encode("utf-8"))
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)", (key, value, len(value), now))
+        self.size += len(value)
+        if self.size > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        # a tenth more than necessary is evicted, so not every following put evicts again
+        excess = self.size - self.max_size * 0.9
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM pages ORDER BY used"):
+            if excess <= 0:
+                break
+            keys.append(key)
+            excess -= size
+            self.size -= size
+        with self.connection:
+            self.connection.executemany("DELETE FROM pages WHERE key = ?", ((key,) for key in keys))
+
+    def close(self):
+        self.connection.close()
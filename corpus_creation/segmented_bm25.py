@@ -0,0 +1,475 @@
+"""
+Incremental BM25 index of immutable segments with tombstones and background merging of small segments
+"""
+
+import hashlib
+import json
+import math
+import os
+from os.path import join
+import shutil
+import threading
+from typing import Iterable, List, Mapping, Optional, Sequence, Tuple
+
+from nltk.tokenize import word_tokenize
+import numpy as np
+from scipy import sparse
+
+from bm25 import BM25, INDEX_VERSION, top_k_rows
+from dump_bm25 import save_json_atomic
+
+
+def tokenize_german(text: str) -> List[str]:
+    return word_tokenize(text, "german")
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Segment(object):
+    """Immutable part of a SegmentedBM25: a BM25 index with the keys, text hashes and texts of its documents.
+
+    Only the term frequencies and document lengths of the index are used for scoring, its weights depend on the
+    statistics of the segment alone.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.bm25 = BM25.load(directory)
+        with open(join(directory, "keys.json")) as fin:
+            saved = json.load(fin)
+        self.keys = saved["keys"]
+        self.hashes = saved["hashes"]
+        self.terms = [self.bm25.vocabulary[term] for term in range(len(self.bm25.vocabulary))]
+        # ids of the terms in the vocabulary of all segments, see SegmentedBM25._update_statistics
+        self.term_ids = None
+        # key of the statistics the cached weights are computed with and {term: weights of its postings}
+        self.statistics = None
+        self._weights = {}
+        self._live = None
+
+    @property
+    def size(self):
+        return len(self.keys)
+
+    def live_doc_freqs(self, deleted: np.ndarray) -> np.ndarray:
+        """Returns the document frequency of every term without the deleted documents"""
+        if not deleted.any() or not len(self.bm25.postings):
+            return np.asarray(self.bm25.doc_freqs)
+        return self.bm25.doc_freqs - np.add.reduceat(deleted[self.bm25.postings], self.bm25.indptr[:-1])
+
+    def live_statistics(self, deleted: np.ndarray) -> Tuple[np.ndarray, int]:
+        """Returns the document frequencies of the terms and the total length of the live documents.
+
+        Tombstones are only added, so the number of deleted documents identifies the mask and the result is cached.
+        """
+        num_deleted = int(deleted.sum())
+        if self._live is None or self._live[0] != num_deleted:
+            total_length = int(self.bm25.doc_len.sum()) - int(self.bm25.doc_len[deleted].sum())
+            self._live = (num_deleted, self.live_doc_freqs(deleted), total_length)
+        return self._live[1], self._live[2]
+
+    def query_index(self, words: Iterable[str], statistics: "CorpusStatistics") -> BM25:
+        """Returns the index of the segment restricted to the words, weighted with the statistics of all segments.
+
+        The weights of a term are computed from its term frequencies and document lengths when it is first queried
+        and kept until the statistics change. The terms keep their order, so the scores equal the ones of the whole
+        index with these statistics.
+        """
+        bm25 = self.bm25
+        if self.statistics != statistics.key:
+            self._weights = {}
+            self.statistics = statistics.key
+        terms = sorted({term for term in map(bm25.vocabulary.get, words) if term is not None})
+        idf = statistics.idf([self.terms[term] for term in terms])
+        for term, term_idf in zip(terms, idf):
+            if term not in self._weights:
+                start, end = bm25.indptr[term], bm25.indptr[term + 1]
+                tf = np.asarray(bm25.freqs[start:end], dtype=np.float64)
+                doc_len = bm25.doc_len[bm25.postings[start:end]]
+                self._weights[term] = (term_idf * (tf * (bm25.k1 + 1) / (
+                    tf + bm25.k1 * (1 - bm25.b + bm25.b * doc_len / statistics.avgdl)))).astype(bm25.dtype)
+        positions, row_ptr = bm25.term_positions(terms)
+        index = BM25({self.terms[term]: i for i, term in enumerate(terms)}, row_ptr, bm25.postings[positions],
+                     bm25.freqs[positions], bm25.doc_len, bm25.k1, bm25.b, bm25.epsilon, bm25.dtype,
+                     np.concatenate([self._weights[term] for term in terms] + [np.zeros(0, dtype=bm25.dtype)]))
+        index.idf = idf
+        index.avgdl = statistics.avgdl
+        return index
+
+    def read_lines(self, positions: Iterable[int]) -> Iterable[bytes]:
+        with open(join(self.directory, "docs.jsonl"), "rb") as fin:
+            for position in positions:
+                fin.seek(self.bm25.doc_offsets[position])
+                yield fin.readline()
+
+    def get_text(self, position: int) -> str:
+        return json.loads(next(iter(self.read_lines([position]))))["text"]
+
+
+def write_segment(directory: str, bm25: BM25, keys: Sequence[str], hashes: Sequence[str], lines: Iterable[bytes]):
+    """Writes a segment, lines are the json lines {"key": ..., "text": ...} of its documents in index order"""
+    os.makedirs(directory, exist_ok=True)
+    doc_offsets = []
+    with open(join(directory, "docs.jsonl"), "wb") as fout:
+        for line in lines:
+            doc_offsets.append(fout.tell())
+            fout.write(line)
+    with open(join(directory, "keys.json"), "w") as fout:
+        json.dump({"keys": list(keys), "hashes": list(hashes)}, fout, ensure_ascii=False)
+    # meta.json of the index is written last
+    bm25.save(directory, np.array(doc_offsets, dtype=np.int64))
+
+
+def merge_indexes(segments: Sequence[Segment], deleted: Sequence[np.ndarray], k1: float, b: float, epsilon: float,
+                  dtype) -> Tuple[BM25, List[Tuple[int, int]]]:
+    """Merges the postings of segments without their deleted documents, the documents are not tokenized again.
+
+    Returns the index and the (segment, position) of each of its documents.
+    """
+    vocabulary = {}
+    rows, columns, data, doc_len, sources = [], [], [], [], []
+    for i, (segment, current_deleted) in enumerate(zip(segments, deleted)):
+        bm25 = segment.bm25
+        live = np.flatnonzero(~current_deleted)
+        new_positions = np.full(segment.size, -1, dtype=np.int64)
+        new_positions[live] = np.arange(len(doc_len), len(doc_len) + len(live))
+        term_ids = np.array([vocabulary.setdefault(term, len(vocabulary)) for term in segment.terms], dtype=np.int64)
+        posting_terms = np.repeat(term_ids, bm25.doc_freqs)
+        keep = ~current_deleted[bm25.postings]
+        rows.append(posting_terms[keep])
+        columns.append(new_positions[bm25.postings][keep])
+        data.append(np.asarray(bm25.freqs)[keep])
+        doc_len.extend(np.asarray(bm25.doc_len)[live])
+        sources.extend((i, int(position)) for position in live)
+
+    term_doc = sparse.csr_matrix((np.concatenate(data + [np.zeros(0, dtype=np.int32)]),
+                                  (np.concatenate(rows + [np.zeros(0, dtype=np.int64)]),
+                                   np.concatenate(columns + [np.zeros(0, dtype=np.int64)]))),
+                                 shape=(len(vocabulary), len(doc_len)))
+    term_doc.sort_indices()
+    # terms that only occurred in deleted documents are dropped
+    doc_freqs = np.diff(term_doc.indptr)
+    id_terms = [None] * len(vocabulary)
+    for term, term_id in vocabulary.items():
+        id_terms[term_id] = term
+    kept = np.flatnonzero(doc_freqs)
+    term_doc = term_doc[kept]
+    vocabulary = {id_terms[term_id]: i for i, term_id in enumerate(kept)}
+    bm25 = BM25(vocabulary, term_doc.indptr.astype(np.int64), term_doc.indices.astype(np.int32),
+                term_doc.data.astype(np.int32), np.array(doc_len, dtype=np.int64), k1, b, epsilon, dtype)
+    return bm25, sources
+
+
+class CorpusStatistics(object):
+    """Document frequencies and average length of the live documents of all segments, the idf is the one of
+    rank_bm25.BM25Okapi over them: terms that only occur in deleted documents do not count"""
+
+    def __init__(self, key, term_ids: Mapping[str, int], doc_freqs: np.ndarray, corpus_size: int, total_length: int,
+                 epsilon: float):
+        self.key = key
+        self.term_ids = term_ids
+        self.doc_freqs = doc_freqs
+        self.corpus_size = corpus_size
+        self.avgdl = total_length / corpus_size if corpus_size else 0.0
+        self.epsilon = epsilon
+        freqs = doc_freqs[doc_freqs > 0].astype(np.float64)
+        self.average_idf = (np.log(corpus_size - freqs + 0.5) - np.log(freqs + 0.5)).mean() if len(freqs) else 0.0
+
+    def doc_freq(self, word: str) -> int:
+        term = self.term_ids.get(word)
+        # terms of segments added after these statistics are not counted
+        return int(self.doc_freqs[term]) if term is not None and term < len(self.doc_freqs) else 0
+
+    def idf(self, words: Sequence[str]) -> np.ndarray:
+        freqs = np.array([self.doc_freq(word) for word in words], dtype=np.float64)
+        idf = np.log(self.corpus_size - freqs + 0.5) - np.log(freqs + 0.5)
+        idf[idf < 0] = self.epsilon * self.average_idf
+        idf[freqs == 0] = 0.0
+        return idf
+
+
+class SegmentedBM25(object):
+    """BM25 index that grows by immutable segments, so adding documents only indexes the new documents.
+
+    Documents are identified by string keys. Deleted or replaced documents are marked with tombstones in the manifest
+    and dropped when their segment is merged. Scores use the statistics of all live documents of all segments, like
+    one BM25 index over them. Whenever merge_factor consecutive segments have about the same size, they are merged in
+    a background thread (like the levels of an LSM tree).
+    """
+
+    def __init__(self, directory: str, merge_factor: int = 4, background: bool = True, tokenize=tokenize_german,
+                 k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25, dtype=np.float32):
+        self.directory = directory
+        self.merge_factor = merge_factor
+        self.background = background
+        self.tokenize = tokenize
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.dtype = dtype
+        self._lock = threading.Lock()
+        self._merge_thread = None
+
+        os.makedirs(directory, exist_ok=True)
+        manifest_file = join(directory, "manifest.json")
+        self.manifest = {"version": INDEX_VERSION, "segments": [], "next_segment": 0}
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as fin:
+                self.manifest = json.load(fin)
+        # segments that are not in the manifest are left over from an interrupted write or merge
+        names = {entry["name"] for entry in self.manifest["segments"]}
+        for name in os.listdir(directory):
+            if name.startswith("segment_") and name not in names:
+                shutil.rmtree(join(directory, name))
+
+        self._segments = {name: Segment(join(directory, name)) for name in names}
+        self._locations = {}  # key -> (segment name, position) of the live documents
+        for entry in self.manifest["segments"]:
+            deleted = set(entry["deleted"])
+            for position, key in enumerate(self._segments[entry["name"]].keys):
+                if position not in deleted:
+                    self._locations[key] = (entry["name"], position)
+        # {term: id} of the terms of all segments the statistics were computed for
+        self._term_ids = {}
+        self._statistics = None
+        self._statistics_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Waits for the running merges"""
+        while True:
+            with self._lock:
+                thread = self._merge_thread
+            if thread is None:
+                return
+            thread.join()
+
+    def __contains__(self, key: str):
+        return key in self._locations
+
+    def __len__(self):
+        return len(self._locations)
+
+    @property
+    def corpus_size(self):
+        return len(self._locations)
+
+    def _save_manifest(self):
+        save_json_atomic(join(self.directory, "manifest.json"), self.manifest)
+
+    def _new_segment_name(self) -> str:
+        name = f"segment_{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        return name
+
+    def _delete(self, keys: Iterable[str]):
+        """Adds tombstones for the keys, the caller holds the lock and saves the manifest"""
+        entries = {entry["name"]: entry for entry in self.manifest["segments"]}
+        for key in keys:
+            location = self._locations.pop(key, None)
+            if location is not None:
+                entries[location[0]]["deleted"].append(location[1])
+
+    def add_documents(self, documents: Iterable[Tuple[str, str]]):
+        """Indexes (key, text) pairs as a new segment, documents with the same keys are replaced"""
+        documents = list(dict(documents).items())
+        if not documents:
+            return
+        bm25 = BM25.from_corpus((self.tokenize(text) for _, text in documents), self.k1, self.b, self.epsilon,
+                                self.dtype)
+        with self._lock:
+            name = self._new_segment_name()
+        lines = (json.dumps({"key": key, "text": text}, ensure_ascii=False).encode("utf-8") + b"\n"
+                 for key, text in documents)
+        write_segment(join(self.directory, name), bm25, [key for key, _ in documents],
+                      [text_hash(text) for _, text in documents], lines)
+        segment = Segment(join(self.directory, name))
+        with self._lock:
+            self._delete(key for key, _ in documents)
+            self.manifest["segments"].append({"name": name, "deleted": []})
+            self._segments[name] = segment
+            for position, (key, _) in enumerate(documents):
+                self._locations[key] = (name, position)
+            self._save_manifest()
+        self.maybe_merge()
+
+    def delete_documents(self, keys: Iterable[str]):
+        with self._lock:
+            self._delete(keys)
+            self._save_manifest()
+
+    def synchronize(self, documents: Mapping[str, str]):
+        """Makes the index contain exactly the documents {key: text}, only new and changed texts are indexed"""
+        current = {}
+        with self._lock:
+            for key, (name, position) in self._locations.items():
+                current[key] = self._segments[name].hashes[position]
+        changed = [(key, text) for key, text in documents.items() if current.get(key) != text_hash(text)]
+        removed = [key for key in current if key not in documents]
+        print("adding ", len(changed), " documents, deleting ", len(removed))
+        if removed:
+            self.delete_documents(removed)
+        self.add_documents(changed)
+
+    def get_text(self, key: str) -> str:
+        with self._lock:
+            name, position = self._locations[key]
+            segment = self._segments[name]
+        return segment.get_text(position)
+
+    def _snapshot(self) -> List[Tuple[Segment, np.ndarray]]:
+        """Returns the current segments with their deleted masks"""
+        with self._lock:
+            snapshot = []
+            for entry in self.manifest["segments"]:
+                segment = self._segments[entry["name"]]
+                deleted = np.zeros(segment.size, dtype=bool)
+                deleted[entry["deleted"]] = True
+                snapshot.append((segment, deleted))
+            return snapshot
+
+    def _update_statistics(self, snapshot: List[Tuple[Segment, np.ndarray]]) -> CorpusStatistics:
+        """Returns the statistics of all live documents of the segments.
+
+        Only the document frequencies and lengths of the segments are summed, the weights of the postings are computed
+        for the query terms by Segment.query_index.
+        """
+        key = tuple((segment.directory, int(deleted.sum())) for segment, deleted in snapshot)
+        with self._statistics_lock:
+            if self._statistics is None or self._statistics.key != key:
+                for segment, _ in snapshot:
+                    if segment.term_ids is None:
+                        segment.term_ids = np.array([self._term_ids.setdefault(term, len(self._term_ids))
+                                                     for term in segment.terms], dtype=np.int64)
+                doc_freqs = np.zeros(len(self._term_ids), dtype=np.int64)
+                corpus_size, total_length = 0, 0
+                for segment, deleted in snapshot:
+                    live_doc_freqs, live_length = segment.live_statistics(deleted)
+                    # the terms of a segment are distinct
+                    doc_freqs[segment.term_ids] += live_doc_freqs
+                    corpus_size += len(deleted) - int(deleted.sum())
+                    total_length += live_length
+                self._statistics = CorpusStatistics(key, self._term_ids, doc_freqs, corpus_size, total_length,
+                                                    self.epsilon)
+            return self._statistics
+
+    def top_k(self, queries: Sequence[Sequence[str]], k: int = 10, batch_size: int = 256,
+              method: str = "exhaustive") -> List[List[Tuple[float, str]]]:
+        """Returns the k best (score, key) of every query, equal scores are ordered by the age of the documents
+
+        Args:
+            method: see BM25.top_k, with "wand" every segment returns k more documents than it has tombstones
+        """
+        snapshot = self._snapshot()
+        statistics = self._update_statistics(snapshot)
+        results = []
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            candidates = [[] for _ in batch]
+            for i, (segment, deleted) in enumerate(snapshot):
+                if not segment.size:
+                    continue
+                index = segment.query_index({word for query in batch for word in query}, statistics)
+                if method == "wand":
+                    num_deleted = int(deleted.sum())
+                    top_ks = [[(score, position) for score, position in index.top_k_wand(query, k + num_deleted)
+                               if not deleted[position]] for query in batch]
+                else:
+                    scores = index.get_batch_scores(batch)
+                    scores[:, deleted] = -np.inf
+                    top_ks = top_k_rows(scores, k)
+                for current, top_k in zip(candidates, top_ks):
+                    current.extend((score, i, position) for score, position in top_k[:k] if score != -np.inf)
+            for current in candidates:
+                current.sort(key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+                results.append([(score, snapshot[i][0].keys[position]) for score, i, position in current[:k]])
+        return results
+
+    def _merge_candidates(self) -> Optional[List[str]]:
+        """Returns the newest run of merge_factor consecutive segments of about the same size, the caller holds the lock
+
+        The size tier of a segment is the logarithm of its live documents to the base merge_factor, the tiers of the
+        merged segments differ at most by one, so a document is merged about once per tier.
+        """
+        entries = self.manifest["segments"]
+        tiers = []
+        for entry in entries:
+            live = self._segments[entry["name"]].size - len(entry["deleted"])
+            tiers.append(int(math.log(max(live, 1), self.merge_factor)))
+        for end in range(len(entries), self.merge_factor - 1, -1):
+            window = tiers[end - self.merge_factor:end]
+            if max(window) - min(window) <= 1:
+                return [entry["name"] for entry in entries[end - self.merge_factor:end]]
+        return None
+
+    def maybe_merge(self):
+        """Starts merging segments if there are enough segments of the same size and no merge is running"""
+        with self._lock:
+            if self._merge_thread is not None or self._merge_candidates() is None:
+                return
+            self._merge_thread = threading.Thread(target=self._merge_loop, daemon=False)
+            thread = self._merge_thread
+        if self.background:
+            thread.start()
+        else:
+            thread.run()
+
+    def _merge_loop(self):
+        while True:
+            with self._lock:
+                names = self._merge_candidates()
+                if names is None:
+                    self._merge_thread = None
+                    return
+            self._merge(names)
+
+    def _merge(self, names: List[str]):
+        """Merges consecutive segments into one, tombstones added meanwhile are carried over"""
+        with self._lock:
+            entries = {entry["name"]: entry for entry in self.manifest["segments"]}
+            segments = [self._segments[name] for name in names]
+            deleted_before = [set(entries[name]["deleted"]) for name in names]
+            name = self._new_segment_name()
+        deleted = []
+        for segment, current in zip(segments, deleted_before):
+            mask = np.zeros(segment.size, dtype=bool)
+            mask[list(current)] = True
+            deleted.append(mask)
+
+        bm25, sources = merge_indexes(segments, deleted, self.k1, self.b, self.epsilon, self.dtype)
+        keys = [segments[i].keys[position] for i, position in sources]
+        hashes = [segments[i].hashes[position] for i, position in sources]
+
+        def lines():
+            for i, segment in enumerate(segments):
+                yield from segment.read_lines(position for current, position in sources if current == i)
+
+        write_segment(join(self.directory, name), bm25, keys, hashes, lines())
+        merged = Segment(join(self.directory, name))
+
+        with self._lock:
+            entries = {entry["name"]: entry for entry in self.manifest["segments"]}
+            new_positions = {source: position for position, source in enumerate(sources)}
+            new_deleted = []
+            for i, (source_name, before) in enumerate(zip(names, deleted_before)):
+                for position in set(entries[source_name]["deleted"]) - before:
+                    new_deleted.append(new_positions[i, position])
+            for position, (i, old_position) in enumerate(sources):
+                if self._locations.get(keys[position]) == (names[i], old_position):
+                    self._locations[keys[position]] = (name, position)
+            first = self.manifest["segments"].index(entries[names[0]])
+            self.manifest["segments"][first:first + len(names)] = [{"name": name, "deleted": sorted(new_deleted)}]
+            self._segments[name] = merged
+            for source_name in names:
+                del self._segments[source_name]
+            self._save_manifest()
+        # open memory maps of queries running on the old segments stay valid
+        for source_name in names:
+            shutil.rmtree(join(self.directory, source_name))
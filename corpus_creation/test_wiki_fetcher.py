@@ -0,0 +1,126 @@
+"""
+Tests of the concurrent fetch stage against the local stand-in of the Wikipedia API, run with
+python -m unittest test_wiki_fetcher in corpus_creation
+"""
+
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import aiohttp
+
+from wiki_api_stub import WikiAPIStub, example_pages
+from wiki_fetcher import WikiFetcher, count_written, skip_written
+
+
+TITLES = ["Haus", "häuser", "Fehlt", "Kaputt", "Ünïcode (Begriff)"] + [f"Seite {i}" for i in range(100)]
+
+
+def page_json(title, page) -> str:
+    if not page.exists():
+        return json.dumps({"question": title, "target_text": "page does not exist"}, ensure_ascii=False)
+    return json.dumps({"question": title, "target_title": page.title, "target_text": page.text}, ensure_ascii=False)
+
+
+class WikiFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        pages, redirects = example_pages()
+        self.stub = WikiAPIStub(pages, redirects, delay=0.01)
+        self.api_url = self.stub.start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def fetcher(self, **kwargs) -> WikiFetcher:
+        kwargs = {"concurrency": 8, "rate": 1000.0, "backoff": 0.01, **kwargs}
+        return WikiFetcher("de", api_url=self.api_url, **kwargs)
+
+    def test_pages_in_order(self):
+        with self.fetcher() as fetcher:
+            pages = fetcher.pages(TITLES, ("extracts", "categories"))
+        self.assertEqual(len(pages), len(TITLES))
+        self.assertEqual(pages[0].text, "Ein Haus.\n\nGeschichte\nAlt.")
+        self.assertEqual(list(pages[0].categories), ["Kategorie:Bauwerk"])
+        # the lower case title and the redirect are resolved to the same page
+        self.assertEqual(pages[1].title, "Haus")
+        self.assertEqual(pages[1].text, pages[0].text)
+        self.assertFalse(pages[2].exists())
+        self.assertFalse(pages[3].exists())
+        self.assertEqual(pages[4].text, "Text ü")
+        for i, page in enumerate(pages[5:]):
+            self.assertEqual(page.title, f"Seite {i}")
+            self.assertEqual(page.text, (f"Seite {i}. " * (i % 5)).strip())
+        self.assertGreater(self.stub.max_in_flight, 1)
+        self.assertLessEqual(self.stub.max_in_flight, 8)
+
+    def test_info_and_langlinks(self):
+        with self.fetcher() as fetcher:
+            house, missing, odd = fetcher.pages(["Haus", "Seite 2", "Seite 3"], ("info", "langlinks"))
+        self.assertEqual(house.fullurl, "https://de.wikipedia.org/wiki/Haus")
+        self.assertEqual(house.langlinks["en"].title, "House")
+        self.assertEqual(house.langlinks["en"].fullurl, "https://en.wikipedia.org/wiki/House")
+        self.assertNotIn("en", missing.langlinks)
+        self.assertEqual(odd.langlinks["en"].title, "Page 3")
+
+    def test_retries(self):
+        with self.fetcher() as fetcher:
+            expected = [page_json(title, page) for title, page in zip(TITLES, fetcher.pages(TITLES, ("extracts",)))]
+        for status in (503, 429):
+            self.stub.fail_status = status
+            self.stub.fail_times = 2
+            self.stub.failures.clear()
+            self.stub.requests = 0
+            with self.fetcher(retries=3) as fetcher:
+                pages = fetcher.pages(TITLES, ("extracts",))
+            self.assertEqual([page_json(title, page) for title, page in zip(TITLES, pages)], expected)
+            self.assertEqual(self.stub.requests, 3 * len(TITLES))
+
+    def test_retries_exhausted(self):
+        self.stub.fail_times = 3
+        with self.fetcher(retries=2) as fetcher:
+            with self.assertRaises(aiohttp.ClientResponseError) as raised:
+                fetcher.pages(["Haus"], ("extracts",))
+        self.assertEqual(raised.exception.status, 503)
+
+    def test_rate(self):
+        with self.fetcher(rate=20.0) as fetcher:
+            start = time.monotonic()
+            fetcher.pages(TITLES[:30], ("extracts",))
+            elapsed = time.monotonic() - start
+        # a burst of 20 requests, the other 10 requests at 20 per second
+        self.assertGreaterEqual(elapsed, 0.45)
+        self.assertEqual(self.stub.requests, 30)
+
+    def test_resume(self):
+        # questions occur twice, like the questions of the corpus that have several answer sets
+        questions = [(f"question {i % 80}", title) for i, title in enumerate(TITLES)]
+        with tempfile.TemporaryDirectory() as directory:
+            outfile = os.path.join(directory, "articles.json")
+            with self.fetcher() as fetcher, open(outfile, "w") as fout:
+                for (question, _), page in zip(questions, fetcher.iter_pages([t for _, t in questions], ("extracts",))):
+                    fout.write(page_json(question, page) + "\n")
+            with open(outfile, "rb") as fin:
+                expected = fin.read()
+            # an interrupted run leaves an incomplete last line
+            with open(outfile, "wb") as fout:
+                fout.write(expected[:len(expected) // 2])
+
+            written = count_written(outfile, lambda line: json.loads(line)["question"])
+            with open(outfile, "rb") as fin:
+                self.assertTrue(fin.read().endswith(b"\n"))
+            remaining = skip_written(questions, [question for question, _ in questions], written)
+            self.assertEqual(remaining, questions[len(questions) - len(remaining):])
+            self.stub.requests = 0
+            with self.fetcher() as fetcher, open(outfile, "a") as fout:
+                for (question, _), page in zip(remaining, fetcher.iter_pages([t for _, t in remaining], ("extracts",))):
+                    fout.write(page_json(question, page) + "\n")
+            self.assertEqual(self.stub.requests, len(remaining))
+            with open(outfile, "rb") as fin:
+                self.assertEqual(fin.read(), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,257 @@
+"""
+Offline resolution of Wikipedia titles to pages, redirect targets and language links from the SQL dumps
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+from os.path import join
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+
+import numpy as np
+from tqdm import tqdm
+
+from dump_bm25 import save_json_atomic
+from wiki_dump import normalize_title
+
+
+RESOLVER_VERSION = 1
+
+# a quoted MySQL string or an unquoted value like a number or NULL
+SQL_FIELD = r"(?:'(?:[^'\\]|\\.)*'|[^,'()]*)"
+# the rest of a row after the last field that is read
+SQL_ROW_END = r"(?:'(?:[^'\\]|\\.)*'|[^'()])*\)"
+SQL_ESCAPES = {"0": "\0", "b": "\b", "n": "\n", "r": "\r", "t": "\t", "Z": "\x1a"}
+
+
+def sql_value(field: str) -> str:
+    """Returns the value of a MySQL field, strings are unquoted and unescaped"""
+    if not field.startswith("'"):
+        return field
+    field = field[1:-1]
+    if "\\" in field:
+        field = re.sub(r"\\(.)", lambda match: SQL_ESCAPES.get(match.group(1), match.group(1)), field)
+    return field
+
+
+def iter_sql_rows(infile, columns: Sequence[str]) -> Tuple[List[str], ...]:
+    """Yields the values of the columns of every row of a gzipped MySQL table dump like enwiki-...-page.sql.gz.
+
+    The positions of the columns are read from the CREATE TABLE statement, so dumps with different schemas work.
+    """
+    with gzip.open(infile, "rt", encoding="utf-8", errors="replace") as fin:
+        table_columns = []
+        for line in fin:
+            if line.startswith("CREATE TABLE"):
+                continue
+            match = re.match(r"\s+`(\w+)`", line)
+            if match is not None:
+                table_columns.append(match.group(1))
+            elif table_columns and line.startswith(")"):
+                break
+        positions = [table_columns.index(column) for column in columns]
+        fields = [f"({SQL_FIELD})" if i in positions else SQL_FIELD for i in range(max(positions) + 1)]
+        row_pattern = re.compile(r"\(" + ",".join(fields) + SQL_ROW_END)
+        # the groups are in the order of the table, the values are returned in the order of the columns
+        order = [sorted(positions).index(position) for position in positions]
+        for line in fin:
+            if not line.startswith("INSERT INTO"):
+                continue
+            rows = row_pattern.findall(line)
+            if len(columns) == 1:
+                rows = [(row,) for row in rows]
+            yield [[sql_value(row[i]) for i in order] for row in rows]
+
+
+def title_hashes(titles: Sequence[str]) -> np.ndarray:
+    """Returns 64 bit hashes of the titles, collisions are negligible for the size of Wikipedia"""
+    digests = b"".join(hashlib.blake2b(title.encode("utf-8"), digest_size=8).digest() for title in titles)
+    return np.frombuffer(digests, dtype="<u8")
+
+
+def page_url(language: str, title: str) -> str:
+    """Returns the full URL of a page like MediaWiki, which leaves a few characters unescaped"""
+    return f"https://{language}.wikipedia.org/wiki/" + quote(title.replace(" ", "_"), safe=";@$!*(),/~:")
+
+
+def save_strings(directory: str, name: str, strings: Sequence[str]):
+    """Stores strings as one UTF-8 file and their byte offsets, which takes much less memory than a list of strings"""
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=offsets[1:])
+    with open(join(directory, f"{name}_titles.bin"), "wb") as fout:
+        fout.write(b"".join(encoded))
+    np.save(join(directory, f"{name}_offsets.npy"), offsets)
+
+
+class StringTable(object):
+    """Strings stored by save_strings, indexed by position"""
+
+    def __init__(self, directory: str, name: str):
+        with open(join(directory, f"{name}_titles.bin"), "rb") as fin:
+            self.data = fin.read()
+        self.offsets = np.load(join(directory, f"{name}_offsets.npy"))
+
+    def __getitem__(self, position: int) -> str:
+        return self.data[self.offsets[position]:self.offsets[position + 1]].decode("utf-8")
+
+
+def sorted_table(keys: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the keys and values sorted by key, the first value of a duplicate key is kept"""
+    order = np.argsort(keys, kind="stable")
+    keys, values = keys[order], values[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return keys[first], values[first]
+
+
+def lookup(keys: np.ndarray, needles: np.ndarray) -> np.ndarray:
+    """Returns the positions of the needles in the sorted keys, -1 for needles that are missing"""
+    if len(keys) == 0:
+        return np.full(len(needles), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(keys, needles), len(keys) - 1)
+    return np.where(keys[positions] == needles, positions, -1)
+
+
+def read_title_table(infile, key_column: str, columns: Sequence[str], condition) -> Tuple[np.ndarray, List[str]]:
+    """Returns the sorted integer keys and the titles of the rows of a redirect or langlinks table that match"""
+    keys = []
+    titles = []
+    for rows in tqdm(iter_sql_rows(infile, [key_column] + list(columns)), desc=os.path.basename(infile)):
+        for row in rows:
+            if condition(row):
+                keys.append(int(row[0]))
+                titles.append(row[-1])
+    keys, order = sorted_table(np.array(keys, dtype=np.int64), np.arange(len(keys)))
+    return keys, [titles[i] for i in order]
+
+
+def build_title_resolver(page_file, redirect_file, langlinks_file, directory: str, language: str = "en",
+                         target_language: str = "de") -> "TitleResolver":
+    """Builds the resolver of a language from its page, redirect and langlinks SQL dumps, an unchanged build is reused
+
+    Only the language links to the target language are stored.
+    """
+    source = {"version": RESOLVER_VERSION, "language": language, "target_language": target_language}
+    for name, infile in (("page", page_file), ("redirect", redirect_file), ("langlinks", langlinks_file)):
+        stat = os.stat(infile)
+        source[name] = [os.path.abspath(infile), stat.st_size, stat.st_mtime_ns]
+    resolver_file = join(directory, "resolver.json")
+    if os.path.exists(resolver_file):
+        with open(resolver_file) as fin:
+            saved = json.load(fin)
+        if all(saved.get(key) == value for key, value in source.items()):
+            return TitleResolver(directory)
+        print("title resolver outdated ", directory)
+    os.makedirs(directory, exist_ok=True)
+
+    # the rows of one INSERT statement are converted at once, so the Python objects of the whole table never exist
+    hashes = []
+    page_ids = []
+    for rows in tqdm(iter_sql_rows(page_file, ["page_id", "page_namespace", "page_title"]), desc="pages"):
+        rows = [row for row in rows if row[1] == "0"]
+        hashes.append(title_hashes([row[2].replace("_", " ") for row in rows]))
+        page_ids.append(np.array([int(row[0]) for row in rows], dtype=np.int64))
+    hashes, page_ids = sorted_table(np.concatenate(hashes), np.concatenate(page_ids))
+    np.save(join(directory, "title_hashes.npy"), hashes)
+    np.save(join(directory, "page_ids.npy"), page_ids)
+
+    # redirects to other namespaces and wikis are left out, their targets are stored with underscores
+    redirect_ids, redirect_titles = read_title_table(
+        redirect_file, "rd_from", ["rd_namespace", "rd_interwiki", "rd_title"],
+        lambda row: row[1] == "0" and not row[2])
+    np.save(join(directory, "redirect_ids.npy"), redirect_ids)
+    save_strings(directory, "redirect", [title.replace("_", " ") for title in redirect_titles])
+
+    langlink_ids, langlink_titles = read_title_table(langlinks_file, "ll_from", ["ll_lang", "ll_title"],
+                                                     lambda row: row[1] == target_language and row[2])
+    np.save(join(directory, "langlink_ids.npy"), langlink_ids)
+    save_strings(directory, "langlink", langlink_titles)
+
+    # written last, a resolver without it is incomplete
+    save_json_atomic(resolver_file, source)
+    print(len(page_ids), " pages, ", len(redirect_ids), " redirects, ", len(langlink_ids), " language links")
+    return TitleResolver(directory)
+
+
+class ResolvedPage(object):
+    """Page found by a TitleResolver with the attributes of a wikipediaapi page that get_original_articles uses"""
+
+    def __init__(self, language: str, title: str, page_id: int = -1, langlinks: Optional[Dict] = None):
+        self.language = language
+        self.title = title
+        self.pageid = page_id
+        self.langlinks = langlinks or {}
+
+    @property
+    def fullurl(self):
+        return page_url(self.language, self.title)
+
+    def exists(self):
+        return self.pageid != -1
+
+
+class TitleResolver(object):
+    """Answers whether titles exist, their redirect targets and their language links in memory.
+
+    Titles are resolved like the Wikipedia API with redirects: the first letter is case-insensitive, a redirect is
+    followed once and the title of a page is the title of the redirect target.
+    """
+
+    def __init__(self, directory: str):
+        with open(join(directory, "resolver.json")) as fin:
+            saved = json.load(fin)
+        self.language = saved["language"]
+        self.target_language = saved["target_language"]
+        self.hashes = np.load(join(directory, "title_hashes.npy"))
+        self.page_ids = np.load(join(directory, "page_ids.npy"))
+        self.redirect_ids = np.load(join(directory, "redirect_ids.npy"))
+        self.redirect_titles = StringTable(directory, "redirect")
+        self.langlink_ids = np.load(join(directory, "langlink_ids.npy"))
+        self.langlink_titles = StringTable(directory, "langlink")
+
+    def find(self, titles: Sequence[str]) -> np.ndarray:
+        """Returns the page ids of the titles, -1 for missing titles"""
+        positions = lookup(self.hashes, title_hashes(titles))
+        return np.where(positions == -1, -1, self.page_ids[positions])
+
+    def pages(self, titles: Sequence[str]) -> List[ResolvedPage]:
+        """Resolves a batch of titles at once"""
+        titles = [normalize_title(title) for title in titles]
+        page_ids = self.find(titles)
+        redirects = lookup(self.redirect_ids, page_ids)
+        for i in np.flatnonzero(redirects != -1):
+            titles[i] = self.redirect_titles[redirects[i]]
+        # the page of a redirect target is looked up again, it is missing if the target does not exist
+        redirected = np.flatnonzero(redirects != -1)
+        if len(redirected):
+            page_ids[redirected] = self.find([titles[i] for i in redirected])
+        langlinks = lookup(self.langlink_ids, page_ids)
+        pages = []
+        for i, title in enumerate(titles):
+            page_links = {}
+            if page_ids[i] != -1 and langlinks[i] != -1:
+                target_title = self.langlink_titles[langlinks[i]]
+                page_links[self.target_language] = ResolvedPage(self.target_language, target_title)
+            pages.append(ResolvedPage(self.language, title, int(page_ids[i]), page_links))
+        return pages
+
+    def page(self, title: str) -> ResolvedPage:
+        return self.pages([title])[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the title resolver of a Wikipedia from its SQL dumps")
+    parser.add_argument("--page", default="/home/ca/wikipedia_en/enwiki-20200601-page.sql.gz")
+    parser.add_argument("--redirect", default="/home/ca/wikipedia_en/enwiki-20200601-redirect.sql.gz")
+    parser.add_argument("--langlinks", default="/home/ca/wikipedia_en/enwiki-20200601-langlinks.sql.gz")
+    parser.add_argument("--resolver_dir", default="title_resolver")
+    parser.add_argument("--language", default="en")
+    parser.add_argument("--target_language", default="de")
+    args = parser.parse_args()
+    build_title_resolver(args.page, args.redirect, args.langlinks, args.resolver_dir, args.language,
+                         args.target_language)
@@ -1,32 +1,156 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List
 
 import googletrans
 from tqdm import tqdm
 
+from wiki_fetcher import count_written, skip_written
 
-def translate(infile, outfile):
-    translator = googletrans.Translator()
+
+class Translator(object):
+    """Backend of the translation stage, translates a batch of texts into the language dest"""
+
+    def translate_batch(self, texts: List[str], dest: str) -> List[str]:
+        raise NotImplementedError
+
+
+class GoogleTranslator(Translator):
+
+    def __init__(self):
+        # every worker thread has its own client
+        self._local = threading.local()
+
+    def translate_batch(self, texts: List[str], dest: str) -> List[str]:
+        if not hasattr(self._local, "translator"):
+            self._local.translator = googletrans.Translator()
+        return [translated.text for translated in self._local.translator.translate(texts, dest=dest)]
+
+
+class IdentityTranslator(Translator):
+    """Offline stand-in that returns the texts unchanged, e.g. to try the stage without network access"""
+
+    def translate_batch(self, texts: List[str], dest: str) -> List[str]:
+        return list(texts)
+
+
+BACKENDS = {"google": GoogleTranslator, "identity": IdentityTranslator}
+
+
+class TranslationMemory(object):
+    """Translations stored in an sqlite database, keyed by source text and target language"""
+
+    def __init__(self, filename: str):
+        self.connection = sqlite3.connect(filename, timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS translations "
+                                    "(source TEXT, dest TEXT, translation TEXT, PRIMARY KEY (source, dest))")
+
+    def lookup(self, texts: Iterable[str], dest: str) -> Dict[str, str]:
+        texts = list(texts)
+        translations = {}
+        for start in range(0, len(texts), 500):
+            current = texts[start:start + 500]
+            rows = self.connection.execute(f"SELECT source, translation FROM translations WHERE dest = ? AND source "
+                                           f"IN ({','.join('?' * len(current))})", [dest] + current)
+            translations.update(rows)
+        return translations
+
+    def store(self, translations: Dict[str, str], dest: str):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                                        ((source, dest, translation) for source, translation in translations.items()))
+
+    def close(self):
+        self.connection.close()
+
+
+def translate_with_retries(backend: Translator, texts: List[str], dest: str, retries: int = 3,
+                           backoff: float = 2.0) -> List[str]:
+    for attempt in range(retries + 1):
+        try:
+            return backend.translate_batch(texts, dest)
+        except Exception as e:
+            if attempt == retries:
+                raise e
+            print("translation failed, retrying: ", e)
+            time.sleep(backoff * 2 ** attempt)
+
+
+def read_items(infile) -> List[Dict]:
+    items = []
     with open(infile) as fin:
-        with open(outfile, "w") as fout:
-            for line in tqdm(fin):
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    current = json.loads(line)
-                except json.decoder.JSONDecodeError as e:
-                    print("line: ", line)
-                    raise e
-                question = current["question"]
-                current["translated_question"] = translator.translate(question, dest="de").text
-                answers = current["answers"]
-                current["translated_answers"] = [translator.translate(answer, dest="de").text for answer in answers]
-                json.dump(current, fout, ensure_ascii=False)
+        for line in fin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.decoder.JSONDecodeError as e:
+                print("line: ", line)
+                raise e
+    return items
+
+
+def translate(infile, outfile, backend: Translator = None, memory_file="translation_memory.sqlite", dest="de",
+              resume=False, batch_size=50, workers=4, chunk_size=1000):
+    """Adds the translations of the questions and answers to the items of infile.
+
+    Every distinct text is translated once, texts translated before are taken from the translation memory. The items
+    are processed in chunks: the new texts of a chunk are translated in batches of batch_size by workers threads and
+    stored in the memory, then the items of the chunk are written in order. With resume the questions already in
+    outfile are skipped.
+    """
+    backend = backend or GoogleTranslator()
+    items = read_items(infile)
+    if resume:
+        written = count_written(outfile, lambda line: json.loads(line)["question"])
+        items = skip_written(items, [item["question"] for item in items], written)
+    memory = TranslationMemory(memory_file)
+    translated = 0
+    with open(outfile, "a" if resume else "w") as fout, ThreadPoolExecutor(workers) as executor:
+        for start in tqdm(range(0, len(items), chunk_size)):
+            chunk = items[start:start + chunk_size]
+            texts = {item["question"] for item in chunk} | {answer for item in chunk for answer in item["answers"]}
+            translations = memory.lookup(texts, dest)
+            missing = sorted(texts - translations.keys())
+            batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+            for batch, batch_translations in zip(batches, executor.map(
+                    lambda batch: translate_with_retries(backend, batch, dest), batches)):
+                if len(batch_translations) != len(batch):
+                    raise ValueError(f"{len(batch_translations)} translations of {len(batch)} texts")
+                new_translations = dict(zip(batch, batch_translations))
+                # stored per batch, so the translations of an interrupted chunk are not lost
+                memory.store(new_translations, dest)
+                translations.update(new_translations)
+            translated += len(missing)
+            for item in chunk:
+                item["translated_question"] = translations[item["question"]]
+                item["translated_answers"] = [translations[answer] for answer in item["answers"]]
+                json.dump(item, fout, ensure_ascii=False)
                 fout.write("\n")
-                fout.flush()
+            fout.flush()
+    memory.close()
+    print(f"{len(items)} items, {translated} texts translated")
 
 
 if __name__ == "__main__":
-    infile = "/home/ca/Documents/Uni/Masterarbeit/crosslingual-qa-scripts/corpus_creation/tail_train_urls.json"
-    outfile = "/home/ca/Documents/Uni/Masterarbeit/crosslingual-qa-scripts/corpus_creation/train_translated_4.json"
-    translate(infile, outfile)
+    parser = argparse.ArgumentParser(description="Translate the questions and answers")
+    parser.add_argument("--infile",
+                        default="/home/ca/Documents/Uni/Masterarbeit/crosslingual-qa-scripts/corpus_creation/"
+                                "tail_train_urls.json")
+    parser.add_argument("--outfile",
+                        default="/home/ca/Documents/Uni/Masterarbeit/crosslingual-qa-scripts/corpus_creation/"
+                                "train_translated_4.json")
+    parser.add_argument("--backend", default="google", choices=sorted(BACKENDS))
+    parser.add_argument("--memory", default="translation_memory.sqlite", help="translations of earlier runs")
+    parser.add_argument("--resume", action="store_true", help="skip the questions that are already in the output")
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=4, help="number of batches translated at once")
+    args = parser.parse_args()
+    translate(args.infile, args.outfile, BACKENDS[args.backend](), args.memory, resume=args.resume,
+              batch_size=args.batch_size, workers=args.workers)
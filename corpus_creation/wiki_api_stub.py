@@ -0,0 +1,131 @@
+"""
+Local stand-in for the query API of Wikipedia to run the fetch stage without network access
+"""
+
+import asyncio
+from collections import Counter
+import random
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+
+class StubPage(object):
+
+    def __init__(self, pageid: int, text: str, categories: List[str] = (), langlinks: Dict[str, str] = None):
+        self.pageid = pageid
+        self.text = text
+        self.categories = list(categories)
+        self.langlinks = langlinks or {}
+
+
+class WikiAPIStub(object):
+    """Serves canned action=query responses for the props info, extracts, langlinks and categories.
+
+    Titles are normalized and redirects are resolved like by the API. Every response is delayed by up to delay seconds
+    and every distinct query fails fail_times times with fail_status before it is answered, a 429 with Retry-After 0.
+
+    Args:
+        pages: {title: page}
+        redirects: {title: target title}
+    """
+
+    def __init__(self, pages: Dict[str, StubPage], redirects: Optional[Dict[str, str]] = None, language: str = "de",
+                 delay: float = 0.0, fail_times: int = 0, fail_status: int = 503):
+        self.pages = pages
+        self.redirects = redirects or {}
+        self.language = language
+        self.delay = delay
+        self.fail_times = fail_times
+        self.fail_status = fail_status
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.failures = Counter()
+        self._loop = None
+        self._runner = None
+
+    @staticmethod
+    def normalize(title: str) -> str:
+        title = title.replace("_", " ").strip()
+        return title[:1].upper() + title[1:]
+
+    def page_url(self, title: str, language: Optional[str] = None) -> str:
+        return f"https://{language or self.language}.wikipedia.org/wiki/{title.replace(' ', '_')}"
+
+    def query(self, prop: str, title: str) -> Dict:
+        query = {}
+        normalized = self.normalize(title)
+        if normalized != title:
+            query["normalized"] = [{"from": title, "to": normalized}]
+        if normalized in self.redirects:
+            query["redirects"] = [{"from": normalized, "to": self.redirects[normalized]}]
+            normalized = self.redirects[normalized]
+        page = self.pages.get(normalized)
+        if page is None:
+            query["pages"] = {"-1": {"ns": 0, "title": normalized, "missing": ""}}
+            return {"batchcomplete": "", "query": query}
+        value = {"pageid": page.pageid, "ns": 0, "title": normalized}
+        if prop == "info":
+            value.update({"fullurl": self.page_url(normalized), "length": len(page.text)})
+        elif prop == "extracts":
+            value["extract"] = page.text
+        elif prop == "categories" and page.categories:
+            value["categories"] = [{"ns": 14, "title": category} for category in page.categories]
+        elif prop == "langlinks" and page.langlinks:
+            value["langlinks"] = [{"lang": language, "url": self.page_url(target, language), "*": target}
+                                  for language, target in page.langlinks.items()]
+        query["pages"] = {str(page.pageid): value}
+        return {"batchcomplete": "", "query": query}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay:
+                await asyncio.sleep(random.uniform(0, self.delay))
+            params = request.query
+            key = (params["prop"], params["titles"])
+            if self.failures[key] < self.fail_times:
+                self.failures[key] += 1
+                headers = {"Retry-After": "0"} if self.fail_status == 429 else None
+                return web.Response(status=self.fail_status, headers=headers)
+            return web.json_response(self.query(params["prop"], params["titles"]))
+        finally:
+            self.in_flight -= 1
+
+    def start(self, port: int = 0) -> str:
+        """Serves the API on a thread and returns its URL, a free port is used by default"""
+        self._loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_get("/w/api.php", self.handle)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        self._loop.run_until_complete(site.start())
+        port = self._runner.addresses[0][1]
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+        return f"http://127.0.0.1:{port}/w/api.php"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def __enter__(self) -> str:
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def example_pages(n: int = 100) -> Tuple[Dict[str, StubPage], Dict[str, str]]:
+    """Returns pages and redirects with umlauts, missing categories and language links and a broken redirect"""
+    pages = {"Haus": StubPage(1, "Ein Haus.\n\n== Geschichte ==\nAlt.", ["Kategorie:Bauwerk"], {"en": "House"}),
+             "Ünïcode (Begriff)": StubPage(2, "Text ü")}
+    for i in range(n):
+        pages[f"Seite {i}"] = StubPage(100 + i, f"Seite {i}. " * (i % 5), [f"Kategorie:K{i % 3}"],
+                                       {"en": f"Page {i}"} if i % 2 else None)
+    redirects = {"Häuser": "Haus", "Kaputt": "Fehlt"}
+    return pages, redirects
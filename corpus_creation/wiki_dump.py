@@ -0,0 +1,215 @@
+"""
+Reading pages from MediaWiki XML dumps
+"""
+
+import bz2
+from bz2 import BZ2File
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO
+import os
+from typing import Iterator, List, Optional, Tuple
+
+
+Page = Tuple[int, int, str, str]
+
+
+# namespaces of articles, see https://www.mediawiki.org/wiki/Manual:Namespace
+ARTICLE_NAMESPACES = (0,)
+
+
+def normalize_title(title: str) -> str:
+    """Returns a title like MediaWiki stores it: spaces instead of underscores, no section, first letter upper case"""
+    title = " ".join(title.split("#")[0].replace("_", " ").split())
+    return title[:1].upper() + title[1:]
+
+
+def iter_page_elements(fin, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """Yields the raw bytes of every <page> element of an uncompressed XML dump file object, without parsing it"""
+    buffer = b""
+    # the part of the buffer that was already searched for the end of the current page
+    searched = 0
+    while True:
+        chunk = fin.read(chunk_size)
+        if not chunk:
+            return
+        buffer += chunk
+        position = 0
+        while True:
+            begin = buffer.find(b"<page>", position)
+            if begin == -1:
+                # the tag might be cut at the end of the chunk
+                position = max(position, len(buffer) - len(b"<page>") + 1)
+                searched = 0
+                break
+            end = buffer.find(b"</page>", max(begin, searched))
+            if end == -1:
+                position = begin
+                searched = len(buffer) - len(b"</page>") + 1
+                break
+            end += len(b"</page>")
+            yield buffer[begin:end]
+            position = end
+            searched = 0
+        buffer = buffer[position:]
+        searched = max(searched - position, 0)
+
+
+def element_text(page: bytes, tag: bytes, start: int = 0) -> Tuple[Optional[bytes], int]:
+    """Returns the content of the first element with the tag after start and the position after it.
+
+    The content is None if the element is missing or empty.
+    """
+    begin = page.find(b"<" + tag, start)
+    if begin == -1:
+        return None, start
+    begin = page.index(b">", begin) + 1
+    if page[begin - 2] == ord("/"):
+        return None, begin
+    end = page.index(b"</" + tag + b">", begin)
+    return page[begin:end], end
+
+
+# the entities escaped in the dumps, &amp; has to be replaced last
+XML_ENTITIES = (("&lt;", "<"), ("&gt;", ">"), ("&quot;", '"'), ("&#039;", "'"), ("&apos;", "'"), ("&amp;", "&"))
+
+
+def decode_xml(text: bytes) -> str:
+    text = text.decode("utf-8")
+    if "&" in text:
+        for entity, character in XML_ENTITIES:
+            text = text.replace(entity, character)
+    return text
+
+
+def parse_page(page: bytes, namespaces=ARTICLE_NAMESPACES, skip_redirects: bool = True) -> Optional[Page]:
+    """Returns (page id, namespace, title, text) of the bytes of a <page> element.
+
+    Returns None for pages without a text, pages outside of the namespaces (all if None) and for redirects if
+    skip_redirects, these are recognized before the text is decoded.
+    """
+    title, position = element_text(page, b"title")
+    ns, position = element_text(page, b"ns", position)
+    ns = int(ns)
+    if namespaces is not None and ns not in namespaces:
+        return None
+    revision = page.find(b"<revision>", position)
+    if skip_redirects and page.find(b"<redirect", position, revision) != -1:
+        return None
+    page_id, _ = element_text(page, b"id", position)
+    text, _ = element_text(page, b"text", revision)
+    if text is None:
+        print("no text ", decode_xml(title))
+        return None
+    return int(page_id), ns, decode_xml(title), decode_xml(text)
+
+
+def iter_xml_pages(fin, namespaces=ARTICLE_NAMESPACES, skip_redirects: bool = True) -> Iterator[Page]:
+    """Yields (page id, namespace, title, text) of the pages with a text of an uncompressed XML file object.
+
+    The pages are cut out of the bytes and only the few elements that are needed are searched, which is much faster
+    than building XML elements. See parse_page for the filters.
+    """
+    for element in iter_page_elements(fin):
+        page = parse_page(element, namespaces, skip_redirects)
+        if page is not None:
+            yield page
+
+
+def find_index_file(infile) -> Optional[str]:
+    """Returns the offset index shipped with a multistream dump, e.g. ...-multistream-index.txt.bz2, if it exists"""
+    infile = str(infile)
+    if not infile.endswith("multistream.xml.bz2"):
+        return None
+    index_file = infile[:-len(".xml.bz2")] + "-index.txt.bz2"
+    return index_file if os.path.exists(index_file) else None
+
+
+def read_stream_offsets(index_file) -> List[int]:
+    """Returns the sorted byte offsets of the bz2 streams of a multistream dump.
+
+    Every line of the index is offset:page id:title, the pages of one stream share the offset.
+    """
+    offsets = set()
+    with BZ2File(index_file, "rb") as fin:
+        for line in fin:
+            offsets.add(int(line[:line.index(b":")]))
+    return sorted(offsets)
+
+
+def read_stream_pages(infile, start: int, end: Optional[int], namespaces=ARTICLE_NAMESPACES,
+                      skip_redirects: bool = True) -> List[Page]:
+    """Decompresses the bz2 streams in the byte range [start, end) of a multistream dump and parses their pages"""
+    with open(infile, "rb") as fin:
+        fin.seek(start)
+        data = bz2.decompress(fin.read(-1 if end is None else end - start))
+    return list(iter_xml_pages(BytesIO(data), namespaces, skip_redirects))
+
+
+def iter_dump_stream_pages(infile, index_file=None, processes: int = 1, ordered: bool = True,
+                           streams_per_task: int = 10, start_offset: int = 0, namespaces=ARTICLE_NAMESPACES,
+                           skip_redirects: bool = True) -> Iterator[Tuple[int, Page]]:
+    """Yields (stream offset, page) for the pages of a bz2 compressed dump.
+
+    The stream offset is the byte offset of the first of the streams that were decompressed together and a valid
+    start_offset to continue reading from, it is 0 if the dump is read sequentially. See iter_dump_pages for the
+    other arguments.
+    """
+    index_file = index_file or find_index_file(infile)
+    if index_file is None or (processes <= 1 and not start_offset):
+        if processes > 1:
+            print("no stream index for ", infile, ", reading sequentially")
+        if start_offset:
+            raise ValueError(f"no stream index for {infile} to start reading at {start_offset}")
+        with BZ2File(infile, "rb") as bzfin:
+            for page in iter_xml_pages(bzfin, namespaces, skip_redirects):
+                yield 0, page
+        return
+
+    offsets = [offset for offset in read_stream_offsets(index_file) if offset >= start_offset]
+    # the pages before the first indexed stream are only the siteinfo, the last stream ends at the end of the file
+    bounds = offsets[::streams_per_task] + [None]
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    processes = max(processes, 1)
+    with ProcessPoolExecutor(processes) as executor:
+        # a few tasks per process are in flight, so the decompressed pages do not pile up
+        pending = deque()
+        for start, end in ranges:
+            pending.append((start, executor.submit(read_stream_pages, infile, start, end, namespaces, skip_redirects)))
+            if len(pending) > 2 * processes:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    finished, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                    done = [task for task in pending if task[1] in finished]
+                    for task in done:
+                        pending.remove(task)
+                for stream_offset, future in done:
+                    for page in future.result():
+                        yield stream_offset, page
+        while pending:
+            stream_offset, future = pending.popleft()
+            for page in future.result():
+                yield stream_offset, page
+
+
+def iter_dump_pages(infile, index_file=None, processes: int = 1, ordered: bool = True,
+                    streams_per_task: int = 10, start_offset: int = 0, namespaces=ARTICLE_NAMESPACES,
+                    skip_redirects: bool = True) -> Iterator[Page]:
+    """Yields (page id, namespace, title, text) of the articles in a bz2 compressed dump.
+
+    The streams of a multistream dump are decompressed and parsed in a process pool if its offset index is found,
+    otherwise the dump is read sequentially.
+
+    Args:
+        index_file: offset index of the dump, looked up next to the dump by default
+        processes: number of processes decompressing streams
+        ordered: yield the pages in the order of the dump, otherwise in the order they are decompressed
+        streams_per_task: number of consecutive streams (100 pages each) decompressed by one task
+        start_offset: byte offset of the stream to start reading at, requires the offset index
+        namespaces: namespaces of the pages, all if None
+        skip_redirects: leave out redirect pages
+    """
+    for _, page in iter_dump_stream_pages(infile, index_file, processes, ordered, streams_per_task, start_offset,
+                                          namespaces, skip_redirects):
+        yield page
@@ -0,0 +1,223 @@
+"""
+Concurrent fetching of Wikipedia pages over a pooled session with rate limiting, retries and ordered results
+"""
+
+import asyncio
+from collections import Counter, deque
+import os
+import random
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import aiohttp
+
+from page_cache import PageCache
+from wiki_page import WikiPage, extract_page_text
+
+
+# the parameters of the requests wikipediaapi makes for the properties of a page
+PAGE_QUERIES = {
+    "info": {"prop": "info", "inprop": "protection|talkid|watched|watchers|visitingwatchers|notificationtimestamp|"
+                                      "subjectid|url|readable|preload|displaytitle"},
+    "extracts": {"prop": "extracts", "explaintext": 1, "exsectionformat": "wiki"},
+    "langlinks": {"prop": "langlinks", "lllimit": 500, "llprop": "url"},
+    "categories": {"prop": "categories", "cllimit": 500},
+}
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+USER_AGENT = "Wikipedia-API (https://github.com/martin-majlis/Wikipedia-API)"
+
+
+class TokenBucket(object):
+    """Lets rate requests per second through on average and bursts of up to capacity requests"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # the waiting requests get their tokens in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def build_page(title: str, responses: Dict[str, Dict]) -> WikiPage:
+    """Returns the page of a title with the attributes of the API responses of its calls {call: response}.
+
+    The attributes are the ones wikipediaapi reads from the same responses, the text is built from the extract like
+    the texts of the article store.
+    """
+    page = WikiPage(title)
+    for call, response in responses.items():
+        key, value = next(iter(response["query"]["pages"].items()))
+        if key == "-1":
+            page.pageid = -1
+            continue
+        page.title = value["title"]
+        page.pageid = value["pageid"]
+        if call == "info":
+            page.fullurl = value.get("fullurl")
+        elif call == "extracts":
+            page.text = extract_page_text(value.get("extract", ""))
+        elif call == "langlinks":
+            page.langlinks = {link["lang"]: WikiPage(link["*"], fullurl=link["url"])
+                              for link in value.get("langlinks", [])}
+        elif call == "categories":
+            page.categories = [category["title"] for category in value.get("categories", [])]
+    return page
+
+
+class WikiFetcher(object):
+    """Fetches Wikipedia pages concurrently over one pooled HTTP session.
+
+    The pages are built from the same requests as wikipediaapi makes, but the requests of many pages are in flight at
+    once. Failed requests and the statuses in RETRY_STATUSES are retried with exponential backoff.
+
+    Args:
+        concurrency: maximal number of requests in flight
+        rate: maximal number of requests per second
+        retries: number of retries of a request before its error is raised
+        backoff: seconds to wait before the first retry, doubled for every further retry
+        api_url: URL of the API, e.g. of a local server, the Wikipedia of the language by default
+        cache: responses of earlier lookups, the responses that are fetched are added
+    """
+
+    def __init__(self, language: str, concurrency: int = 8, rate: float = 20.0, retries: int = 5,
+                 backoff: float = 1.0, timeout: float = 60.0, api_url: Optional[str] = None,
+                 headers: Optional[Dict[str, str]] = None, cache: Optional[PageCache] = None):
+        self.language = language
+        self.cache = cache
+        self.api_url = api_url or f"https://{language}.wikipedia.org/w/api.php"
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._loop = asyncio.new_event_loop()
+        self._session = self._loop.run_until_complete(self._open_session(rate, timeout, headers))
+
+    async def _open_session(self, rate: float, timeout: float,
+                            headers: Optional[Dict[str, str]]) -> aiohttp.ClientSession:
+        # the lock of the bucket and the semaphore are created in the loop, before Python 3.10 they are bound to the
+        # current event loop when they are created instead of to the loop they are used in
+        self._bucket = TokenBucket(rate)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        # the connections are kept alive and reused by all requests
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        return aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT, **(headers or {})},
+                                     timeout=aiohttp.ClientTimeout(total=timeout))
+
+    async def query(self, params: Dict) -> Dict:
+        """Returns the JSON response of an API query with the parameters, redirects are resolved like by wikipediaapi"""
+        params = {"action": "query", **params, "format": "json", "redirects": 1}
+        for attempt in range(self.retries + 1):
+            await self._bucket.acquire()
+            retry_after = None
+            try:
+                async with self._semaphore, self._session.get(self.api_url, params=params) as response:
+                    if response.status in RETRY_STATUSES and attempt < self.retries:
+                        retry_after = response.headers.get("Retry-After")
+                    else:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt
+            # the jitter keeps the retries of concurrent requests apart
+            await asyncio.sleep(delay * random.uniform(1, 1.5))
+
+    async def page(self, title, calls: Sequence[str]) -> WikiPage:
+        """Returns the page with the properties of the calls, e.g. ("extracts", "categories"), fetched.
+
+        A list of titles is looked up by its first title.
+        """
+        if not isinstance(title, str):
+            title = title[0]
+        responses = self.cache.get(self.language, title) if self.cache is not None else {}
+        missing = [call for call in calls if call not in responses]
+        if missing:
+            raws = await asyncio.gather(*(self.query({**PAGE_QUERIES[call], "titles": title}) for call in missing))
+            fetched = dict(zip(missing, raws))
+            if self.cache is not None:
+                self.cache.put(self.language, title, fetched)
+            responses.update(fetched)
+        return build_page(title, {call: responses[call] for call in calls})
+
+    def iter_pages(self, titles: Iterable, calls: Sequence[str],
+                   window: Optional[int] = None) -> Iterator[WikiPage]:
+        """Yields the pages of the titles in order while the pages after them are fetched.
+
+        Args:
+            window: maximal number of pages fetched ahead, 4 times the concurrency by default
+        """
+        window = window or 4 * self.concurrency
+        pending = deque()
+        for title in titles:
+            pending.append(self._loop.create_task(self.page(title, calls)))
+            if len(pending) >= window:
+                yield self._loop.run_until_complete(pending.popleft())
+        while pending:
+            yield self._loop.run_until_complete(pending.popleft())
+
+    def pages(self, titles: Iterable, calls: Sequence[str]) -> List[WikiPage]:
+        return list(self.iter_pages(titles, calls))
+
+    def close(self):
+        # the pages of an abandoned iter_pages are still being fetched
+        tasks = asyncio.all_tasks(self._loop)
+        if tasks:
+            for task in tasks:
+                task.cancel()
+            self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.run_until_complete(self._session.close())
+        self._loop.close()
+        if self.cache is not None:
+            print(f"page cache: {self.cache.hits} hits, {self.cache.misses} misses")
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def count_written(outfile, key_of_line: Callable[[str], str]) -> Counter:
+    """Returns how often every key occurs in the lines of an output file that is continued.
+
+    An incomplete last line of an interrupted run is cut off.
+    """
+    written = Counter()
+    if not os.path.exists(outfile):
+        return written
+    end = 0
+    with open(outfile, "rb+") as fin:
+        for line in fin:
+            if not line.endswith(b"\n"):
+                break
+            written[key_of_line(line.decode("utf-8"))] += 1
+            end += len(line)
+        fin.truncate(end)
+    return written
+
+
+def skip_written(items: Sequence, keys: Sequence[str], written: Counter) -> List:
+    """Returns the items that are not in the output yet, an item with a key that occurs n times is written n times"""
+    remaining = []
+    for item, key in zip(items, keys):
+        if written[key] > 0:
+            written[key] -= 1
+        else:
+            remaining.append(item)
+    if remaining and len(remaining) < len(items):
+        print(f"resuming after {len(items) - len(remaining)} written items")
+    return remaining
@@ -0,0 +1,52 @@
+"""
+Wikipedia pages built from the responses of the API or from the offline article store
+"""
+
+import re
+from typing import Dict, List, Optional
+
+
+# headings of the plain text extracts of the API with exsectionformat=wiki
+SECTION_PATTERN = re.compile(r"\n\n *(===*) (.*?) (===*) *\n")
+
+
+def extract_page_text(extract: str) -> str:
+    """Returns the text of a page with a plain text extract of the API, built from its sections like wikipediaapi does.
+
+    The summary and the sections are separated by empty lines and every heading is replaced by its title. Like in
+    wikipediaapi, the text of every section but the last is stripped and an extract without a summary before its
+    first heading is used as summary in whole.
+    """
+    matches = list(SECTION_PATTERN.finditer(extract))
+    summary = extract[:matches[0].start()].strip() if matches else ""
+    if not summary:
+        summary = extract.strip()
+    parts = [summary + "\n\n" if summary else ""]
+    for i, match in enumerate(matches):
+        if i + 1 < len(matches):
+            section_text = extract[match.end():matches[i + 1].start()].strip()
+        else:
+            section_text = extract[match.end():]
+        parts.append(match.group(2).strip() + "\n" + section_text + ("\n\n" if section_text else ""))
+    return "".join(parts).strip()
+
+
+class WikiPage(object):
+    """Page with the attributes of a wikipediaapi page that are used, a page that does not exist has the pageid -1
+
+    Args:
+        categories: titles of the categories with their namespace, e.g. "Kategorie:Bauwerk"
+        langlinks: {language: page} of the language links, which only have a title and a fullurl
+    """
+
+    def __init__(self, title: str, pageid: int = -1, text: str = "", categories: Optional[List[str]] = None,
+                 fullurl: Optional[str] = None, langlinks: Optional[Dict[str, "WikiPage"]] = None):
+        self.title = title
+        self.pageid = pageid
+        self.text = text
+        self.categories = categories or []
+        self.fullurl = fullurl
+        self.langlinks = langlinks or {}
+
+    def exists(self):
+        return self.pageid != -1